@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+bench_http_client.py
+────────────────────
+Per-request latency of urllib.request.urlopen (new connection per call)
+versus http_client.urlopen (pooled keep-alive), against a local stand-in
+server — no Supabase or OpenAI credentials needed.
+
+The server speaks HTTP/1.1 keep-alive, answers GET with a JSON page of
+verse-like rows (gzip-compressed when asked) and POST with a small JSON
+ack, like PostgREST. --handshake adds a delay to every NEW connection to
+stand in for the TCP + TLS round trips of a real upstream (a few RTTs,
+typically 50–150 ms to Supabase); --tls runs the server over real TLS with
+a throwaway self-signed certificate (needs the openssl CLI).
+
+  python3 scripts/bench_http_client.py
+  python3 scripts/bench_http_client.py --requests 500 --handshake 60 --workers 8
+  python3 scripts/bench_http_client.py --tls
+"""
+
+import argparse, gzip, json, os, shutil, socket, ssl, statistics, subprocess, sys, tempfile, threading, time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import http_client
+
+# ── Stand-in server ───────────────────────────────────────────────────────────
+
+def make_handler(handshake, page_rows):
+    page = json.dumps([{
+        "id": f"2:{i}", "surah_number": 2, "verse_number": i,
+        "translation": "Kitab (Al-Qur'an) ini tidak ada keraguan padanya; petunjuk bagi mereka yang bertakwa. " * 2,
+    } for i in range(1, page_rows + 1)]).encode()
+    page_gz = gzip.compress(page)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            time.sleep(handshake)          # once per connection
+            # headers and body go out as separate writes; like real servers,
+            # don't let Nagle hold the second one back for a delayed ACK
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            super().setup()
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, body, encoding=None):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                self.reply(page_gz, "gzip")
+            else:
+                self.reply(page)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self.reply(b'{"ok":true}')
+
+    return Handler, len(page), len(page_gz)
+
+
+def self_signed(tmp):
+    if not shutil.which("openssl"):
+        return None
+    cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def start_server(handler, cert=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    if cert:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(*cert)
+        server.socket = ctx.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scheme = "https" if cert else "http"
+    return server, f"{scheme}://localhost:{server.server_port}"
+
+# ── Clients ───────────────────────────────────────────────────────────────────
+
+def call_urllib(url, body, ctx):
+    req = urllib.request.Request(url, data=body, method="POST" if body else "GET",
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30, context=ctx) as resp:
+        return len(resp.read())
+
+
+def call_pooled(url, body, ctx):
+    req = urllib.request.Request(url, data=body, method="POST" if body else "GET",
+                                 headers={"Content-Type": "application/json"})
+    with http_client.urlopen(req, timeout=30) as resp:
+        return len(resp.read())
+
+
+def run(label, call, url, body, n, workers, ctx):
+    latencies = []
+    lock = threading.Lock()
+
+    def one(_):
+        t0 = time.perf_counter()
+        call(url, body, ctx)
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(one, range(n)))
+    wall = time.perf_counter() - t0
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"  {label:<26} mean {statistics.mean(latencies) * 1000:>7.1f} ms  "
+          f"p50 {statistics.median(latencies) * 1000:>7.1f} ms  p95 {p95 * 1000:>7.1f} ms  "
+          f"{n / wall:>7.0f} req/s")
+    return statistics.mean(latencies)
+
+# ── Main ──────────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent client threads")
+    parser.add_argument("--handshake", type=float, default=30.0,
+                        help="ms added per new connection (simulated TCP + TLS setup)")
+    parser.add_argument("--rows", type=int, default=50, help="rows in the GET response")
+    parser.add_argument("--tls", action="store_true", help="serve over TLS (self-signed)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert = None
+        if args.tls:
+            cert = self_signed(tmp)
+            if cert is None:
+                print("openssl not found — running without TLS")
+        handler, raw_size, gz_size = make_handler(args.handshake / 1000, args.rows)
+        server, base = start_server(handler, cert)
+
+        ctx = None
+        if cert:
+            ctx = ssl.create_default_context(cafile=cert[0])
+            http_client.ssl_context = ctx
+
+        print(f"\n── HTTP client benchmark ({args.requests} requests × {args.workers} worker(s), "
+              f"+{args.handshake:.0f} ms per new connection{', TLS' if cert else ''}) ──")
+        print(f"  GET body: {raw_size:,} B plain, {gz_size:,} B gzip\n")
+
+        body = json.dumps({"updates": [{"id": "1:1", "value": "x" * 200}] * 20}).encode()
+        for name, url, payload in (("GET  page", f"{base}/rest/v1/quran_verses", None),
+                                   ("POST rpc", f"{base}/rest/v1/rpc/update", body)):
+            before = run(f"{name} urllib", call_urllib, url, payload, args.requests, args.workers, ctx)
+            after  = run(f"{name} http_client", call_pooled, url, payload, args.requests, args.workers, ctx)
+            print(f"  → {before / after:.1f}× lower mean latency\n")
+
+        print(f"  {http_client.summary()}")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
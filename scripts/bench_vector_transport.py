@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+bench_vector_transport.py
+─────────────────────────
+Compares the two embedding wire formats used by reembed.py:
+
+  text — {"embedding": "[f1,f2,...]"}   → update_embedding_batch
+  f32  — {"embedding_f32": "<base64>"}   → update_embedding_batch_f32
+
+Offline (default): builds RPC payloads for synthetic 1536-dim vectors and
+reports payload bytes per row, projected bytes for the full corpus and
+client-side encode rows/second.
+
+Live (--live N): reads N existing vectors from Supabase and writes the same
+values back through both RPCs, reporting end-to-end rows/second. The rows
+are unchanged afterwards (float32 round-trip is exact).
+
+  python3 scripts/bench_vector_transport.py
+  python3 scripts/bench_vector_transport.py --live 500
+"""
+
+import argparse, json, random, sys, time, urllib.request
+from array import array
+
+import http_client, reembed
+
+CORPUS_ROWS = 6236
+
+# ── Payload builders ──────────────────────────────────────────────────────────
+
+def synthetic_vectors(n, dims):
+    """Unit-norm vectors, as OpenAI returns them (≈10 decimal places) and as
+    they come back from the float32 embedding cache."""
+    api, f32 = [], []
+    for _ in range(n):
+        v    = [random.gauss(0, 1) for _ in range(dims)]
+        norm = sum(x * x for x in v) ** 0.5
+        v    = [x / norm for x in v]
+        api.append([round(x, 10) for x in v])
+        f32.append(array("f", v).tolist())
+    return api, f32
+
+def payload(rows):
+    return json.dumps({"updates": rows}).encode()
+
+def measure(label, verses, vecs, transport, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0   = time.perf_counter()
+        body = payload([reembed.build_update_row(v, e, transport) for v, e in zip(verses, vecs)])
+        dt   = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    per_row = len(body) / len(verses)
+    print(f"  {label:<22} {per_row:>9,.0f} B/row  "
+          f"{per_row * CORPUS_ROWS / 1_048_576:>7.1f} MB/corpus  "
+          f"{len(verses) / best:>9,.0f} rows/s encode")
+    return per_row
+
+def offline(n, dims):
+    print(f"\n── Offline payload benchmark ({n} rows × {dims} dims) ─────────────────────")
+    verses    = [{"id": f"0:{i}", "translation": f"ayat {i}"} for i in range(n)]
+    api, f32  = synthetic_vectors(n, dims)
+    text_api  = measure("text (API floats)",    verses, api, "text")
+    text_f32  = measure("text (cached float32)", verses, f32, "text")
+    packed    = measure("f32 (base64)",          verses, f32, "f32")
+    print(f"\n  f32 payload is {packed / text_api:.0%} of text (API floats) "
+          f"and {packed / text_f32:.0%} of text (cached float32)")
+
+# ── Live round-trip ───────────────────────────────────────────────────────────
+
+def fetch_existing(n):
+    url = (f"{reembed.SUPABASE_URL}/rest/v1/quran_verses"
+           f"?select={reembed.VERSE_COLUMNS},embedding&order=id&limit={n}")
+    req = urllib.request.Request(url, headers=reembed.supabase_headers(reembed.SUPABASE_SERVICE_KEY))
+    with http_client.urlopen(req, timeout=60) as resp:
+        rows = json.loads(resp.read())
+    return rows, [json.loads(r.pop("embedding")) for r in rows]
+
+def live(n):
+    reembed.check_env()
+    print(f"\n── Live RPC benchmark ({n} rows, values written back unchanged) ──────────")
+    verses, vecs = fetch_existing(n)
+    for transport in ("text", "f32"):
+        step  = reembed.TRANSPORTS[transport][1]
+        rows  = [reembed.build_update_row(v, e, transport) for v, e in zip(verses, vecs)]
+        sent  = 0
+        t0    = time.perf_counter()
+        for start in range(0, len(rows), step):
+            batch = rows[start : start + step]
+            sent += len(payload(batch))
+            reembed.update_batch(batch, transport)
+        dt = time.perf_counter() - t0
+        print(f"  {transport:<5} {sent / 1_048_576:>7.2f} MB sent  "
+              f"{len(rows) / dt:>7,.0f} rows/s  ({step} rows/call)")
+
+# ── Main ──────────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500, help="rows for the offline benchmark")
+    parser.add_argument("--live", type=int, metavar="N", help="also round-trip N rows through Supabase")
+    args = parser.parse_args()
+
+    offline(args.rows, reembed.EMBED_DIMS)
+    if args.live:
+        live(args.live)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,9 @@ and writes data/verses.json.
 Run: python3 scripts/build_verses.py
 """
 
-import json, time, urllib.request, os, sys
+import json, time, os, sys
+
+import http_cache
 
 SEED = [
   # ── PARENTING / FAMILY ──────────────────────────────────────────────────────
@@ -102,10 +104,11 @@ SEED = [
   {"ref":"10:57","name":"Yunus","themes":["health","guidance","healing","heart","comfort","hope"],"tafsir":"Wahai manusia, sungguh telah datang kepadamu pelajaran dari Tuhanmu dan penyembuh bagi penyakit dalam dada. Al-Quran sendiri adalah obat — bukan hanya untuk tubuh, tapi terutama untuk jiwa."},
 ]
 
+def verse_url(ref):
+    return f"https://api.alquran.cloud/v1/ayah/{ref}/editions/quran-simple,id.indonesian"
+
 def fetch_verse(ref):
-    url = f"https://api.alquran.cloud/v1/ayah/{ref}/editions/quran-simple,id.indonesian"
-    with urllib.request.urlopen(url, timeout=15) as resp:
-        data = json.loads(resp.read().decode())
+    data = http_cache.fetch_json(verse_url(ref), timeout=15, validate=http_cache.code_ok)
     if data.get("code") != 200 or not data.get("data") or len(data["data"]) < 2:
         raise ValueError(f"API error for {ref}: {data.get('status','unknown')}")
     arabic      = data["data"][0]["text"]
@@ -118,6 +121,7 @@ def build():
     ok = fail = 0
     for item in SEED:
         print(f"  Fetching {item['ref']} ({item['name']}) … ", end="", flush=True)
+        polite = not http_cache.cached(verse_url(item["ref"]))
         try:
             arabic, translation, ayah_no = fetch_verse(item["ref"])
             verses.append({
@@ -134,7 +138,8 @@ def build():
         except Exception as e:
             print(f"✗  {e}")
             fail += 1
-        time.sleep(0.3)
+        if polite:
+            time.sleep(0.3)
 
     out_path = os.path.join(os.path.dirname(__file__), "../data/verses.json")
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
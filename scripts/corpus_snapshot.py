@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""
+corpus_snapshot.py
+──────────────────
+Columnar on-disk snapshot of quran_verses, so offline jobs start from local
+disk in milliseconds instead of minutes of paginated PostgREST JSON.
+
+Rows are addressed by a dense ayah index 0 … n-1 in mushaf order. Layout of
+one snapshot (scripts/snapshots/<version>/):
+
+  manifest.json          format, version, row count, per-file sha256
+  embedding.npy          float32 (n, dims), memory-mapped on load
+  surah_number.npy       int16 (n,)
+  verse_number.npy       int16 (n,)
+  <column>.bin           text column: zlib blocks of BLOCK_ROWS rows (UTF-8)
+  <column>.idx.npy       int64 (n + 1,) row offsets in the decompressed stream
+  <column>.blocks.npy    int64 (blocks + 1,) block offsets in <column>.bin
+  <column>.null.npy      bool (n,), only when the column has NULLs
+
+scripts/snapshots/CURRENT names the newest snapshot; exports write a new
+version directory and switch CURRENT atomically, keeping the last KEEP.
+
+  Snapshot(path=None)    — open a snapshot (default: CORPUS_SNAPSHOT, else
+                           CURRENT); arrays are mmapped, text blocks are
+                           decompressed on access
+    .embeddings / .has_embedding / .column(name)[i] / .index(surah, verse)
+    .rows(columns, ids=None) — row dicts, like supabase_rest.scan_verses
+    .take(columns, indices)  — row dicts for ayah indices
+  scan_verses(columns, filters=(), snapshot=None, live_nulls=()) — scan_verses
+                           with text read from the snapshot; filters are still
+                           evaluated live, fetching only ids; rows whose
+                           live_nulls columns changed NULL-ness are read live
+  export(root=None) → path
+
+Used by reembed.py, generate_tafsir_summaries.py and
+translate_asbabun_nuzul.py (--snapshot) and local_search.py. A snapshot is
+a point-in-time copy: re-export after re-seeding text or re-embedding.
+
+Requires numpy (pip install numpy).
+
+  python3 scripts/corpus_snapshot.py           # export a new snapshot
+  python3 scripts/corpus_snapshot.py --info    # describe the current one
+  python3 scripts/corpus_snapshot.py --verify  # check file checksums
+"""
+
+import argparse, hashlib, json, mmap, os, shutil, sys, time, urllib.parse, zlib
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import supabase_rest
+
+FORMAT       = 1
+BLOCK_ROWS   = 64     # rows per zlib block: random access inflates ≤ 64 rows
+ZLIB_LEVEL   = 9
+EXPORT_PAGE  = 200    # rows per PostgREST page (embeddings make rows ~30 KB)
+LIVE_CHUNK   = 100    # ids per id=in.(…) filter when re-reading stale rows
+KEEP         = 3      # snapshot versions kept after an export
+DEFAULT_ROOT = os.path.join(os.path.dirname(__file__), "snapshots")
+
+INT_COLUMNS  = ("surah_number", "verse_number")
+TEXT_COLUMNS = ("id", "surah_name", "arabic", "translation", "tafsir_quraish_shihab",
+                "tafsir_kemenag", "tafsir_ibnu_kathir", "tafsir_ibnu_kathir_id",
+                "asbabun_nuzul", "asbabun_nuzul_id", "embed_fingerprint")
+JSON_COLUMNS = ("tafsir_summary",)
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("corpus_snapshot needs numpy (pip install numpy)")
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def root_dir():
+    return os.environ.get("CORPUS_SNAPSHOT_ROOT") or DEFAULT_ROOT
+
+def current_path():
+    """Directory of the snapshot to load, or None if there is none."""
+    if os.environ.get("CORPUS_SNAPSHOT"):
+        return os.environ["CORPUS_SNAPSHOT"]
+    pointer = os.path.join(root_dir(), "CURRENT")
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        return os.path.join(root_dir(), f.read().strip())
+
+# ── Loader ────────────────────────────────────────────────────────────────────
+
+class Column:
+    """One text column: row i → str or None, inflating one block at a time."""
+
+    def __init__(self, path, name, n, kind, nulls):
+        self.name   = name
+        self.kind   = kind
+        self.n      = n
+        self.idx    = np.load(os.path.join(path, f"{name}.idx.npy"), mmap_mode="r")
+        self.blocks = np.load(os.path.join(path, f"{name}.blocks.npy"), mmap_mode="r")
+        self.null   = (np.load(os.path.join(path, f"{name}.null.npy"), mmap_mode="r")
+                       if nulls else None)
+        with open(os.path.join(path, f"{name}.bin"), "rb") as f:
+            size      = os.fstat(f.fileno()).st_size
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._last = (-1, b"")   # (block number, inflated bytes)
+
+    def __len__(self):
+        return self.n
+
+    def _block(self, b):
+        last = self._last
+        if last[0] != b:
+            raw  = memoryview(self.data)[int(self.blocks[b]) : int(self.blocks[b + 1])]
+            last = self._last = (b, zlib.decompress(raw))
+        return last[1]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n
+        if self.null is not None and self.null[i]:
+            return None
+        b     = i // BLOCK_ROWS
+        base  = int(self.idx[b * BLOCK_ROWS])
+        text  = self._block(b)[int(self.idx[i]) - base : int(self.idx[i + 1]) - base].decode("utf-8")
+        return json.loads(text) if self.kind == "json" else text
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+
+class Snapshot:
+
+    def __init__(self, path=None):
+        _require_numpy()
+        path = path or current_path()
+        if not path or not os.path.exists(os.path.join(path, "manifest.json")):
+            raise FileNotFoundError("no corpus snapshot — run python3 scripts/corpus_snapshot.py")
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest["format"] != FORMAT:
+            raise RuntimeError(f"snapshot format {self.manifest['format']} ≠ {FORMAT}; re-export it")
+        self.path    = path
+        self.version = self.manifest["version"]
+        self.n       = self.manifest["rows"]
+        self.ints    = {c: np.load(os.path.join(path, f"{c}.npy"), mmap_mode="r") for c in INT_COLUMNS}
+        self.embeddings    = np.load(os.path.join(path, "embedding.npy"), mmap_mode="r")
+        self.has_embedding = ~np.load(os.path.join(path, "embedding.null.npy"), mmap_mode="r")
+        self._columns = {}
+        self._index   = None   # verse id → ayah index, built on first lookup
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, verse_id):
+        try:
+            self.index_of(verse_id)
+        except KeyError:
+            return False
+        return True
+
+    @property
+    def age(self):
+        """Seconds since the export."""
+        return time.time() - self.manifest["created_at"]
+
+    def columns(self):
+        return list(INT_COLUMNS) + list(self.manifest["columns"])
+
+    def column(self, name):
+        if name in self.ints:
+            return self.ints[name]
+        if name not in self._columns:
+            meta = self.manifest["columns"].get(name)
+            if meta is None:
+                raise KeyError(f"column {name!r} is not in snapshot {self.version}")
+            self._columns[name] = Column(self.path, name, self.n, meta["kind"], meta["nulls"])
+        return self._columns[name]
+
+    def index(self, surah, verse):
+        """Dense ayah index of surah:verse."""
+        return self.index_of(f"{surah}:{verse}")
+
+    def index_of(self, verse_id):
+        """Dense ayah index of a verse id; KeyError if the snapshot lacks it."""
+        if self._index is None:
+            self._index = {vid: i for i, vid in enumerate(self.column("id"))}
+        try:
+            return self._index[verse_id]
+        except KeyError:
+            raise KeyError(f"verse {verse_id!r} is not in snapshot {self.version}") from None
+
+    def take(self, columns, indices):
+        """Row dicts with `columns` for the given ayah indices, in that order."""
+        if isinstance(columns, str):
+            columns = [c.strip() for c in columns.split(",") if c.strip()]
+        cols = [(c, self.column(c)) for c in columns]
+        return [{c: (int(col[i]) if c in self.ints else col[i]) for c, col in cols}
+                for i in indices]
+
+    def rows(self, columns, ids=None):
+        """Row dicts with `columns`, in mushaf order, optionally only `ids`."""
+        order = range(self.n) if ids is None else sorted(self.index_of(i) for i in ids)
+        return self.take(columns, order)
+
+    def verify(self):
+        """Names of files whose sha256 differs from the manifest."""
+        return [name for name, digest in self.manifest["files"].items()
+                if _sha256(os.path.join(self.path, name)) != digest]
+
+    def describe(self):
+        m = self.manifest
+        return (f"snapshot {self.version}: {self.n} verses, {m['embedding']['dims']} dims "
+                f"({self.n - m['embedding']['missing']} embedded), {len(m['columns'])} text columns, "
+                f"{m['bytes'] / 1_048_576:.1f} MB, exported {self.age / 3600:.1f} h ago")
+
+
+def scan_verses(columns, filters=(), snapshot=None, page_size=supabase_rest.PAGE_SIZE,
+                live_nulls=()):
+    """supabase_rest.scan_verses, but with row text taken from `snapshot`.
+
+    Filters depend on live state (e.g. tafsir_summary=is.null), so with
+    filters only the matching ids are fetched from PostgREST; with none the
+    database is not contacted at all. snapshot=None scans PostgREST as before.
+
+    Ids the snapshot lacks (verses added after the export) are skipped with a
+    warning. For each column in live_nulls (which must be among `columns`,
+    as must "id") the set of non-NULL ids is also fetched live; rows where it
+    disagrees with the snapshot — text seeded or cleared since the export —
+    are read from PostgREST instead.
+    """
+    if snapshot is None:
+        return list(supabase_rest.scan_verses(columns, filters, page_size=page_size))
+    ids = None
+    if filters:
+        ids = [r["id"] for r in supabase_rest.scan_verses("id", filters, page_size=page_size)]
+        missing = [i for i in ids if i not in snapshot]
+        if missing:
+            print(f"  ⚠ {len(missing)} verses are not in snapshot {snapshot.version} "
+                  f"— skipped; re-export the snapshot to include them")
+            ids = [i for i in ids if i in snapshot]
+    rows = snapshot.rows(columns, ids)
+
+    stale = set()
+    for column in live_nulls:
+        present = {r["id"] for r in supabase_rest.scan_verses(
+            "id", [*filters, f"{column}=not.is.null"], page_size=page_size)}
+        stale.update(r["id"] for r in rows if (r[column] is not None) != (r["id"] in present))
+    if not stale:
+        return rows
+
+    print(f"  ↻ {len(stale)} verses changed since snapshot {snapshot.version} — reading them live")
+    live    = {}
+    ordered = sorted(stale)
+    for start in range(0, len(ordered), LIVE_CHUNK):
+        chunk = ",".join(f'"{i}"' for i in ordered[start : start + LIVE_CHUNK])
+        in_ids = "id=in." + urllib.parse.quote(f"({chunk})", safe="(),:")
+        for r in supabase_rest.scan_verses(columns, [*filters, in_ids], page_size=page_size):
+            live[r["id"]] = r
+    # A stale row that no longer matches the filters is dropped
+    return [live[r["id"]] if r["id"] in live else r for r in rows
+            if r["id"] in live or r["id"] not in stale]
+
+# ── Export ────────────────────────────────────────────────────────────────────
+
+def _write_text_column(path, name, values, kind):
+    payload = [None if v is None else
+               (json.dumps(v, ensure_ascii=False) if kind == "json" else v).encode("utf-8")
+               for v in values]
+    idx    = np.zeros(len(payload) + 1, dtype=np.int64)
+    blocks = [0]
+    raw    = 0
+    with open(os.path.join(path, f"{name}.bin"), "wb") as f:
+        for start in range(0, len(payload), BLOCK_ROWS):
+            chunk = [p or b"" for p in payload[start : start + BLOCK_ROWS]]
+            for j, p in enumerate(chunk):
+                raw += len(p)
+                idx[start + j + 1] = raw
+            blocks.append(blocks[-1] + f.write(zlib.compress(b"".join(chunk), ZLIB_LEVEL)))
+    np.save(os.path.join(path, f"{name}.idx.npy"), idx)
+    np.save(os.path.join(path, f"{name}.blocks.npy"), np.asarray(blocks, dtype=np.int64))
+    nulls = sum(p is None for p in payload)
+    if nulls:
+        np.save(os.path.join(path, f"{name}.null.npy"),
+                np.asarray([p is None for p in payload], dtype=bool))
+    return {"kind": kind, "nulls": nulls, "raw_bytes": raw, "bytes": blocks[-1]}
+
+
+def write_snapshot(path, rows, embeddings, source=""):
+    """Write rows (mushaf order) + embeddings (list of vectors / None) to path."""
+    _require_numpy()
+    os.makedirs(path)
+    n    = len(rows)
+    dims = next((len(e) for e in embeddings if e is not None), 0)
+    matrix  = np.zeros((n, dims), dtype=np.float32)
+    missing = np.ones(n, dtype=bool)
+    for i, e in enumerate(embeddings):
+        if e is not None:
+            matrix[i]  = e
+            missing[i] = False
+    np.save(os.path.join(path, "embedding.npy"), matrix)
+    np.save(os.path.join(path, "embedding.null.npy"), missing)
+    for c in INT_COLUMNS:
+        np.save(os.path.join(path, f"{c}.npy"), np.asarray([r[c] for r in rows], dtype=np.int16))
+
+    columns = {}
+    for name, kind in [(c, "text") for c in TEXT_COLUMNS] + [(c, "json") for c in JSON_COLUMNS]:
+        if any(name in r for r in rows):
+            columns[name] = _write_text_column(path, name, [r.get(name) for r in rows], kind)
+
+    files   = {f: _sha256(os.path.join(path, f)) for f in sorted(os.listdir(path))}
+    created = time.time()
+    digest  = hashlib.sha256("".join(files.values()).encode()).hexdigest()[:12]
+    stamp   = datetime.fromtimestamp(created, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    manifest = {
+        "format":     FORMAT,
+        "version":    f"{stamp}-{digest}",
+        "created_at": created,
+        "source":     source,
+        "rows":       n,
+        "block_rows": BLOCK_ROWS,
+        "embedding":  {"dims": dims, "missing": int(missing.sum())},
+        "columns":    columns,
+        "bytes":      sum(os.path.getsize(os.path.join(path, f)) for f in files),
+        "files":      files,
+    }
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def export(root=None, keep=KEEP):
+    """Download quran_verses and write a new snapshot version. Returns its path."""
+    root    = root or root_dir()
+    os.makedirs(root, exist_ok=True)
+    columns = list(INT_COLUMNS) + list(TEXT_COLUMNS) + list(JSON_COLUMNS) + ["embedding"]
+    rows, embeddings = [], []
+    for r in supabase_rest.scan_verses(columns, page_size=EXPORT_PAGE):
+        e = r.pop("embedding", None)
+        embeddings.append(json.loads(e) if isinstance(e, str) else e)
+        rows.append(r)
+        if len(rows) % 1000 == 0:
+            print(f"  Fetched {len(rows)} verses so far …", flush=True)
+    print(f"  ✓ Fetched {len(rows)} verses")
+
+    tmp      = os.path.join(root, f".export-{os.getpid()}")
+    manifest = write_snapshot(tmp, rows, embeddings, source=supabase_rest.base_url())
+    path     = os.path.join(root, manifest["version"])
+    os.rename(tmp, path)
+    pointer  = os.path.join(root, "CURRENT")
+    with open(pointer + ".tmp", "w") as f:
+        f.write(manifest["version"] + "\n")
+    os.replace(pointer + ".tmp", pointer)
+
+    versions = sorted(d for d in os.listdir(root)
+                      if os.path.exists(os.path.join(root, d, "manifest.json")))
+    for old in versions[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(root, old))
+    return path
+
+# ── Main ──────────────────────────────────────────────────────────────────────
+
+def load_env():
+    path = os.path.join(os.path.dirname(__file__), "../.env")
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and "=" in line and not line.startswith("#"):
+                k, v = line.split("=", 1)
+                os.environ.setdefault(k.strip(), v.strip())
+
+
+def main():
+    load_env()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--info", action="store_true", help="describe the current snapshot")
+    parser.add_argument("--verify", action="store_true", help="check the current snapshot's checksums")
+    parser.add_argument("--keep", type=int, default=KEEP, help="snapshot versions to keep (0 = all)")
+    args = parser.parse_args()
+
+    if args.info or args.verify:
+        t0 = time.perf_counter()
+        try:
+            snap = Snapshot()
+        except FileNotFoundError as e:
+            print(f"  ✗ {e}")
+            return 1
+        print(f"  ✓ Opened in {(time.perf_counter() - t0) * 1000:.1f} ms — {snap.describe()}")
+        if args.verify:
+            bad = snap.verify()
+            print(f"  ✗ Checksum mismatch: {', '.join(bad)}" if bad else "  ✓ All checksums match")
+            return 1 if bad else 0
+        return 0
+
+    for k in ("SUPABASE_URL", "SUPABASE_SERVICE_KEY"):
+        if not os.environ.get(k):
+            print(f"ERROR: missing env var {k}")
+            return 1
+    print("\n── Exporting corpus snapshot ────────────────────────────────────────────")
+    t0   = time.perf_counter()
+    path = export(keep=args.keep)
+    print(f"  ✓ {Snapshot(path).describe()}")
+    print(f"  ✓ Wrote {path} in {time.perf_counter() - t0:.0f}s")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+embed_cache.py
+──────────────
+Content-addressed on-disk cache for OpenAI embeddings, shared by
+seed_quran.py, reembed.py and seed_ajarkan.py.
+
+Entries are keyed by (model, dimensions, sha256(input text)), so an
+unchanged build_embed_text() output never hits the embeddings API twice.
+
+Layout (one directory per model + dimensions):
+
+  scripts/.embed_cache/text-embedding-3-large-1536/
+    vectors.f32   — fixed-size slots, memory-mapped: the 32-byte sha256 of
+                    the text, then the float32 vector
+    index.json    — {sha256: [slot, last_used_tick]}
+    lock          — flock held by the process using the cache
+
+When the cache holds max_entries vectors, the least recently used slot is
+reused. A slot is only served when the sha256 stored in it matches, so an
+index saved before a crash never returns another text's vector. One
+process uses a cache directory at a time; a second concurrent run bypasses
+it. Set EMBED_CACHE_DIR to move the cache, EMBED_CACHE=off to bypass it.
+"""
+
+import hashlib, heapq, json, mmap, os, sys, threading
+from array import array
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_DIR         = os.path.join(os.path.dirname(__file__), ".embed_cache")
+DEFAULT_MAX_ENTRIES = 50_000   # ~300 MB at 1536 dims
+GROW_SLOTS          = 1024     # file grows in chunks of this many vectors
+FORMAT              = 2        # slot layout: key digest + vector
+KEY_BYTES           = 32
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Float32 vector store keyed by sha256 of the embedded text."""
+
+    def __init__(self, model, dims, root=None, max_entries=DEFAULT_MAX_ENTRIES):
+        root = root or os.environ.get("EMBED_CACHE_DIR") or DEFAULT_DIR
+        self.model       = model
+        self.dims        = dims
+        self.max_entries = max_entries
+        self.enabled     = os.environ.get("EMBED_CACHE", "on").lower() not in ("off", "0", "false")
+        self.dir         = os.path.join(root, f"{model}-{dims}")
+        self.index_path  = os.path.join(self.dir, "index.json")
+        self.data_path   = os.path.join(self.dir, "vectors.f32")
+        self.slot_bytes  = KEY_BYTES + dims * 4
+        self.lock        = threading.Lock()
+        self.hits        = 0
+        self.misses      = 0
+        self.index       = {}      # sha256 → [slot, last_used]
+        self.tick        = 0
+        self.capacity    = 0
+        self.free        = []      # unused slots, lowest last
+        self.file        = None
+        self.mm          = None
+        self.lock_file   = None
+        if self.enabled:
+            self._open()
+
+    # ── Storage ──────────────────────────────────────────────────────────────
+
+    def _open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        if not self._lock_dir():
+            print(f"  ⚠ {self.dir} is in use by another process — running without the embedding cache")
+            self.enabled = False
+            return
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if (meta.get("format") == FORMAT and meta.get("model") == self.model
+                    and meta.get("dims") == self.dims):
+                self.index = meta.get("entries", {})
+                self.tick  = meta.get("tick", 0)
+        self.file = open(self.data_path, "a+b")
+        size = os.path.getsize(self.data_path)
+        self.capacity = size // self.slot_bytes
+        # Drop index entries pointing past the end of a truncated data file
+        self.index = {k: v for k, v in self.index.items() if v[0] < self.capacity}
+        used = {v[0] for v in self.index.values()}
+        self.free = [i for i in range(self.capacity - 1, -1, -1) if i not in used]
+        if self.capacity:
+            self.mm = mmap.mmap(self.file.fileno(), self.capacity * self.slot_bytes)
+
+    def _lock_dir(self):
+        """Hold an exclusive flock on the directory until the process exits:
+        the free list is per process, so two writers would reuse each
+        other's slots."""
+        if fcntl is None:
+            return True
+        self.lock_file = open(os.path.join(self.dir, "lock"), "a")
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def _grow(self):
+        new_cap = min(self.max_entries, self.capacity + GROW_SLOTS)
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+        self.file.truncate(new_cap * self.slot_bytes)
+        self.free.extend(range(new_cap - 1, self.capacity - 1, -1))
+        self.capacity = new_cap
+        self.mm = mmap.mmap(self.file.fileno(), new_cap * self.slot_bytes)
+
+    def _evict(self, n):
+        """Release the n least recently used slots."""
+        for key in heapq.nsmallest(n, self.index, key=lambda k: self.index[k][1]):
+            self.free.append(self.index.pop(key)[0])
+
+    def _alloc_slot(self):
+        if not self.free:
+            if self.capacity < self.max_entries:
+                self._grow()
+            else:
+                self._evict(max(1, self.max_entries // 10))
+        return self.free.pop()
+
+    def _read(self, slot, key):
+        """Vector in slot, or None when the slot now holds another key."""
+        off = slot * self.slot_bytes
+        if self.mm[off : off + KEY_BYTES] != bytes.fromhex(key):
+            return None
+        vec = array("f")
+        vec.frombytes(self.mm[off + KEY_BYTES : off + self.slot_bytes])
+        if sys.byteorder != "little":
+            vec.byteswap()
+        return vec.tolist()
+
+    def _write(self, slot, key, vec):
+        buf = array("f", vec)
+        if sys.byteorder != "little":
+            buf.byteswap()
+        off = slot * self.slot_bytes
+        self.mm[off + KEY_BYTES : off + self.slot_bytes] = buf.tobytes()
+        self.mm[off : off + KEY_BYTES] = bytes.fromhex(key)
+
+    # ── Public API ───────────────────────────────────────────────────────────
+
+    def get(self, text):
+        """Return the cached vector for text, or None."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            key   = text_key(text)
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            vec = self._read(entry[0], key)
+            if vec is None:
+                # Slot reused after the index was saved
+                del self.index[key]
+                self.free.append(entry[0])
+                return None
+            self.tick += 1
+            entry[1] = self.tick
+            return vec
+
+    def put(self, text, vec):
+        if not self.enabled:
+            return
+        if len(vec) != self.dims:
+            raise ValueError(f"expected {self.dims} dims, got {len(vec)}")
+        with self.lock:
+            key   = text_key(text)
+            entry = self.index.get(key)
+            slot  = entry[0] if entry else self._alloc_slot()
+            self._write(slot, key, vec)
+            self.tick += 1
+            self.index[key] = [slot, self.tick]
+
+    def embed(self, texts, embed_fn, batch_size=100):
+        """Return vectors for texts, calling embed_fn(list_of_texts) only for misses.
+
+        Duplicate texts within one call are embedded once. The index is saved
+        after new vectors are stored, so a crashed run keeps what it paid for.
+        """
+        vecs    = [self.get(t) for t in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vecs) if v is None))
+        self.hits   += len(texts) - sum(1 for v in vecs if v is None)
+        self.misses += len(missing)
+        if not missing:
+            return vecs
+
+        fresh = {}
+        for start in range(0, len(missing), batch_size):
+            chunk = missing[start : start + batch_size]
+            for t, v in zip(chunk, embed_fn(chunk)):
+                fresh[t] = v
+                self.put(t, v)
+        self.save()
+        return [v if v is not None else fresh[t] for t, v in zip(texts, vecs)]
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.mm is not None:
+                self.mm.flush()
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"format": FORMAT, "model": self.model, "dims": self.dims,
+                           "tick": self.tick, "entries": self.index}, f)
+            os.replace(tmp, self.index_path)
+
+    def summary(self):
+        return f"embedding cache: {self.hits} hits, {self.misses} misses ({len(self.index)} stored)"
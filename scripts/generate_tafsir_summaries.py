@@ -8,18 +8,40 @@ using the OpenAI Batch API (gpt-4o-mini).
 Flow:
   1. Fetch verses WHERE tafsir_summary IS NULL from Supabase
   2. Build JSONL request file for OpenAI Batch API
-  3. Upload file, create batch, poll until complete
-  4. Download results, validate, update Supabase
+  3. Upload files and keep several batches in flight, up to the
+     enqueued-token quota; poll them together
+  4. As each batch completes: download results, validate, update Supabase
+     (update_tafsir_summary_batch RPC, migration 015 — UPDATE_BATCH rows per
+     call, WRITERS calls in parallel)
   5. Save request + result files to scripts/batch_output/ for debugging
 
+Submitted batches are recorded in the job ledger (openai_batch.py). If the
+process dies mid-poll, a re-run picks the unfinished batches back up and
+leaves their verses out of the new submissions.
+
+Verses are packed into batches by counted prompt tokens (system prompt +
+build_user_message), each up to --batch-tokens. Batches are submitted while
+the tokens of all unfinished batches fit in --quota, so the run takes about
+one batch turnaround per quota's worth of tokens instead of one per batch.
+
+Before packing, each tafsir source is capped to its token budget (SOURCES,
+--source-tokens). An Ibnu Katsir passage spanning several ayat is sent,
+capped, with every one of them: each request is summarised on its own.
+
 Run from the project root:
 
   python3 scripts/generate_tafsir_summaries.py
+  python3 scripts/generate_tafsir_summaries.py --batch-tokens 400000 --quota 1800000
+  python3 scripts/generate_tafsir_summaries.py --source-tokens tafsir_kemenag=2000
+  python3 scripts/generate_tafsir_summaries.py --snapshot   # text from corpus_snapshot.py
 
 Re-running is safe: only processes verses with tafsir_summary IS NULL.
 """
 
-import json, os, sys, time, urllib.request, urllib.error
+import argparse, json, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import corpus_snapshot, openai_batch, supabase_rest, token_count
 
 # ── Config ────────────────────────────────────────────────────────────────────
 
@@ -36,14 +58,32 @@ def load_env():
 
 load_env()
 
-SUPABASE_URL         = os.environ.get("SUPABASE_URL", "").rstrip("/")
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY", "")
-OPENAI_API_KEY       = os.environ.get("OPENAI_API_KEY", "")
-
 FETCH_BATCH    = 1000   # rows per Supabase REST fetch
-UPDATE_BATCH   = 100    # rows per Supabase PATCH cycle
-UPDATE_SLEEP   = 0.15   # seconds between PATCH batches
+UPDATE_BATCH   = 250    # summaries per update_tafsir_summary_batch call
+WRITERS        = 4      # parallel Supabase writers
+WRITE_AHEAD    = 2 * WRITERS   # groups queued for the writers before the download waits
 POLL_INTERVAL  = 60     # seconds between batch status polls
+SNAPSHOT_MAX_AGE = 7 * 86400   # --snapshot older than this gets a warning
+JOB            = "tafsir_summary"   # ledger job name
+
+SUMMARY_MODEL       = "gpt-4o-mini"
+# gpt-4o-mini's Batch API enqueued-token limit is 2M prompt tokens across all
+# unfinished batches; keep ~10% headroom for counting differences when
+# tiktoken isn't installed. Batches a third of the quota keep three in flight.
+ENQUEUED_TOKEN_QUOTA = 1_800_000
+BATCH_TOKEN_LIMIT    = 600_000
+BATCH_MAX_REQUESTS   = 50_000    # Batch API per-file request cap
+LIMIT_REJECTIONS     = 3         # solo token_limit_exceeded rejections before a chunk fails
+
+# Tafsir sources in the user message: column, heading, default token budget.
+# Ibnu Katsir and Kemenag often run to several thousand tokens per verse;
+# the summary only needs the opening of each.
+SOURCES = [
+    ("tafsir_kemenag",        "Tafsir Kemenag",                 1500),
+    ("tafsir_ibnu_kathir_id", "Tafsir Ibnu Katsir (Indonesia)", 1500),
+    ("tafsir_quraish_shihab", "Tafsir Quraish Shihab",          1000),
+    ("asbabun_nuzul_id",      "Asbabun Nuzul",                   600),
+]
 
 BATCH_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "batch_output")
 
@@ -218,272 +258,166 @@ def check_env():
         print(f"ERROR: missing env vars: {', '.join(missing)}")
         sys.exit(1)
 
-def supabase_get(path):
-    """GET request to Supabase REST API."""
-    url = f"{SUPABASE_URL}{path}"
-    req = urllib.request.Request(url, method="GET", headers={
-        "apikey":        SUPABASE_SERVICE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-    })
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        return json.loads(resp.read().decode())
-
-def supabase_patch(path, body):
-    """PATCH request to Supabase REST API."""
-    url = f"{SUPABASE_URL}{path}"
-    data = json.dumps(body).encode()
-    req = urllib.request.Request(url, data=data, method="PATCH", headers={
-        "Content-Type":  "application/json",
-        "apikey":        SUPABASE_SERVICE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-        "Prefer":        "return=minimal",
-    })
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            resp.read()
-    except urllib.error.HTTPError as e:
-        raise RuntimeError(f"HTTP {e.code}: {e.read().decode()[:200]}")
-
-def openai_request(method, path, body=None, file_upload=None):
-    """Make a request to the OpenAI API. Returns parsed JSON for JSON responses, raw bytes otherwise."""
-    url = f"https://api.openai.com{path}"
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-
-    if file_upload:
-        # multipart/form-data upload
-        boundary = "----BatchUploadBoundary"
-        parts = []
-        for key, val in file_upload.items():
-            if key == "file":
-                filename, filedata = val
-                parts.append(
-                    f"--{boundary}\r\n"
-                    f"Content-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
-                    f"Content-Type: application/jsonl\r\n\r\n".encode() + filedata + b"\r\n"
-                )
-            else:
-                parts.append(
-                    f"--{boundary}\r\n"
-                    f"Content-Disposition: form-data; name=\"{key}\"\r\n\r\n"
-                    f"{val}\r\n".encode()
-                )
-        data = b"".join(p if isinstance(p, bytes) else p.encode() for p in parts) + f"--{boundary}--\r\n".encode()
-        headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
-    elif body is not None:
-        data = json.dumps(body).encode()
-        headers["Content-Type"] = "application/json"
-    else:
-        data = None
-
-    req = urllib.request.Request(url, data=data, method=method, headers=headers)
-    # Use longer timeout for file uploads (102MB JSONL)
-    req_timeout = 600 if file_upload else 120
-    try:
-        with urllib.request.urlopen(req, timeout=req_timeout) as resp:
-            raw = resp.read()
-            content_type = resp.headers.get("Content-Type", "")
-            if "application/json" in content_type:
-                return json.loads(raw.decode())
-            return raw
-    except urllib.error.HTTPError as e:
-        raise RuntimeError(f"OpenAI HTTP {e.code}: {e.read().decode()[:500]}")
-
 def ensure_output_dir():
     os.makedirs(BATCH_OUTPUT_DIR, exist_ok=True)
 
 # ── Phase 1: Fetch verses from Supabase ──────────────────────────────────────
 
-def fetch_verses():
-    """Fetch all verses where tafsir_summary IS NULL, paginated."""
+def fetch_verses(snapshot=None):
+    """Stream all verses where tafsir_summary IS NULL (keyset-paginated).
+    With a corpus snapshot the ids, and which sources are NULL, are fetched
+    live; text comes from disk, except for verses whose sources were seeded
+    or cleared since the export."""
     columns = "id,surah_number,surah_name,verse_number,arabic,translation,tafsir_kemenag,tafsir_ibnu_kathir_id,tafsir_quraish_shihab,asbabun_nuzul_id"
     all_verses = []
-    offset = 0
 
     print("\n── Phase 1: Fetching verses (tafsir_summary IS NULL) ──────────────────")
-
-    while True:
-        path = (
-            f"/rest/v1/quran_verses"
-            f"?select={columns}"
-            f"&tafsir_summary=is.null"
-            f"&order=id"
-            f"&offset={offset}"
-            f"&limit={FETCH_BATCH}"
-        )
-        batch = supabase_get(path)
-        if not batch:
-            break
-        all_verses.extend(batch)
-        print(f"  Fetched {len(all_verses)} verses so far …", flush=True)
-        if len(batch) < FETCH_BATCH:
-            break
-        offset += FETCH_BATCH
+    if snapshot:
+        if snapshot.age > SNAPSHOT_MAX_AGE:
+            print(f"  ⚠ Snapshot {snapshot.version} was exported {snapshot.age / 86400:.0f} days ago — "
+                  f"sources edited since then are summarised from the old text; re-export it first")
+        all_verses = corpus_snapshot.scan_verses(
+            columns, ["tafsir_summary=is.null"], snapshot, page_size=FETCH_BATCH,
+            live_nulls=[column for column, _, _ in SOURCES])
+        print(f"  ✓ Total verses to process: {len(all_verses)} (text from snapshot {snapshot.version})\n")
+        return all_verses
+
+    for v in supabase_rest.scan_verses(columns, ["tafsir_summary=is.null"], page_size=FETCH_BATCH):
+        all_verses.append(v)
+        if len(all_verses) % FETCH_BATCH == 0:
+            print(f"  Fetched {len(all_verses)} verses so far …", flush=True)
 
     print(f"  ✓ Total verses to process: {len(all_verses)}\n")
     return all_verses
 
 # ── Phase 2: Build JSONL file ────────────────────────────────────────────────
 
+def budget_sources(verses, budgets):
+    """Cap each tafsir source to its token budget.
+
+    Every verse keeps its own (capped) copy of each source, including an
+    Ibnu Katsir passage shared with its neighbours: each Batch request is
+    summarised on its own, so a verse cannot be pointed at another's text.
+    Returns new verse dicts (the input is not modified) plus
+    {"truncated": n} for the report.
+    """
+    stats  = {"truncated": 0}
+    capped = {}   # (column, text) → capped text; shared passages are cut once
+    out    = []
+    for v in verses:
+        v = dict(v)
+        for column, _, _ in SOURCES:
+            text = v.get(column)
+            if not text:
+                continue
+            key = (column, text)
+            if key not in capped:
+                capped[key] = token_count.truncate(text, budgets[column], SUMMARY_MODEL)
+            if capped[key] is not text:
+                v[column] = capped[key]
+                stats["truncated"] += 1
+        out.append(v)
+    return out, stats
+
 def build_user_message(v):
     """Build the user message for a single verse."""
-    return (
-        f"Surat: {v['surah_name']} ({v['surah_number']}), Ayat: {v['verse_number']}\n"
-        f"\n"
-        f"Teks Arab:\n"
-        f"{v['arabic']}\n"
-        f"\n"
-        f"Terjemahan Indonesia:\n"
-        f"{v['translation']}\n"
-        f"\n"
-        f"Tafsir Kemenag:\n"
-        f"{v['tafsir_kemenag'] or '(tidak tersedia)'}\n"
-        f"\n"
-        f"Tafsir Ibnu Katsir (Indonesia):\n"
-        f"{v['tafsir_ibnu_kathir_id'] or '(tidak tersedia)'}\n"
-        f"\n"
-        f"Tafsir Quraish Shihab:\n"
-        f"{v['tafsir_quraish_shihab'] or '(tidak tersedia)'}\n"
-        f"\n"
-        f"Asbabun Nuzul:\n"
-        f"{v['asbabun_nuzul_id'] or '(tidak tersedia)'}"
+    parts = [
+        f"Surat: {v['surah_name']} ({v['surah_number']}), Ayat: {v['verse_number']}",
+        f"Teks Arab:\n{v['arabic']}",
+        f"Terjemahan Indonesia:\n{v['translation']}",
+    ]
+    parts += [f"{heading}:\n{v[column] or '(tidak tersedia)'}" for column, heading, _ in SOURCES]
+    return "\n\n".join(parts)
+
+def build_request(v):
+    # SYSTEM_PROMPT (~2k tokens) is the shared, cache-eligible prefix; all
+    # verse-specific text is in the user message after it
+    return openai_batch.chat_request(
+        v["id"], SUMMARY_MODEL, SYSTEM_PROMPT, build_user_message(v),
+        cache_key=openai_batch.prompt_cache_key(JOB, SYSTEM_PROMPT),
+        response_format={"type": "json_object"},
+        temperature=0.3,
+        max_tokens=600,
     )
 
 def build_jsonl(verses):
-    """Build JSONL content for OpenAI Batch API and save to file."""
+    """Stream the JSONL request file for OpenAI Batch API to disk."""
     print("── Phase 2: Building JSONL request file ────────────────────────────────")
 
-    lines = []
-    for v in verses:
-        request_obj = {
-            "custom_id": v["id"],
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": "gpt-4o-mini",
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": build_user_message(v)},
-                ],
-                "response_format": {"type": "json_object"},
-                "temperature": 0.3,
-                "max_tokens": 600,
-            },
-        }
-        lines.append(json.dumps(request_obj, ensure_ascii=False))
-
-    jsonl_content = "\n".join(lines)
-
     ensure_output_dir()
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     jsonl_path = os.path.join(BATCH_OUTPUT_DIR, f"batch_request_{timestamp}.jsonl")
-    with open(jsonl_path, "w", encoding="utf-8") as f:
-        f.write(jsonl_content)
+    n, size = openai_batch.write_jsonl(jsonl_path, (build_request(v) for v in verses))
 
-    print(f"  ✓ Built {len(lines)} requests → {jsonl_path}\n")
-    return jsonl_content.encode("utf-8"), jsonl_path, timestamp
+    print(f"  ✓ Built {n} requests ({size / 1_048_576:.1f} MB) → {jsonl_path}\n")
+    return jsonl_path, timestamp
 
 # ── Phase 3: Upload, create batch, poll ──────────────────────────────────────
 
-def upload_and_run_batch(jsonl_bytes):
-    """Upload JSONL file, create batch, poll until done. Returns result file ID."""
-    print("── Phase 3: OpenAI Batch API ───────────────────────────────────────────")
+def submit_batch(ledger, jsonl_path, verses, meta):
+    """Upload a JSONL file, create a batch and record it in the ledger."""
+    return openai_batch.submit(ledger, JOB, jsonl_path, [v["id"] for v in verses], meta)
 
-    # Upload file
-    print("  Uploading JSONL file …", end=" ", flush=True)
-    upload_resp = openai_request("POST", "/v1/files", file_upload={
-        "purpose": "batch",
-        "file": ("batch_request.jsonl", jsonl_bytes),
-    })
-    file_id = upload_resp["id"]
-    print(f"✓ file_id={file_id}")
-
-    # Create batch
-    print("  Creating batch …", end=" ", flush=True)
-    batch_resp = openai_request("POST", "/v1/batches", body={
-        "input_file_id": file_id,
-        "endpoint": "/v1/chat/completions",
-        "completion_window": "24h",
-    })
-    batch_id = batch_resp["id"]
-    print(f"✓ batch_id={batch_id}")
-
-    # Poll for completion
-    print(f"  Polling every {POLL_INTERVAL}s …")
-    while True:
-        status_resp = openai_request("GET", f"/v1/batches/{batch_id}")
-        status = status_resp["status"]
-        completed = status_resp.get("request_counts", {}).get("completed", 0)
-        total = status_resp.get("request_counts", {}).get("total", 0)
-        failed = status_resp.get("request_counts", {}).get("failed", 0)
-
-        print(f"    status={status}  completed={completed}/{total}  failed={failed}", flush=True)
-
-        if status == "completed":
-            output_file_id = status_resp.get("output_file_id")
-            error_file_id = status_resp.get("error_file_id")
-            print(f"  ✓ Batch completed! output_file_id={output_file_id}")
-            if error_file_id:
-                print(f"    error_file_id={error_file_id}")
-            return output_file_id, error_file_id
-        elif status in ("failed", "expired", "cancelled", "cancelling"):
-            raise RuntimeError(f"Batch {batch_id} ended with status: {status}")
+def poll_batch(ledger, batch_id):
+    """One status check, recorded in the ledger. Returns the batch object."""
+    status_resp = openai_batch.retrieve(batch_id)
+    ledger.update(status_resp)
+    return status_resp
 
-        time.sleep(POLL_INTERVAL)
+def batch_hit_token_limit(status_resp):
+    """True if the batch was rejected for exceeding the enqueued-token limit."""
+    errors = (status_resp.get("errors") or {}).get("data") or []
+    return any(e.get("code") == "token_limit_exceeded" for e in errors)
 
 # ── Phase 4: Download and parse results ──────────────────────────────────────
 
-def download_results(output_file_id, error_file_id, timestamp):
-    """Download batch results and optionally error file. Returns list of (custom_id, parsed_json_or_None, error_msg)."""
-    print("\n── Phase 4: Downloading results ────────────────────────────────────────")
+def parse_result(obj):
+    """One output line → (custom_id, parsed_json_or_None, error_msg)."""
+    custom_id = obj["custom_id"]
+    response = obj.get("response") or {}
+    status_code = response.get("status_code")
+    error_msg = None
+    parsed = None
+
+    if status_code == 200:
+        try:
+            body = response["body"]
+            content = body["choices"][0]["message"]["content"]
+            parsed = json.loads(content)
+        except (KeyError, IndexError, json.JSONDecodeError) as e:
+            error_msg = f"Parse error: {e}"
+    else:
+        error_body = response.get("body", {}) or obj.get("error")
+        error_msg = f"HTTP {status_code}: {json.dumps(error_body)[:200]}"
+
+    return custom_id, parsed, error_msg
+
+def download_results(output_file_id, error_file_id, timestamp, usage=None):
+    """Stream batch results, yielding (custom_id, parsed_json_or_None, error_msg) per line.
+
+    The output file is parsed as it downloads (and copied to batch_output/),
+    so the caller can start writing to Supabase immediately. Error-file lines
+    come last. Token usage of each line is added to `usage` if given.
+    """
+    print("\n── Phase 4: Streaming results ──────────────────────────────────────────")
     ensure_output_dir()
 
-    # Download output file
-    print("  Downloading output file …", end=" ", flush=True)
-    raw = openai_request("GET", f"/v1/files/{output_file_id}/content")
     output_path = os.path.join(BATCH_OUTPUT_DIR, f"batch_result_{timestamp}.jsonl")
-    with open(output_path, "wb") as f:
-        f.write(raw)
-    print(f"✓ → {output_path}")
+    print(f"  Output file → {output_path}")
+    if output_file_id:
+        for obj in openai_batch.stream_results(output_file_id, output_path):
+            if usage:
+                usage.add(obj)
+            yield parse_result(obj)
 
-    # Download error file if present
     if error_file_id:
-        print("  Downloading error file …", end=" ", flush=True)
+        err_path = os.path.join(BATCH_OUTPUT_DIR, f"batch_errors_{timestamp}.jsonl")
+        print(f"  Error file  → {err_path}")
         try:
-            err_raw = openai_request("GET", f"/v1/files/{error_file_id}/content")
-            err_path = os.path.join(BATCH_OUTPUT_DIR, f"batch_errors_{timestamp}.jsonl")
-            with open(err_path, "wb") as f:
-                f.write(err_raw)
-            print(f"✓ → {err_path}")
+            for obj in openai_batch.stream_results(error_file_id, err_path):
+                yield parse_result(obj)
         except Exception as e:
-            print(f"✗ {e}")
-
-    # Parse results
-    results = []
-    for line in raw.decode("utf-8").strip().split("\n"):
-        if not line.strip():
-            continue
-        obj = json.loads(line)
-        custom_id = obj["custom_id"]
-        response = obj.get("response", {})
-        status_code = response.get("status_code")
-        error_msg = None
-        parsed = None
-
-        if status_code == 200:
-            try:
-                body = response["body"]
-                content = body["choices"][0]["message"]["content"]
-                parsed = json.loads(content)
-            except (KeyError, IndexError, json.JSONDecodeError) as e:
-                error_msg = f"Parse error: {e}"
-        else:
-            error_body = response.get("body", {})
-            error_msg = f"HTTP {status_code}: {json.dumps(error_body)[:200]}"
-
-        results.append((custom_id, parsed, error_msg))
-
-    print(f"  ✓ Parsed {len(results)} results\n")
-    return results
+            print(f"  ✗ Error file download failed: {e}")
 
 # ── Phase 5: Validate results ────────────────────────────────────────────────
 
@@ -536,67 +470,89 @@ def validate_result(custom_id, data):
 
 # ── Phase 6: Update Supabase ─────────────────────────────────────────────────
 
-def update_supabase(valid_results):
-    """Batch-update tafsir_summary in Supabase."""
-    print("── Phase 6: Updating Supabase ──────────────────────────────────────────")
-
-    total = len(valid_results)
-    updated = 0
-    failed = 0
-
-    for start in range(0, total, UPDATE_BATCH):
-        batch = valid_results[start : start + UPDATE_BATCH]
-        end = min(start + UPDATE_BATCH, total)
-        print(f"  Updating {start+1}–{end}/{total} …", end=" ", flush=True)
-
-        batch_failed = 0
-        for verse_id, summary_data in batch:
-            try:
-                path = f"/rest/v1/quran_verses?id=eq.{verse_id}"
-                supabase_patch(path, {"tafsir_summary": summary_data})
-            except Exception as e:
-                batch_failed += 1
-                print(f"\n    ✗ {verse_id}: {e}", end="", flush=True)
+def write_summaries(group):
+    """One update_tafsir_summary_batch call for [(verse_id, summary)].
 
-        batch_ok = len(batch) - batch_failed
-        updated += batch_ok
-        failed += batch_failed
-        if batch_failed == 0:
-            print("✓")
-        else:
-            print(f" ({batch_failed} failed)")
-
-        time.sleep(UPDATE_SLEEP)
-
-    print(f"  ✓ Updated {updated} rows  ({failed} failed)\n")
-    return updated, failed
+    Returns [(verse_id, error)] for rows that did not land. If the call
+    itself fails (timeout, payload too large, 5xx) the group is split in
+    half and each half retried, down to single rows, so only the rows that
+    really can't be written are reported.
+    """
+    updates = [{"id": verse_id, "summary": summary} for verse_id, summary in group]
+    try:
+        rows = supabase_rest.rpc("update_tafsir_summary_batch", {"updates": updates}, timeout=120)
+        return [(r["id"], r["error"]) for r in rows or []]
+    except Exception as e:
+        if len(group) == 1:
+            return [(group[0][0], str(e))]
+        mid = len(group) // 2
+        return write_summaries(group[:mid]) + write_summaries(group[mid:])
+
+def update_supabase(group):
+    """Write one group of (verse_id, summary) to Supabase. Returns (updated, failed)."""
+    errors = write_summaries(group)
+    for verse_id, error in errors:
+        print(f"    ✗ {verse_id}: {error}", flush=True)
+    return len(group) - len(errors), len(errors)
+
+# ── Token-aware packing ──────────────────────────────────────────────────────
+
+def request_tokens(v, system_tokens):
+    """Prompt tokens of one verse's request, reusing the system prompt count."""
+    return (token_count.REPLY_PRIMING + 2 * token_count.MESSAGE_OVERHEAD + system_tokens
+            + token_count.count(build_user_message(v), SUMMARY_MODEL))
+
+def pack_batches(verses, token_limit=BATCH_TOKEN_LIMIT, max_requests=BATCH_MAX_REQUESTS):
+    """Split verses into batches whose prompt tokens stay ≤ token_limit.
+
+    Greedy, in mushaf order: a batch is closed when the next verse would
+    overflow it. Returns [(verses, tokens), ...].
+    """
+    system_tokens = token_count.count(SYSTEM_PROMPT, SUMMARY_MODEL)
+    batches, current, used = [], [], 0
+    for v in verses:
+        n = request_tokens(v, system_tokens)
+        if current and (used + n > token_limit or len(current) >= max_requests):
+            batches.append((current, used))
+            current, used = [], 0
+        current.append(v)
+        used += n
+    if current:
+        batches.append((current, used))
+    return batches
 
 # ── Main ─────────────────────────────────────────────────────────────────────
 
-# OpenAI gpt-4o-mini batch enqueued token limit is 2M.
-# Each verse request is ~3-5k tokens (tafsir content), so ~350 verses per chunk.
-CHUNK_SIZE = 350
-
-def process_chunk(chunk_verses, chunk_num, total_chunks):
-    """Process a single chunk of verses through the batch pipeline."""
+def apply_batch(chunk_num, total_chunks, status_resp, timestamp, run_usage=None):
+    """Download, validate and store one completed batch. Returns (ok, failed)."""
     print(f"\n{'='*72}")
-    print(f"  CHUNK {chunk_num}/{total_chunks}  ({len(chunk_verses)} verses)")
+    print(f"  CHUNK {chunk_num}/{total_chunks} completed  (batch_id={status_resp['id']})")
     print(f"{'='*72}")
 
-    # Build JSONL for this chunk
-    jsonl_bytes, jsonl_path, timestamp = build_jsonl(chunk_verses)
-
-    # Upload & run batch
-    output_file_id, error_file_id = upload_and_run_batch(jsonl_bytes)
-
-    # Download results
-    results = download_results(output_file_id, error_file_id, timestamp)
-
-    # Validate
-    print("── Validating results ──────────────────────────────────────────────────")
-    valid_results = []
+    # Validate each line as it streams in and hand every UPDATE_BATCH valid
+    # rows to the writer pool straight away, so large outputs land while
+    # still downloading
+    usage = openai_batch.UsageTally()
+    results = download_results(status_resp.get("output_file_id"),
+                               status_resp.get("error_file_id"), timestamp, usage)
+    print("── Validating + updating Supabase ─────────────────────────────────────")
+    group = []
+    valid_count = 0
     invalid_count = 0
     warn_count = 0
+    updated = 0
+    update_failed = 0
+    writer  = ThreadPoolExecutor(max_workers=WRITERS)
+    writes  = []
+    # At most WRITE_AHEAD groups wait for a writer; beyond that the download
+    # pauses, so a fast stream never piles the whole result set up in memory
+    slots   = threading.BoundedSemaphore(WRITE_AHEAD)
+
+    def submit(group):
+        slots.acquire()
+        future = writer.submit(update_supabase, group)
+        future.add_done_callback(lambda _: slots.release())
+        writes.append(future)
 
     for custom_id, parsed, error_msg in results:
         if error_msg:
@@ -615,50 +571,201 @@ def process_chunk(chunk_verses, chunk_num, total_chunks):
             for w in warnings:
                 print(f"  ⚠ {custom_id}: {w}")
 
-        valid_results.append((custom_id, parsed))
+        valid_count += 1
+        group.append((custom_id, parsed))
+        if len(group) >= UPDATE_BATCH:
+            submit(group)
+            group = []
+
+    if group:
+        submit(group)
+    writer.shutdown(wait=True)
+    for w in writes:
+        ok, fail = w.result()
+        updated += ok
+        update_failed += fail
+
+    print(f"  ✓ Valid: {valid_count}  Invalid: {invalid_count}  Warnings: {warn_count}")
+    print(f"  ✓ Updated {updated} rows  ({update_failed} failed)")
+    print(f"  {usage.summary()}\n")
+    if run_usage:
+        run_usage.merge(usage)
+
+    return updated, invalid_count + update_failed
+
+
+
+def run_batches(chunks, ledger, quota=ENQUEUED_TOKEN_QUOTA, resumed=(), usage=None):
+    """Keep batches in flight while their tokens fit in `quota`; apply each on completion.
+
+    chunks is [(verses, tokens), ...] from pack_batches; resumed is the
+    ledger's outstanding batches from an earlier run, which are polled
+    alongside the new ones. Token usage is merged into `usage`. A batch
+    rejected with token_limit_exceeded is re-queued and nothing new is
+    submitted until another batch finishes; rejected with nothing else in
+    flight it is too big on its own and is split in half, and fails after
+    LIMIT_REJECTIONS such rejections. A batch whose results cannot be applied is
+    left unapplied in the ledger, so the next run resumes it.
+    Returns (ok, failed) totals.
+    """
+    print("── Phase 3: OpenAI Batch API ───────────────────────────────────────────")
+    total_chunks = len(chunks) + len(resumed)
+    pending   = [(n, verses, tokens, 0)
+                 for n, (verses, tokens) in enumerate(chunks, len(resumed) + 1)]
+    in_flight = {}      # batch_id → {chunk, verses, count, tokens, timestamp, rejections}
+    enqueued  = 0
+    blocked   = False   # set after a token_limit_exceeded rejection
+    total_ok = total_fail = 0
+
+    for n, job in enumerate(resumed, 1):
+        meta = job["meta"] or {}
+        print(f"  ↻ Resuming batch {job['batch_id']} ({len(job['custom_ids'])} verses) as chunk {n}")
+        in_flight[job["batch_id"]] = {
+            "chunk": n, "verses": None, "count": len(job["custom_ids"]),
+            "tokens": meta.get("tokens", 0),
+            "timestamp": meta.get("timestamp") or time.strftime("%Y%m%d_%H%M%S"),
+            "rejections": 0,
+        }
+        enqueued += meta.get("tokens", 0)
 
-    print(f"  ✓ Valid: {len(valid_results)}  Invalid: {invalid_count}  Warnings: {warn_count}\n")
+    while pending or in_flight:
+        while pending and not blocked and (not in_flight or enqueued + pending[0][2] <= quota):
+            n, verses, tokens, rejections = pending.pop(0)
+            print(f"\n  CHUNK {n}/{total_chunks}  ({len(verses)} verses, ~{tokens:,} tokens)")
+            jsonl_path, timestamp = build_jsonl(verses)
+            try:
+                batch_id = submit_batch(ledger, jsonl_path, verses,
+                                        {"tokens": tokens, "timestamp": timestamp})
+            except Exception as e:
+                print(f"  ✗ Chunk {n}: submit failed — {e}")
+                total_fail += len(verses)
+                continue
+            in_flight[batch_id] = {"chunk": n, "verses": verses, "count": len(verses),
+                                   "tokens": tokens, "timestamp": timestamp,
+                                   "rejections": rejections}
+            enqueued += tokens
+
+        if not in_flight:
+            break
+        print(f"  {len(in_flight)} batch(es) in flight (~{enqueued:,} tokens enqueued), "
+              f"{len(pending)} queued — polling every {POLL_INTERVAL}s …", flush=True)
+        time.sleep(POLL_INTERVAL)
 
-    # Update Supabase
-    updated, update_failed = 0, 0
-    if valid_results:
-        updated, update_failed = update_supabase(valid_results)
-    else:
-        print("  No valid results to update.\n")
+        for batch_id in list(in_flight):
+            job = in_flight[batch_id]
+            n   = job["chunk"]
+            try:
+                status_resp = poll_batch(ledger, batch_id)
+            except Exception as e:
+                print(f"    chunk {n}: poll failed — {e}")
+                continue
+            status = status_resp["status"]
+            print(f"    chunk {n}: {openai_batch.describe(status_resp)}", flush=True)
+
+            if status not in openai_batch.TERMINAL:
+                continue
+            del in_flight[batch_id]
+            enqueued -= job["tokens"]
+            blocked   = False
+            if status == "completed":
+                try:
+                    ok, fail = apply_batch(n, total_chunks, status_resp, job["timestamp"], usage)
+                except Exception as e:
+                    print(f"  ✗ Chunk {n}: applying results failed — {e} "
+                          f"(batch {batch_id} stays in the ledger; re-run to retry)")
+                    total_fail += job["count"]
+                    continue
+                ledger.mark_applied(batch_id)
+                total_ok += ok
+                total_fail += fail
+            elif status == "failed" and job["verses"] and batch_hit_token_limit(status_resp):
+                rejections = job["rejections"]
+                if in_flight:
+                    print(f"  ⚠ Chunk {n} exceeded the enqueued-token limit — re-queued")
+                    pending.insert(0, (n, job["verses"], job["tokens"], rejections))
+                    blocked = True
+                elif rejections + 1 >= LIMIT_REJECTIONS:
+                    print(f"  ✗ Chunk {n}: over the enqueued-token limit even on its own "
+                          f"({rejections + 1}×) — giving up")
+                    total_fail += job["count"]
+                else:
+                    # Nothing else is enqueued, so the chunk alone is over the limit
+                    rejections += 1
+                    halves = pack_batches(job["verses"], max(1, job["tokens"] // 2))
+                    print(f"  ⚠ Chunk {n} alone exceeds the enqueued-token limit — "
+                          f"split into {len(halves)} smaller batches")
+                    pending[:0] = [(n, verses, tokens, rejections) for verses, tokens in halves]
+            else:
+                print(f"  ✗ Chunk {n}: batch {batch_id} ended with status: {status}")
+                total_fail += job["count"]
 
-    return len(valid_results), invalid_count + update_failed
+    return total_ok, total_fail
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-tokens", type=int, default=BATCH_TOKEN_LIMIT,
+                        help=f"prompt tokens per batch (default {BATCH_TOKEN_LIMIT:,})")
+    parser.add_argument("--quota", type=int, default=ENQUEUED_TOKEN_QUOTA,
+                        help=f"enqueued prompt tokens across in-flight batches "
+                             f"(default {ENQUEUED_TOKEN_QUOTA:,})")
+    parser.add_argument("--source-tokens", action="append", default=[], metavar="COLUMN=N",
+                        help="token budget for one tafsir source, e.g. tafsir_kemenag=2000 "
+                             "(repeatable; defaults: " +
+                             ", ".join(f"{c}={n}" for c, _, n in SOURCES) + ")")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="read verse text from the corpus snapshot (corpus_snapshot.py)")
+    args = parser.parse_args()
+
+    budgets = {column: n for column, _, n in SOURCES}
+    for spec in args.source_tokens:
+        column, _, n = spec.partition("=")
+        if column not in budgets or not n.isdigit():
+            parser.error(f"--source-tokens expects COLUMN=N with COLUMN one of "
+                         f"{', '.join(budgets)}, got {spec!r}")
+        budgets[column] = int(n)
+
     check_env()
 
+    # Batches still running from an interrupted run
+    ledger    = openai_batch.Ledger()
+    resumed   = ledger.outstanding(JOB)
+    in_ledger = {cid for job in resumed for cid in job["custom_ids"]} | ledger.unsubmitted_ids(JOB)
+
     # Phase 1: Fetch
-    verses = fetch_verses()
-    if not verses:
+    snapshot = corpus_snapshot.Snapshot() if args.snapshot else None
+    verses = [v for v in fetch_verses(snapshot) if v["id"] not in in_ledger]
+    if in_ledger:
+        print(f"  ↻ {len(resumed)} unfinished batch(es) from an earlier run cover "
+              f"{len(in_ledger)} verses — resuming those instead of re-submitting")
+    if not verses and not resumed:
         print("  Nothing to process — all verses already have tafsir_summary.")
         print("── Done ─────────────────────────────────────────────────────────────────")
         return
 
-    # Split into chunks to stay under 2M enqueued token limit
-    chunks = [verses[i:i + CHUNK_SIZE] for i in range(0, len(verses), CHUNK_SIZE)]
+    # Cap sources, then pack into chunks that stay
+    # under the enqueued-token limit
+    verses, trimmed = budget_sources(verses, budgets)
+    print(f"  Source budgets: {trimmed['truncated']} texts truncated")
+    chunks = pack_batches(verses, args.batch_tokens)
     total_chunks = len(chunks)
-    print(f"\n  Splitting {len(verses)} verses into {total_chunks} chunks of ≤{CHUNK_SIZE}")
-
-    total_ok = 0
-    total_fail = 0
+    total_tokens = sum(t for _, t in chunks)
+    print(f"\n  Packed {len(verses)} verses (~{total_tokens:,} prompt tokens, "
+          f"counted with {token_count.backend()}) into {total_chunks} chunks "
+          f"of ≤{args.batch_tokens:,} tokens")
 
-    for i, chunk in enumerate(chunks, 1):
-        ok, fail = process_chunk(chunk, i, total_chunks)
-        total_ok += ok
-        total_fail += fail
+    usage = openai_batch.UsageTally()
+    total_ok, total_fail = run_batches(chunks, ledger, args.quota, resumed, usage)
 
     # Final report
     print(f"\n{'='*72}")
     print("── FINAL REPORT ────────────────────────────────────────────────────────")
     print(f"  Total fetched:       {len(verses)}")
-    print(f"  Chunks processed:    {total_chunks}")
+    print(f"  Chunks processed:    {total_chunks + len(resumed)}")
     print(f"  Updated in DB:       {total_ok}")
     print(f"  Failed (total):      {total_fail}")
+    print(f"  Prompt tokens:       {usage.prompt:,} ({usage.cached:,} served from prompt cache, "
+          f"{usage.cached / usage.prompt if usage.prompt else 0:.0%})")
     print(f"  Results dir:         {BATCH_OUTPUT_DIR}")
     print("── Done ─────────────────────────────────────────────────────────────────")
 
@@ -0,0 +1,191 @@
+"""
+http_cache.py
+─────────────
+On-disk mirror of upstream GET responses for the seed scripts
+(alquran.cloud, equran.id, quran.com, raw.githubusercontent.com).
+
+  fetch(url, headers=None, timeout=30)      → response body (bytes)
+  fetch_json(url, headers=None, timeout=30, validate=None) → parsed JSON;
+      a body that fails validate(data) is evicted, so a retry refetches it
+      (code_ok validates APIs that report errors in a 200 body)
+  cached(url) — True if fetch(url) would be served without touching the
+                network, so callers can skip their politeness delays
+
+Non-2xx responses raise urllib.error.HTTPError exactly as urlopen would,
+so callers keep their existing error handling. 404/410 are cached too
+(negative caching), so known-missing files aren't re-requested each run.
+
+Modes (HTTP_CACHE env var):
+  revalidate (default) — entries younger than HTTP_CACHE_MAX_AGE seconds
+      (default 1 day) are served from disk; older ones are revalidated with
+      If-None-Match / If-Modified-Since and a 304 just refreshes them
+  offline — replay recorded responses only; a miss raises CacheMiss
+  off     — bypass the cache entirely
+
+Layout: scripts/.http_cache/ab/<sha256(url)>.{json,body} — metadata
+(status, ETag, Last-Modified, stored_at) next to the raw body. Set
+HTTP_CACHE_DIR to move it.
+"""
+
+import email.message, hashlib, json, os, threading, time, urllib.error, urllib.request
+from io import BytesIO
+
+import http_client
+
+DEFAULT_DIR     = os.path.join(os.path.dirname(__file__), ".http_cache")
+DEFAULT_MAX_AGE = 86_400          # seconds before an entry is revalidated
+NEGATIVE        = (404, 410)      # error statuses worth caching
+MODES           = ("revalidate", "offline", "off")
+
+stats = {"fresh": 0, "revalidated": 0, "fetched": 0, "bytes": 0}
+_lock = threading.Lock()
+
+
+class CacheMiss(urllib.error.URLError):
+    """Raised in offline mode when a URL has no recorded response."""
+
+
+# ── Settings ──────────────────────────────────────────────────────────────────
+
+def mode():
+    m = os.environ.get("HTTP_CACHE", "revalidate").lower()
+    if m not in MODES:
+        raise ValueError(f"HTTP_CACHE must be one of {', '.join(MODES)}, got {m!r}")
+    return m
+
+def max_age():
+    return float(os.environ.get("HTTP_CACHE_MAX_AGE") or DEFAULT_MAX_AGE)
+
+def _paths(url):
+    key  = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    base = os.path.join(os.environ.get("HTTP_CACHE_DIR") or DEFAULT_DIR, key[:2], key)
+    return base + ".json", base + ".body"
+
+def _count(field, n=1):
+    with _lock:
+        stats[field] += n
+
+# ── Storage ───────────────────────────────────────────────────────────────────
+
+def _atomic_write(path, data):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _load(url):
+    meta_path, body_path = _paths(url)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            return meta, f.read()
+    except (OSError, ValueError):
+        return None
+
+def _store(url, status, headers, body):
+    meta_path, body_path = _paths(url)
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    meta = {
+        "url":           url,
+        "status":        status,
+        "etag":          headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "stored_at":     time.time(),
+    }
+    _atomic_write(body_path, body)
+    _atomic_write(meta_path, json.dumps(meta).encode())
+    return meta
+
+def _evict(url):
+    for path in _paths(url):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _touch(url, meta):
+    meta["stored_at"] = time.time()
+    _atomic_write(_paths(url)[0], json.dumps(meta).encode())
+
+def _serve(url, meta, body):
+    if meta["status"] in NEGATIVE:
+        raise urllib.error.HTTPError(url, meta["status"], "cached", email.message.Message(),
+                                     BytesIO(body))
+    return body
+
+# ── Public API ────────────────────────────────────────────────────────────────
+
+def fetch(url, headers=None, timeout=30):
+    """GET url through the cache and return the body bytes."""
+    m = mode()
+    if m == "off":
+        req = urllib.request.Request(url, headers=headers or {})
+        with http_client.urlopen(req, timeout=timeout) as resp:
+            return resp.read()
+
+    entry = _load(url)
+    if entry is None and m == "offline":
+        raise CacheMiss(f"not in HTTP cache: {url}")
+    if entry is not None:
+        meta, body = entry
+        if m == "offline" or time.time() - meta["stored_at"] < max_age():
+            _count("fresh")
+            return _serve(url, meta, body)
+
+    conditional = {}
+    if entry is not None:
+        if meta.get("etag"):
+            conditional["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            conditional["If-Modified-Since"] = meta["last_modified"]
+    req = urllib.request.Request(url, headers={**(headers or {}), **conditional})
+    try:
+        with http_client.urlopen(req, timeout=timeout) as resp:
+            fresh = resp.read()
+            meta  = _store(url, resp.status, resp.headers, fresh)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry is not None:
+            _touch(url, meta)
+            _count("revalidated")
+            return _serve(url, meta, body)
+        if e.code in NEGATIVE:
+            fresh = e.read()
+            _store(url, e.code, e.headers, fresh)
+            _count("fetched")
+            raise urllib.error.HTTPError(url, e.code, e.reason, e.headers, BytesIO(fresh))
+        raise
+    _count("fetched")
+    _count("bytes", len(fresh))
+    return fresh
+
+def cached(url):
+    m = mode()
+    if m == "off":
+        return False
+    meta_path = _paths(url)[0]
+    if m == "offline":
+        return os.path.exists(meta_path)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            return time.time() - json.load(f)["stored_at"] < max_age()
+    except (OSError, ValueError, KeyError):
+        return False
+
+def fetch_json(url, headers=None, timeout=30, validate=None):
+    """fetch() parsed as JSON. When validate(data) is false the entry is
+    evicted before data is returned, so the caller's error is not replayed
+    from disk on its next attempt."""
+    data = json.loads(fetch(url, headers, timeout).decode("utf-8"))
+    if validate is not None and mode() != "off" and not validate(data):
+        _evict(url)
+    return data
+
+def code_ok(data):
+    """validate= for alquran.cloud / equran.id: errors come back as 200 with
+    {"code": <status>}."""
+    return isinstance(data, dict) and data.get("code") == 200
+
+def summary():
+    return (f"HTTP cache ({mode()}): {stats['fresh']} from disk, {stats['revalidated']} revalidated, "
+            f"{stats['fetched']} fetched ({stats['bytes'] / 1_048_576:.1f} MB)")
@@ -0,0 +1,368 @@
+"""
+http_client.py
+──────────────
+Pooled keep-alive HTTP client shared by the scripts (stdlib http.client).
+
+urllib.request.urlopen opens a new TCP + TLS connection for every call, so
+thousands of small Supabase / OpenAI requests each pay a full handshake.
+Here idle connections are kept per host and reused across calls and
+threads.
+
+  urlopen(req, timeout=60, retry=PASSTHROUGH) — drop-in for
+                     urllib.request.urlopen: takes a urllib Request or URL,
+                     returns a response with .status / .headers / .read() /
+                     line iteration, raises urllib.error.HTTPError on non-2xx
+  request(method, url, headers=None, body=None, timeout=60, retry=None,
+          gzip_body=False) → response; retries per the default policy
+  RetryPolicy(tries, backoff, max_backoff, statuses, methods)
+  default_retry()  — policy from HTTP_RETRIES / HTTP_BACKOFF (3 tries, 1 s)
+  summary()        — requests sent, connections opened, reuse ratio
+
+Behaviour:
+  • Responses are requested with Accept-Encoding: gzip and decoded
+    transparently, also while streaming lines.
+  • gzip_body=True compresses the request body (Content-Encoding: gzip),
+    for upstreams that accept it; off by default.
+  • A reused connection the server has already closed is retried once on
+    a fresh one; streamed (non-replayable) bodies always use a fresh one. Status and connection-error retries follow the policy;
+    bodies that are iterators (streamed uploads) are never replayed.
+  • GET / HEAD redirects are followed, as urllib does.
+  • HTTP_CLIENT_HTTP2=1 sends request() / urlopen() through an httpx
+    client with HTTP/2 multiplexing when httpx (and h2) are installed
+    (pip install 'httpx[http2]'); otherwise it is ignored.
+
+Proxy environment variables are not consulted.
+"""
+
+import atexit, gzip, http.client, importlib.util, io, os, random, ssl, sys, threading, time, urllib.error, urllib.request
+from urllib.parse import urljoin, urlsplit
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+if importlib.util.find_spec("h2") is None:   # httpx needs h2 for HTTP/2
+    httpx = None
+
+POOL_SIZE     = 16    # idle connections kept per host
+MAX_REDIRECTS = 5
+REDIRECTS     = (301, 302, 303, 307, 308)
+USER_AGENT    = f"Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}"   # as before
+
+ssl_context = None    # created on first HTTPS request; assign to override
+
+stats  = {"requests": 0, "connections": 0, "reused": 0, "retries": 0}
+_lock  = threading.Lock()
+
+
+def _count(field, n=1):
+    with _lock:
+        stats[field] += n
+
+# ── Retry policy ──────────────────────────────────────────────────────────────
+
+class RetryPolicy:
+    """How often and when to retry a request.
+
+    tries     — attempts in total (1 = no retries)
+    backoff   — base delay in seconds, doubled per attempt, capped at
+                max_backoff and jittered; a Retry-After header wins
+    statuses  — HTTP statuses that are retried for any method
+    methods   — methods also retried after a connection error (the request
+                may have reached the server, so only idempotent ones)
+    """
+
+    def __init__(self, tries=3, backoff=1.0, max_backoff=30.0,
+                 statuses=(429, 500, 502, 503, 504),
+                 methods=("GET", "HEAD", "PUT", "DELETE", "OPTIONS")):
+        self.tries       = max(1, tries)
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self.statuses    = frozenset(statuses)
+        self.methods     = frozenset(methods)
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+PASSTHROUGH = RetryPolicy(tries=1)   # urlopen(): callers keep their own retry loops
+
+def default_retry():
+    return RetryPolicy(tries=int(os.environ.get("HTTP_RETRIES") or 3),
+                       backoff=float(os.environ.get("HTTP_BACKOFF") or 1.0))
+
+# ── Connection pool ───────────────────────────────────────────────────────────
+
+class _Pool:
+    """Idle connections per (scheme, host, port), shared by all threads."""
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, timeout, fresh=False):
+        """Return (connection, reused)."""
+        if not fresh:
+            with self.lock:
+                conns = self.idle.get(key)
+                conn  = conns.pop() if conns else None
+            if conn is not None:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                _count("reused")
+                return conn, True
+        scheme, host, port = key
+        if scheme == "https":
+            global ssl_context
+            if ssl_context is None:
+                ssl_context = ssl.create_default_context()
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        _count("connections")
+        return conn, False
+
+    def put(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            conns, self.idle = self.idle, {}
+        for pool in conns.values():
+            for conn in pool:
+                conn.close()
+
+
+_pool = _Pool()
+
+# ── Responses ─────────────────────────────────────────────────────────────────
+
+class _IterReader(io.RawIOBase):
+    """Raw stream over an iterator of byte chunks (httpx responses)."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf    = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            self.buf = next(self.chunks, None)
+            if self.buf is None:
+                self.buf = b""
+                return 0
+        n = min(len(b), len(self.buf))
+        b[:n], self.buf = self.buf[:n], self.buf[n:]
+        return n
+
+
+class Response:
+    """Subset of urllib's response object: status, reason, headers, url,
+    read(), readline(), line iteration, context manager.
+
+    The connection goes back to the pool once the body has been read to the
+    end; closing a response early discards its connection instead.
+    """
+
+    def __init__(self, url, status, reason, headers, body, release):
+        self.url      = url
+        self.status   = self.code = status
+        self.reason   = reason
+        self.headers  = headers
+        self._body    = body
+        self._release = release
+
+    def getcode(self):
+        return self.status
+
+    def _finish(self, complete):
+        if self._release:
+            release, self._release = self._release, None
+            release(complete)
+
+    def read(self, n=-1):
+        data = self._body.read() if n is None or n < 0 else self._body.read(n)
+        if n is None or n < 0 or not data:
+            self._finish(True)
+        return data
+
+    def readline(self):
+        line = self._body.readline()
+        if not line:
+            self._finish(True)
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        self._finish(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ── Transport ─────────────────────────────────────────────────────────────────
+
+_STALE = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+          ConnectionResetError, BrokenPipeError)
+
+def _send_pooled(method, url, headers, body, timeout, replayable):
+    parts = urlsplit(url)
+    port  = parts.port or (443 if parts.scheme == "https" else 80)
+    key   = (parts.scheme, parts.hostname, port)
+    path  = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+
+    # A streamed body can't be re-sent if an idle connection turns out to be
+    # closed, so it always gets a fresh one
+    for fresh in ((False, True) if replayable else (True,)):
+        conn, reused = _pool.get(key, timeout, fresh)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            raw = conn.getresponse()
+        except _STALE:
+            conn.close()
+            if reused and replayable:
+                continue          # server closed the idle connection; retry once
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        break
+
+    def release(complete, raw=raw, conn=conn):
+        if complete and raw.isclosed() and not raw.will_close:
+            _pool.put(key, conn)
+        else:
+            conn.close()
+
+    body_stream = raw
+    if (raw.getheader("Content-Encoding") or "").lower() == "gzip" and method != "HEAD":
+        body_stream = gzip.GzipFile(fileobj=raw)
+    return Response(url, raw.status, raw.reason, raw.headers, body_stream, release)
+
+
+_httpx_client = None
+
+def _use_http2():
+    return httpx is not None and os.environ.get("HTTP_CLIENT_HTTP2", "").lower() in ("1", "true", "on")
+
+def _send_httpx(method, url, headers, body, timeout, replayable):
+    global _httpx_client
+    with _lock:
+        if _httpx_client is None:
+            _httpx_client = httpx.Client(http2=True, follow_redirects=False,
+                                         limits=httpx.Limits(max_keepalive_connections=POOL_SIZE))
+    req = _httpx_client.build_request(method, url, headers=headers, content=body, timeout=timeout)
+    try:
+        r = _httpx_client.send(req, stream=True)
+    except httpx.TransportError as e:
+        raise ConnectionError(str(e)) from e
+    body_stream = io.BufferedReader(_IterReader(r.iter_bytes()))
+    return Response(url, r.status_code, r.reason_phrase, r.headers, body_stream,
+                    lambda complete: r.close())
+
+# ── Public API ────────────────────────────────────────────────────────────────
+
+def request(method, url, headers=None, body=None, timeout=60, retry=None, gzip_body=False):
+    """Send one request through the pool. Returns a Response for 2xx.
+
+    Non-2xx statuses raise urllib.error.HTTPError (body readable via .read())
+    and connection failures raise urllib.error.URLError, once the retry
+    policy is exhausted.
+    """
+    policy  = retry or default_retry()
+    method  = method.upper()
+    headers = dict(headers or {})
+    if not any(k.lower() == "user-agent" for k in headers):
+        headers["User-Agent"] = USER_AGENT
+    if not any(k.lower() == "accept-encoding" for k in headers):
+        headers["Accept-Encoding"] = "gzip"
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if gzip_body and isinstance(body, (bytes, bytearray)):
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    replayable = body is None or isinstance(body, (bytes, bytearray))
+    send       = _send_httpx if _use_http2() else _send_pooled
+
+    attempt   = 0
+    redirects = 0
+    while True:
+        _count("requests")
+        try:
+            resp = send(method, url, headers, body, timeout, replayable)
+        except (OSError, http.client.HTTPException) as e:
+            if replayable and method in policy.methods and attempt + 1 < policy.tries:
+                _count("retries")
+                time.sleep(policy.delay(attempt))
+                attempt += 1
+                continue
+            raise urllib.error.URLError(e) from e
+
+        if resp.status in REDIRECTS and method in ("GET", "HEAD") and redirects < MAX_REDIRECTS:
+            location = resp.headers.get("Location")
+            resp.read()
+            if location:
+                url = urljoin(url, location)
+                redirects += 1
+                continue
+
+        if 200 <= resp.status < 300:
+            return resp
+
+        if resp.status in policy.statuses and replayable and attempt + 1 < policy.tries:
+            wait = policy.delay(attempt, resp.headers.get("Retry-After"))
+            resp.read()
+            _count("retries")
+            time.sleep(wait)
+            attempt += 1
+            continue
+
+        data = resp.read()
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(data))
+
+
+def urlopen(req, data=None, timeout=60, retry=PASSTHROUGH):
+    """urllib.request.urlopen over the pool; req is a Request or a URL."""
+    if isinstance(req, str):
+        req = urllib.request.Request(req, data=data)
+    elif data is not None:
+        req.data = data
+    headers = dict(req.header_items())
+    return request(req.get_method(), req.full_url, headers, req.data, timeout, retry)
+
+
+def close():
+    """Close all idle connections (also done at interpreter exit)."""
+    _pool.close()
+    if _httpx_client is not None:
+        _httpx_client.close()
+
+atexit.register(close)
+
+
+def summary():
+    reuse = stats["reused"] / stats["requests"] if stats["requests"] else 0.0
+    return (f"HTTP client: {stats['requests']} requests over {stats['connections']} connections "
+            f"({reuse:.0%} reused), {stats['retries']} retries")
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+local_search.py
+───────────────
+In-process mirror of the match_verses_hybrid RPC (migrations 002 / 004)
+for bulk offline jobs: no database round trip, no load on Supabase.
+
+  vector — all 6,236 embeddings in one contiguous, L2-normalised float32
+           matrix; a batch of queries is one matrix multiply + argpartition
+           top-k (exact cosine, where the RPC uses the approximate HNSW index)
+  text   — BM25 over the same text as the fts column (translation,
+           tafsir_quraish_shihab, tafsir_kemenag, tafsir_ibnu_kathir_id),
+           tokenised like to_tsvector('simple', …): lower-cased runs of
+           letters / digits, no stemming, OR semantics
+  merge  — reciprocal rank fusion exactly as the RPC: each side contributes
+           its top match_count * 2, score = Σ 1 / (60 + rank)
+
+  LocalSearch(rows, embeddings) — rows are dicts with the RPC's columns
+  LocalSearch.from_snapshot()   — load from a corpus snapshot (corpus_snapshot.py)
+  LocalSearch.from_supabase()   — load everything via PostgREST (~1 min)
+  load()                        — from the snapshot if there is one, else Supabase
+  .hybrid(embedding, text, match_count=20)        → rows like the RPC
+  .hybrid_batch(embeddings, texts, match_count=20) → one list per query
+
+The RPC's full-text side is unordered (it takes the first match_count * 2
+matches the GIN index yields), so BM25 ranks that side better than the RPC
+does; exact parity is only expected for the vector side. --check measures
+both against the live RPCs.
+
+seed_ajarkan.py --local-search runs its candidate search through this
+module instead of the RPC.
+
+Requires numpy (pip install numpy). Reads SUPABASE_URL and
+SUPABASE_SERVICE_KEY from .env / the environment.
+
+  python3 scripts/local_search.py --check 50
+"""
+
+import argparse, json, math, os, re, sys, time
+from collections import Counter, defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import corpus_snapshot, supabase_rest
+
+RRF_K        = 60
+BM25_K1      = 1.2
+BM25_B       = 0.75
+FTS_COLUMNS  = ("translation", "tafsir_quraish_shihab", "tafsir_kemenag", "tafsir_ibnu_kathir_id")
+RESULT_COLUMNS = ("id", "surah_number", "surah_name", "verse_number", "arabic", "translation",
+                  "tafsir_quraish_shihab")
+EMBED_PAGE   = 200    # rows per PostgREST page when embeddings are included
+
+_TOKEN = re.compile(r"[^\W_]+")
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower()) if text else []
+
+def fts_text(row):
+    return " ".join(row.get(c) or "" for c in FTS_COLUMNS)
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("local_search needs numpy (pip install numpy)")
+
+# ── BM25 ──────────────────────────────────────────────────────────────────────
+
+class BM25:
+    """Inverted index: term → (doc indices, term frequencies) as numpy arrays."""
+
+    def __init__(self, docs):
+        _require_numpy()
+        postings = defaultdict(lambda: ([], []))
+        lengths  = np.zeros(len(docs), dtype=np.float32)
+        for i, text in enumerate(docs):
+            counts     = Counter(tokenize(text))
+            lengths[i] = sum(counts.values())
+            for term, tf in counts.items():
+                ids, tfs = postings[term]
+                ids.append(i)
+                tfs.append(tf)
+        n          = len(docs)
+        avgdl      = float(lengths.mean()) if n else 0.0
+        self.n     = n
+        self.norm  = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (avgdl or 1.0))
+        self.index = {}
+        for term, (ids, tfs) in postings.items():
+            df  = len(ids)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            self.index[term] = (np.asarray(ids, dtype=np.int32), np.asarray(tfs, dtype=np.float32), idf)
+
+    def top(self, query, k):
+        """Indices of the k best-scoring documents matching any query term."""
+        scores = np.zeros(self.n, dtype=np.float32)
+        hit    = False
+        for term in set(tokenize(query)):
+            entry = self.index.get(term)
+            if entry is None:
+                continue
+            ids, tfs, idf = entry
+            scores[ids] += idf * tfs * (BM25_K1 + 1) / (tfs + self.norm[ids])
+            hit = True
+        if not hit:
+            return np.empty(0, dtype=np.int64)
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        return matched[np.argsort(-scores[matched], kind="stable")]
+
+# ── Search engine ─────────────────────────────────────────────────────────────
+
+class LocalSearch:
+
+    def __init__(self, rows, embeddings):
+        _require_numpy()
+        self.rows    = [{c: r.get(c) for c in RESULT_COLUMNS} for r in rows]
+        self.ids     = [r["id"] for r in rows]
+        matrix       = np.ascontiguousarray(embeddings, dtype=np.float32)
+        norms        = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix  = matrix / np.where(norms == 0, 1, norms)
+        self.bm25    = BM25([fts_text(r) for r in rows])
+
+    @classmethod
+    def from_supabase(cls, page_size=EMBED_PAGE):
+        columns = sorted(set(RESULT_COLUMNS) | set(FTS_COLUMNS)) + ["embedding"]
+        rows, vecs = [], []
+        for r in supabase_rest.scan_verses(columns, ["embedding=not.is.null"], page_size=page_size):
+            e = r.pop("embedding")
+            vecs.append(json.loads(e) if isinstance(e, str) else e)
+            rows.append(r)
+        return cls(rows, np.asarray(vecs, dtype=np.float32))
+
+    @classmethod
+    def from_snapshot(cls, snapshot=None):
+        snapshot = snapshot or corpus_snapshot.Snapshot()
+        columns  = sorted(set(RESULT_COLUMNS) | set(FTS_COLUMNS))
+        keep     = np.flatnonzero(snapshot.has_embedding)
+        rows     = snapshot.take(columns, keep)
+        return cls(rows, snapshot.embeddings[keep])
+
+    def __len__(self):
+        return len(self.rows)
+
+    # ── Stages ────────────────────────────────────────────────────────────────
+
+    def vector_top(self, queries, k):
+        """Top-k verse indices by cosine similarity for a (b, dims) batch.
+        Returns (indices, similarities), both (b, k), best first."""
+        q     = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        q     = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        sims  = q @ self.matrix.T
+        k     = min(k, sims.shape[1])
+        part  = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(sims, part, axis=1).argsort(axis=1)[:, ::-1]
+        idx   = np.take_along_axis(part, order, axis=1)
+        return idx, np.take_along_axis(sims, idx, axis=1)
+
+    def text_top(self, query_text, k):
+        return self.bm25.top(query_text, k)
+
+    def _fuse(self, vec_idx, text_idx, match_count):
+        scores = defaultdict(float)
+        for rank, i in enumerate(vec_idx, 1):
+            scores[int(i)] += 1.0 / (RRF_K + rank)
+        for rank, i in enumerate(text_idx, 1):
+            scores[int(i)] += 1.0 / (RRF_K + rank)
+        best = sorted(scores.items(), key=lambda kv: -kv[1])[:match_count]
+        return [{**self.rows[i], "similarity": s} for i, s in best]
+
+    # ── Public API ────────────────────────────────────────────────────────────
+
+    def hybrid(self, query_embedding, query_text, match_count=20):
+        return self.hybrid_batch([query_embedding], [query_text], match_count)[0]
+
+    def hybrid_batch(self, query_embeddings, query_texts, match_count=20):
+        vec_idx, _ = self.vector_top(query_embeddings, match_count * 2)
+        return [self._fuse(v, self.text_top(t, match_count * 2), match_count)
+                for v, t in zip(vec_idx, query_texts)]
+
+def load():
+    """LocalSearch from the current corpus snapshot, or from Supabase when
+    none has been exported. Returns (engine, description of the source)."""
+    if corpus_snapshot.current_path():
+        snapshot = corpus_snapshot.Snapshot()
+        return LocalSearch.from_snapshot(snapshot), f"snapshot {snapshot.version}"
+    return LocalSearch.from_supabase(), "Supabase"
+
+# ── Parity check against the RPCs ─────────────────────────────────────────────
+
+def overlap(a, b):
+    return len(set(a) & set(b)) / max(1, len(b))
+
+def check(n, match_count):
+    print("\n── Loading corpus ───────────────────────────────────────────────────────")
+    t0 = time.perf_counter()
+    engine, source = load()
+    print(f"  ✓ {len(engine)} verses from {source}, {engine.matrix.shape[1]} dims, "
+          f"{len(engine.bm25.index):,} terms in {time.perf_counter() - t0:.1f}s")
+
+    # Existing verse embeddings stand in for query embeddings (no OpenAI
+    # calls); the first words of the translation stand in for the query text
+    step   = max(1, len(engine) // n)
+    sample = list(range(0, len(engine), step))[:n]
+    texts  = [" ".join(tokenize(engine.rows[i]["translation"])[:6]) for i in sample]
+    embeds = engine.matrix[sample]
+
+    t0 = time.perf_counter()
+    local = engine.hybrid_batch(embeds, texts, match_count)
+    dt = time.perf_counter() - t0
+    print(f"  ✓ Local hybrid: {len(sample)} queries in {dt * 1000:.0f} ms "
+          f"({len(sample) / dt:,.0f} queries/s)")
+
+    print(f"\n── Comparing with the RPCs ({len(sample)} queries, match_count={match_count}) ──")
+    vec_overlap, hyb_overlap, top1 = [], [], 0
+    local_vec, _ = engine.vector_top(embeds, match_count)
+    for j, (e, text) in enumerate(zip(embeds, texts)):
+        emb = "[" + ",".join(repr(float(x)) for x in e) + "]"
+        remote_vec = supabase_rest.rpc("match_verses", {"query_embedding": emb,
+                                                        "match_count": match_count}) or []
+        remote_hyb = supabase_rest.rpc("match_verses_hybrid", {"query_embedding": emb,
+                                                               "query_text": text,
+                                                               "match_count": match_count}) or []
+        vec_overlap.append(overlap([engine.ids[i] for i in local_vec[j]], [r["id"] for r in remote_vec]))
+        hyb_overlap.append(overlap([r["id"] for r in local[j]], [r["id"] for r in remote_hyb]))
+        top1 += bool(remote_hyb and local[j] and remote_hyb[0]["id"] == local[j][0]["id"])
+
+    print(f"  Vector top-{match_count} overlap: {sum(vec_overlap) / len(vec_overlap):.1%} "
+          f"(HNSW is approximate; expect ≥ 95%)")
+    print(f"  Hybrid top-{match_count} overlap: {sum(hyb_overlap) / len(hyb_overlap):.1%} "
+          f"(RPC's text side is unordered, so lower)")
+    print(f"  Hybrid top-1 agreement:  {top1}/{len(sample)}")
+
+
+def load_env():
+    path = os.path.join(os.path.dirname(__file__), "../.env")
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and "=" in line and not line.startswith("#"):
+                k, v = line.split("=", 1)
+                os.environ.setdefault(k.strip(), v.strip())
+
+
+def main():
+    load_env()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", type=int, metavar="N", default=50,
+                        help="compare N sample queries with the live RPCs")
+    parser.add_argument("--match-count", type=int, default=20)
+    args = parser.parse_args()
+    for k in ("SUPABASE_URL", "SUPABASE_SERVICE_KEY"):
+        if not os.environ.get(k):
+            print(f"ERROR: missing env var {k}")
+            return 1
+    check(args.check, args.match_count)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,369 @@
+"""
+openai_batch.py
+───────────────
+Shared OpenAI Batch API client and durable job ledger for the batch
+scripts (translate_ibnu_kathir.py, translate_asbabun_nuzul.py,
+generate_tafsir_summaries.py, seed_ajarkan.py --batch).
+
+Every submitted batch is recorded in scripts/batch_output/ledger.sqlite3
+with its file id, batch id, custom_id set, last known status and whether
+its results have been applied. On restart a script asks the ledger for its
+outstanding batches and resumes polling them instead of re-submitting (and
+re-paying for) the same requests; applied batches are never downloaded
+again. The upload is recorded before the batch is created, so a crash in
+between is completed on the next run instead of paying twice.
+
+  write_jsonl(path, records) — stream request dicts to a JSONL file
+  chat_request(custom_id, model, system, user, **params) — one batch line
+                       with the static system prompt first and a prompt_cache_key
+  UsageTally         — sums usage from output lines; reports the cached-token ratio
+  Ledger(path=None)  — open / create the ledger (BATCH_LEDGER overrides path)
+  submit(ledger, job, jsonl_path, custom_ids, meta=None) → batch_id
+  wait(batch_id, ledger=None, interval=60) → final batch object
+  stream_results(file_id, save_to=None) — parsed output lines as they arrive
+  upload / create / retrieve / download — thin API wrappers; upload streams
+                       the file from disk, so memory stays flat for 100 MB+ files
+
+Reads OPENAI_API_KEY from the environment at call time.
+"""
+
+import contextlib, hashlib, json, os, sqlite3, time, urllib.error, urllib.request
+
+import http_client
+
+API_BASE       = "https://api.openai.com/v1"
+DEFAULT_LEDGER = os.path.join(os.path.dirname(__file__), "batch_output", "ledger.sqlite3")
+TERMINAL       = ("completed", "failed", "expired", "cancelled")
+UPLOADED       = "uploaded"    # ledger status: file recorded, batch not created yet
+UNSUBMITTED    = "unsubmitted:"   # placeholder batch_id prefix for UPLOADED rows
+FAILED         = ("failed", "expired", "cancelled")
+UPLOAD_CHUNK   = 1 << 20   # bytes read per upload chunk
+
+# ── API ───────────────────────────────────────────────────────────────────────
+
+def _auth():
+    return {"Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY', '')}"}
+
+def api(method, path, body=None, timeout=120):
+    """JSON request to the OpenAI API; raises RuntimeError on HTTP errors."""
+    headers = _auth()
+    data    = None
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(f"{API_BASE}/{path.lstrip('/')}", data=data,
+                                 method=method, headers=headers)
+    try:
+        with http_client.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read().decode())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"OpenAI HTTP {e.code}: {e.read().decode()[:500]}")
+
+def _multipart_body(path, head, tail):
+    yield head
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK):
+            yield chunk
+    yield tail
+
+def upload(path, purpose="batch"):
+    """Upload a JSONL file as multipart/form-data. Returns the file id.
+
+    The body is sent as an iterable (form headers, file chunks, closing
+    boundary) with an explicit Content-Length, so the file is never held in
+    memory as a whole.
+    """
+    boundary = "----BatchUploadBoundary"
+    name     = os.path.basename(path)
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="purpose"\r\n\r\n{purpose}\r\n'
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+        f"Content-Type: application/jsonl\r\n\r\n"
+    ).encode()
+    tail    = f"\r\n--{boundary}--\r\n".encode()
+    length  = len(head) + os.path.getsize(path) + len(tail)
+    headers = {**_auth(),
+               "Content-Type":   f"multipart/form-data; boundary={boundary}",
+               "Content-Length": str(length)}
+    req = urllib.request.Request(f"{API_BASE}/files", data=_multipart_body(path, head, tail),
+                                 method="POST", headers=headers)
+    try:
+        with http_client.urlopen(req, timeout=600) as resp:
+            return json.loads(resp.read().decode())["id"]
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"OpenAI HTTP {e.code}: {e.read().decode()[:500]}")
+
+def create(file_id, endpoint="/v1/chat/completions"):
+    return api("POST", "batches", {
+        "input_file_id":     file_id,
+        "endpoint":          endpoint,
+        "completion_window": "24h",
+    })
+
+def retrieve(batch_id):
+    return api("GET", f"batches/{batch_id}")
+
+def find_batch(file_id, since=0):
+    """The batch created from input file `file_id`, or None. Pages through
+    the batch list (newest first) back to `since` (unix time)."""
+    after = None
+    while True:
+        page = api("GET", "batches?limit=100" + (f"&after={after}" if after else ""))
+        for batch in page.get("data", []):
+            if batch.get("input_file_id") == file_id:
+                return batch
+            if batch.get("created_at", 0) < since:
+                return None
+        if not page.get("has_more") or not page.get("data"):
+            return None
+        after = page["data"][-1]["id"]
+
+def download(file_id):
+    """Raw bytes of a batch output / error file."""
+    req = urllib.request.Request(f"{API_BASE}/files/{file_id}/content", headers=_auth())
+    try:
+        with http_client.urlopen(req, timeout=600) as resp:
+            return resp.read()
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"OpenAI HTTP {e.code}: {e.read().decode()[:500]}")
+
+def stream_results(file_id, save_to=None):
+    """Yield each JSON line of an output / error file while it downloads.
+
+    Lines are parsed as they come off the socket, so callers can start
+    writing results before the download finishes; memory stays at one line.
+    If save_to is given the raw bytes are also copied there.
+    """
+    req = urllib.request.Request(f"{API_BASE}/files/{file_id}/content", headers=_auth())
+    try:
+        resp = http_client.urlopen(req, timeout=600)
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"OpenAI HTTP {e.code}: {e.read().decode()[:500]}")
+    with resp, (open(save_to, "wb") if save_to else contextlib.nullcontext()) as out:
+        for line in resp:
+            if out:
+                out.write(line)
+            if line.strip():
+                yield json.loads(line)
+
+def write_jsonl(path, records):
+    """Write request dicts one line at a time. Returns (lines, bytes)."""
+    n = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for rec in records:
+            if n:
+                f.write("\n")
+            f.write(json.dumps(rec, ensure_ascii=False))
+            n += 1
+    return n, os.path.getsize(path)
+
+# ── Requests + usage ──────────────────────────────────────────────────────────
+
+def prompt_cache_key(name, system):
+    """Stable key per script + system prompt version, so requests sharing the
+    prefix are routed to the same prompt cache."""
+    return f"{name}-{hashlib.sha256(system.encode('utf-8')).hexdigest()[:12]}"
+
+def chat_request(custom_id, model, system, user, cache_key=None, **params):
+    """Batch line for /v1/chat/completions.
+
+    The system prompt always comes first and is passed through untouched,
+    so every request of a job shares a byte-identical prefix — the part the
+    API can serve from its prompt cache (prefixes ≥ 1024 tokens). Anything
+    per-request belongs in `user`.
+    """
+    body = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user",   "content": user},
+        ],
+        **params,
+    }
+    if cache_key:
+        body["prompt_cache_key"] = cache_key
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+
+class UsageTally:
+    """Token usage summed over batch output lines."""
+
+    def __init__(self):
+        self.requests   = 0
+        self.prompt     = 0
+        self.cached     = 0
+        self.completion = 0
+
+    def add(self, obj):
+        usage = ((obj.get("response") or {}).get("body") or {}).get("usage")
+        if not usage:
+            return
+        self.requests   += 1
+        self.prompt     += usage.get("prompt_tokens", 0)
+        self.cached     += (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        self.completion += usage.get("completion_tokens", 0)
+
+    def merge(self, other):
+        self.requests   += other.requests
+        self.prompt     += other.prompt
+        self.cached     += other.cached
+        self.completion += other.completion
+
+    def summary(self):
+        ratio = self.cached / self.prompt if self.prompt else 0.0
+        return (f"usage: {self.requests} requests, {self.prompt:,} prompt tokens "
+                f"({self.cached:,} cached = {ratio:.0%}), {self.completion:,} completion tokens")
+
+# ── Ledger ────────────────────────────────────────────────────────────────────
+
+class Ledger:
+    """SQLite record of submitted batches, one row per batch."""
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("BATCH_LEDGER") or DEFAULT_LEDGER
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+              batch_id    TEXT PRIMARY KEY,
+              job         TEXT NOT NULL,
+              file_id     TEXT NOT NULL,
+              custom_ids  TEXT NOT NULL,           -- JSON array
+              status      TEXT NOT NULL,
+              output_file TEXT,
+              error_file  TEXT,
+              applied     INTEGER NOT NULL DEFAULT 0,
+              meta        TEXT,                    -- JSON, script-specific
+              created_at  REAL NOT NULL,
+              updated_at  REAL NOT NULL,
+              endpoint    TEXT
+            )""")
+        columns = {r["name"] for r in self.db.execute("PRAGMA table_info(batches)")}
+        if "endpoint" not in columns:   # ledgers created before the column existed
+            self.db.execute("ALTER TABLE batches ADD COLUMN endpoint TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS batches_job ON batches (job, applied)")
+        self.db.commit()
+
+    def record(self, job, file_id, batch_id, custom_ids, status="validating", meta=None,
+               endpoint=None):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO batches (batch_id, job, file_id, custom_ids, status, meta,"
+            " created_at, updated_at, endpoint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (batch_id, job, file_id, json.dumps(list(custom_ids)), status,
+             json.dumps(meta) if meta is not None else None, now, now, endpoint))
+        self.db.commit()
+
+    def assign(self, file_id, batch):
+        """Attach the created batch to the UPLOADED row for file_id."""
+        self.db.execute(
+            "UPDATE batches SET batch_id = ?, status = ?, updated_at = ? WHERE batch_id = ?",
+            (batch["id"], batch["status"], time.time(), UNSUBMITTED + file_id))
+        self.db.commit()
+
+    def _create_unsubmitted(self, job):
+        """Finish submits that stopped between upload and batch creation:
+        adopt the batch if it was created after all, else create it now from
+        the already uploaded file. On an API or network error the row stays
+        UPLOADED and the next run tries again."""
+        rows = self.db.execute(
+            "SELECT file_id, endpoint, created_at FROM batches WHERE job = ? AND status = ?",
+            (job, UPLOADED)).fetchall()
+        for r in rows:
+            try:
+                batch = find_batch(r["file_id"], since=r["created_at"] - 3600)
+                if batch is None:
+                    batch = create(r["file_id"], r["endpoint"] or "/v1/chat/completions")
+                    print(f"  ↻ Created batch {batch['id']} for uploaded file {r['file_id']}")
+                else:
+                    print(f"  ↻ Found batch {batch['id']} for uploaded file {r['file_id']}")
+            except (RuntimeError, OSError) as e:
+                print(f"  ⚠ Uploaded file {r['file_id']} could not be submitted yet ({e}) "
+                      f"— retrying on the next run")
+                continue
+            self.assign(r["file_id"], batch)
+
+    def update(self, batch):
+        """Store the status / file ids from a retrieved batch object."""
+        self.db.execute(
+            "UPDATE batches SET status = ?, output_file = ?, error_file = ?, updated_at = ?"
+            " WHERE batch_id = ?",
+            (batch["status"], batch.get("output_file_id"), batch.get("error_file_id"),
+             time.time(), batch["id"]))
+        self.db.commit()
+
+    def mark_applied(self, batch_id):
+        self.db.execute("UPDATE batches SET applied = 1, updated_at = ? WHERE batch_id = ?",
+                        (time.time(), batch_id))
+        self.db.commit()
+
+    def outstanding(self, job):
+        """Batches for `job` whose results still need applying, oldest first.
+
+        Each is a dict with batch_id, file_id, status, custom_ids (list) and
+        meta (dict or None). Failed / expired / cancelled batches are left
+        out — their requests are simply picked up again as todo. Submits
+        interrupted after the upload are completed first; one that still
+        has no batch is left out too (see unsubmitted_ids).
+        """
+        self._create_unsubmitted(job)
+        rows = self.db.execute(
+            "SELECT * FROM batches WHERE job = ? AND applied = 0 AND status NOT IN (?, ?, ?, ?)"
+            " ORDER BY created_at", (job, *FAILED, UPLOADED)).fetchall()
+        return [{
+            "batch_id":   r["batch_id"],
+            "file_id":    r["file_id"],
+            "status":     r["status"],
+            "custom_ids": json.loads(r["custom_ids"]),
+            "meta":       json.loads(r["meta"]) if r["meta"] else None,
+        } for r in rows]
+
+    def unsubmitted_ids(self, job):
+        """custom_ids of uploads whose batch could not be created yet. Keep
+        them out of new submissions: the next outstanding() creates it."""
+        rows = self.db.execute("SELECT custom_ids FROM batches WHERE job = ? AND status = ?",
+                               (job, UPLOADED)).fetchall()
+        return {cid for r in rows for cid in json.loads(r["custom_ids"])}
+
+    def pending_ids(self, job):
+        """custom_ids already submitted in outstanding batches for `job`."""
+        return ({cid for b in self.outstanding(job) for cid in b["custom_ids"]}
+                | self.unsubmitted_ids(job))
+
+# ── Submit / wait ─────────────────────────────────────────────────────────────
+
+def submit(ledger, job, jsonl_path, custom_ids, meta=None, endpoint="/v1/chat/completions"):
+    """Upload jsonl_path, create the batch and record it. Returns the batch id.
+
+    The upload is recorded before the batch is created, so a crash in
+    between leaves an UPLOADED row that Ledger.outstanding() completes on
+    the next run rather than a paid batch the ledger doesn't know about.
+    """
+    print("  Uploading JSONL file …", end=" ", flush=True)
+    file_id = upload(jsonl_path)
+    print(f"✓ file_id={file_id}")
+    ledger.record(job, file_id, UNSUBMITTED + file_id, custom_ids, UPLOADED, meta, endpoint)
+    print("  Creating batch …", end=" ", flush=True)
+    batch = create(file_id, endpoint)
+    print(f"✓ batch_id={batch['id']}")
+    ledger.assign(file_id, batch)
+    return batch["id"]
+
+def describe(batch):
+    counts = batch.get("request_counts") or {}
+    return (f"status={batch['status']}  completed={counts.get('completed', 0)}"
+            f"/{counts.get('total', 0)}  failed={counts.get('failed', 0)}")
+
+def wait(batch_id, ledger=None, interval=60):
+    """Poll until the batch reaches a terminal status; return the batch object."""
+    while True:
+        batch = retrieve(batch_id)
+        if ledger:
+            ledger.update(batch)
+        print(f"    [{time.strftime('%H:%M:%S')}] {describe(batch)}", flush=True)
+        if batch["status"] in TERMINAL:
+            return batch
+        time.sleep(interval)
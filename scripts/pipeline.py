@@ -0,0 +1,278 @@
+"""
+pipeline.py
+───────────
+Shared concurrency helpers for the seed scripts (stdlib only).
+
+  TokenBucket   — requests-per-second limiter shared by all worker threads
+  HostLimiter   — caps in-flight requests per upstream host
+  run_ordered   — runs fn(item) on a thread pool with rate limiting and
+                  retries, returning results in input order
+  stream_stages — producer/consumer pipeline over a bounded queue, so a
+                  slow second stage overlaps with the first
+  AIMDWindow    — concurrency window that grows while the upstream is
+                  healthy and halves on 429/5xx (raise Throttled)
+  run_adaptive  — like run_ordered, but paced by an AIMDWindow
+
+Import from a script in scripts/ with a plain `import pipeline` — the
+script's own directory is on sys.path when run as python3 scripts/x.py.
+"""
+
+import queue, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# ── Rate limiting ─────────────────────────────────────────────────────────────
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens/second, holding at most `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate   = float(rate)
+        self.burst  = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.stamp  = time.monotonic()
+        self.lock   = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp  = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """At most `per_host` concurrent requests to any single host."""
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.sems     = {}
+        self.lock     = threading.Lock()
+
+    @contextmanager
+    def hold(self, url):
+        host = urlsplit(url).netloc or url
+        with self.lock:
+            sem = self.sems.get(host)
+            if sem is None:
+                sem = self.sems[host] = threading.BoundedSemaphore(self.per_host)
+        with sem:
+            yield
+
+# ── Ordered concurrent map ────────────────────────────────────────────────────
+
+def run_ordered(items, fn, workers=8, rate=None, burst=1, per_host=None,
+                url_of=None, retries=3, backoff=1.0, on_result=None):
+    """Run fn(item) for every item concurrently; return [(result, error), ...].
+
+    Output order matches `items` regardless of completion order. Each item is
+    attempted up to `retries` times (at least once) with exponential backoff;
+    the last exception is returned as `error` (result None) so nothing is
+    dropped silently. `rate` (requests/second) is shared across all workers and
+    `per_host` caps concurrency per host of url_of(item).
+
+    on_result(index, item, result, error) is called as each item finishes,
+    serialised under a lock so callers can print progress safely.
+    """
+    items    = list(items)
+    bucket   = TokenBucket(rate, burst) if rate else None
+    hosts    = HostLimiter(per_host) if per_host and url_of else None
+    out      = [None] * len(items)
+    out_lock = threading.Lock()
+
+    def attempt(item):
+        if bucket:
+            bucket.acquire()
+        if hosts:
+            with hosts.hold(url_of(item)):
+                return fn(item)
+        return fn(item)
+
+    attempts = max(1, retries)
+
+    def work(i):
+        item   = items[i]
+        result = error = None
+        for n in range(attempts):
+            try:
+                result = attempt(item)
+                error  = None
+                break
+            except Exception as e:
+                result, error = None, e
+                if n < attempts - 1:
+                    time.sleep(backoff * 2 ** n)
+        with out_lock:
+            out[i] = (result, error)
+            if on_result:
+                on_result(i, item, result, error)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(work, range(len(items))))
+    return out
+
+# ── Two-stage streaming pipeline ──────────────────────────────────────────────
+
+def stream_stages(batches, produce, consume, depth=4, consumers=2, on_result=None):
+    """Run produce(batch) in the caller's thread and consume(output) on workers.
+
+    Outputs travel through a queue of at most `depth` items, so memory stays
+    at a few batches and wall-clock time approaches the slower stage rather
+    than the sum of both. A failing batch is reported and skipped; it never
+    stops the pipeline.
+
+    on_result(stage, index, result, error) is called once per batch and
+    stage ("produce" / "consume"), serialised under a lock.
+    """
+    q    = queue.Queue(maxsize=max(1, depth))
+    lock = threading.Lock()
+
+    def report(stage, i, result, error):
+        if on_result:
+            with lock:
+                on_result(stage, i, result, error)
+
+    def drain():
+        while True:
+            job = q.get()
+            if job is None:
+                return
+            i, item = job
+            try:
+                report("consume", i, consume(item), None)
+            except Exception as e:
+                report("consume", i, None, e)
+
+    threads = [threading.Thread(target=drain, daemon=True) for _ in range(max(1, consumers))]
+    for t in threads:
+        t.start()
+    try:
+        for i, batch in enumerate(batches):
+            try:
+                item = produce(batch)
+            except Exception as e:
+                report("produce", i, None, e)
+                continue
+            report("produce", i, item, None)
+            q.put((i, item))
+    finally:
+        for _ in threads:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+# ── Adaptive (AIMD) concurrency ───────────────────────────────────────────────
+
+class Throttled(Exception):
+    """Raised by a worker when the upstream signals overload (429 / 5xx)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AIMDWindow:
+    """Additive-increase / multiplicative-decrease concurrency limit.
+
+    Every success adds 1/limit (≈ +1 per window of successes); a Throttled
+    response halves the limit, at most once per `cut_interval` seconds so a
+    burst of simultaneous 429s counts as one signal. A Retry-After pauses
+    new requests until it expires.
+    """
+
+    def __init__(self, start=2, floor=1, ceiling=16, cut_interval=1.0):
+        self.limit        = float(start)
+        self.floor        = floor
+        self.ceiling      = ceiling
+        self.cut_interval = cut_interval
+        self.in_flight    = 0
+        self.paused_until = 0.0
+        self.last_cut     = 0.0
+        self.cond         = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.cond.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+
+    def success(self):
+        with self.cond:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def throttled(self, retry_after=None):
+        with self.cond:
+            now = time.monotonic()
+            if now - self.last_cut >= self.cut_interval:
+                self.limit    = max(self.floor, self.limit / 2)
+                self.last_cut = now
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+
+def _jittered(delay):
+    return delay * (0.5 + random.random() / 2)
+
+
+def run_adaptive(items, fn, window, retries=5, backoff=1.0, on_result=None):
+    """Run fn(item) for every item under an AIMDWindow; return [(result, error), ...].
+
+    fn should raise Throttled on rate-limit / overload responses: the window
+    shrinks and the item is retried after the Retry-After pause, or after
+    exponential backoff when there is none. Other exceptions are retried with
+    jittered exponential backoff; every item is attempted at least once.
+    on_result(index, item, result, error) is called as each item finishes,
+    serialised under a lock.
+    """
+    items    = list(items)
+    out      = [None] * len(items)
+    out_lock = threading.Lock()
+
+    attempts = max(1, retries)
+
+    def work(i):
+        item   = items[i]
+        result = error = None
+        for n in range(attempts):
+            try:
+                with window.slot():
+                    result = fn(item)
+                window.success()
+                error = None
+                break
+            except Throttled as e:
+                result, error = None, e
+                window.throttled(e.retry_after)
+                # with Retry-After the window itself holds every slot back
+                if not e.retry_after and n < attempts - 1:
+                    time.sleep(_jittered(backoff * 2 ** n))
+            except Exception as e:
+                result, error = None, e
+                if n < attempts - 1:
+                    time.sleep(_jittered(backoff * 2 ** n))
+        with out_lock:
+            out[i] = (result, error)
+            if on_result:
+                on_result(i, item, result, error)
+
+    with ThreadPoolExecutor(max_workers=max(1, window.ceiling)) as pool:
+        list(pool.map(work, range(len(items))))
+    return out
@@ -8,15 +8,33 @@ Re-embeds all verses using richer text:
             + tafsir_ibnu_kathir_id[:600]
 
 Each successive run enriches the vectors further. Safe to re-run at any time.
+Vectors are cached on disk by embed text (scripts/embed_cache.py), so a
+re-run only calls the embeddings API for verses whose text changed.
 
 Run once from the project root:
 
-  python3 scripts/reembed.py
+  python3 scripts/reembed.py                 # all 6,236 verses
+  python3 scripts/reembed.py --changed-only  # only verses whose text changed
+
+--changed-only compares md5(build_embed_text) against the embed_fingerprint
+stored next to each vector (migration 010) and touches only stale rows, so
+no HNSW REINDEX is needed afterwards.
+
+Vectors are sent as packed float32 (--transport f32, migration 011) by
+default; --transport text falls back to the "[f1,f2,...]" literal path.
+
+--snapshot reads the verse text from the corpus snapshot
+(corpus_snapshot.py) instead of paging it from Supabase (full runs only);
+re-export the snapshot afterwards so it carries the new vectors.
 
 Reads credentials from .env.
 """
 
-import json, os, sys, time, urllib.request, urllib.error
+import argparse, base64, hashlib, json, os, sys, time, urllib.parse, urllib.request, urllib.error
+from array import array
+
+import corpus_snapshot, http_client
+from embed_cache import EmbeddingCache
 
 # ── Config ────────────────────────────────────────────────────────────────────
 
@@ -42,6 +60,10 @@ EMBED_DIMS   = 1536   # keeps pgvector schema unchanged; large model is still be
 FETCH_BATCH  = 500    # rows per Supabase SELECT
 EMBED_BATCH  = 100    # verses per OpenAI embedding request
 UPDATE_BATCH = 50     # rows per Supabase RPC call (large payloads)
+UPDATE_BATCH_F32 = 200  # rows per call with packed float32 (~8 KB/row vs ~30 KB)
+ID_BATCH     = 200    # ids per id=in.(...) SELECT (keeps URLs short)
+
+VERSE_COLUMNS = "id,translation,tafsir_quraish_shihab,tafsir_kemenag,tafsir_ibnu_kathir_id"
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
 
@@ -55,7 +77,7 @@ def check_env():
 def http_post(url, headers, body):
     data = json.dumps(body).encode()
     req  = urllib.request.Request(url, data=data, headers=headers, method="POST")
-    with urllib.request.urlopen(req, timeout=60) as resp:
+    with http_client.urlopen(req, timeout=60) as resp:
         raw = resp.read()
         return json.loads(raw) if raw else None
 
@@ -68,30 +90,26 @@ def supabase_headers(key):
 
 # ── Phase 1: Fetch all verses from Supabase ───────────────────────────────────
 
-def fetch_all_verses():
-    verses  = []
-    offset  = 0
-    headers = supabase_headers(SUPABASE_SERVICE_KEY)
-    headers["Range-Unit"] = "items"
+def fetch_all_verses(snapshot=None):
+    return corpus_snapshot.scan_verses(VERSE_COLUMNS, snapshot=snapshot, page_size=FETCH_BATCH)
 
-    while True:
+def fetch_changed_verses():
+    """Fetch only verses whose embed_fingerprint is stale (see migration 010).
+    Always live: their text changed since the last embed, so a snapshot
+    would most likely still hold the old text."""
+    headers = supabase_headers(SUPABASE_SERVICE_KEY)
+    ids = http_post(f"{SUPABASE_URL}/rest/v1/rpc/verses_needing_reembed", headers, {}) or []
+    verses = []
+    for start in range(0, len(ids), ID_BATCH):
+        chunk = ",".join(f'"{i}"' for i in ids[start : start + ID_BATCH])
         url = (
             f"{SUPABASE_URL}/rest/v1/quran_verses"
-            f"?select=id,translation,tafsir_quraish_shihab,tafsir_kemenag,tafsir_ibnu_kathir_id"
-            f"&order=id"
-            f"&offset={offset}&limit={FETCH_BATCH}"
+            f"?select={VERSE_COLUMNS}"
+            f"&id=in.({urllib.parse.quote(chunk)})"
         )
         req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            batch = json.loads(resp.read())
-        if not batch:
-            break
-        verses.extend(batch)
-        offset += len(batch)
-        if len(batch) < FETCH_BATCH:
-            break
-        time.sleep(0.1)
-
+        with http_client.urlopen(req, timeout=30) as resp:
+            verses.extend(json.loads(resp.read()))
     return verses
 
 # ── Phase 2: Build richer embed text ─────────────────────────────────────────
@@ -108,6 +126,8 @@ def build_embed_text(v):
 
     Total stays well under 8k tokens. Each layer is optional — if not yet
     populated (e.g. IK translation still pending) it is simply skipped.
+
+    Mirrored in SQL by embed_text() (migration 010) — keep the two in sync.
     """
     text = v["translation"] or ""
     if v.get("tafsir_quraish_shihab"):
@@ -118,6 +138,10 @@ def build_embed_text(v):
         text += " " + v["tafsir_ibnu_kathir_id"][:600]
     return text.strip()
 
+def fingerprint(v):
+    """md5 of the embed text — must match md5(embed_text(qv)) in migration 010."""
+    return hashlib.md5(build_embed_text(v).encode("utf-8")).hexdigest()
+
 # ── Phase 3: Embed in batches ─────────────────────────────────────────────────
 
 def embed_batch(texts):
@@ -130,6 +154,8 @@ def embed_batch(texts):
     return [item["embedding"] for item in sorted(resp["data"], key=lambda x: x["index"])]
 
 def embed_all(verses):
+    """Embed every verse, reusing cached vectors for unchanged embed text."""
+    cache = EmbeddingCache(EMBED_MODEL, EMBED_DIMS)
     embeddings = []
     total = len(verses)
     for start in range(0, total, EMBED_BATCH):
@@ -138,41 +164,69 @@ def embed_all(verses):
         end   = min(start + EMBED_BATCH, total)
         print(f"  Embedding {start+1}–{end}/{total} … ", end="", flush=True)
         try:
-            vecs = embed_batch(texts)
+            misses = cache.misses
+            vecs = cache.embed(texts, embed_batch, EMBED_BATCH)
             embeddings.extend(vecs)
-            print("✓")
+            print(f"✓ ({cache.misses - misses} new)")
+            if cache.misses > misses:
+                time.sleep(0.3)
         except Exception as e:
             print(f"✗  {e}")
             embeddings.extend([None] * len(batch))
-        time.sleep(0.3)
+    print(f"  {cache.summary()}")
     return embeddings
 
 # ── Phase 4: Update embeddings via RPC ───────────────────────────────────────
-
-def update_batch(rows):
-    """Call update_embedding_batch RPC — updates only the embedding column."""
-    url  = f"{SUPABASE_URL}/rest/v1/rpc/update_embedding_batch"
+#
+# Two wire formats:
+#   text — "[f1,f2,...]" literal per row, parsed by pgvector (~30 KB/row)
+#   f32  — base64 of little-endian float32, decoded server-side by
+#          decode_f32_vector() (migration 011), ~8 KB/row and bit-exact
+
+def pack_f32(emb):
+    """Encode a vector as base64 little-endian float32."""
+    buf = array("f", emb)
+    if sys.byteorder != "little":
+        buf.byteswap()
+    return base64.b64encode(buf.tobytes()).decode("ascii")
+
+def build_update_row(v, emb, transport):
+    if transport == "f32":
+        return {"id": v["id"], "embedding_f32": pack_f32(emb), "fingerprint": fingerprint(v)}
+    # pgvector accepts "[f1,f2,...]" text representation
+    return {"id": v["id"], "embedding": str(emb), "fingerprint": fingerprint(v)}
+
+TRANSPORTS = {
+    # transport: (RPC name, rows per call)
+    "f32":  ("update_embedding_batch_f32", UPDATE_BATCH_F32),
+    "text": ("update_embedding_batch",     UPDATE_BATCH),
+}
+
+def update_batch(rows, transport="f32"):
+    """Call the update RPC for `transport` — updates only embedding + fingerprint."""
+    rpc  = TRANSPORTS[transport][0]
+    url  = f"{SUPABASE_URL}/rest/v1/rpc/{rpc}"
     body = {"updates": rows}
     http_post(url, supabase_headers(SUPABASE_SERVICE_KEY), body)
 
-def update_all(verses, embeddings):
+def update_all(verses, embeddings, transport="f32"):
     rows    = []
     skipped = 0
     for v, emb in zip(verses, embeddings):
         if emb is None:
             skipped += 1
             continue
-        # pgvector accepts "[f1,f2,...]" text representation
-        rows.append({"id": v["id"], "embedding": str(emb)})
+        rows.append(build_update_row(v, emb, transport))
 
+    step    = TRANSPORTS[transport][1]
     total   = len(rows)
     updated = 0
-    for start in range(0, total, UPDATE_BATCH):
-        batch = rows[start : start + UPDATE_BATCH]
-        end   = min(start + UPDATE_BATCH, total)
+    for start in range(0, total, step):
+        batch = rows[start : start + step]
+        end   = min(start + step, total)
         print(f"  Updating {start+1}–{end}/{total} … ", end="", flush=True)
         try:
-            update_batch(batch)
+            update_batch(batch, transport)
             updated += len(batch)
             print("✓")
         except Exception as e:
@@ -184,10 +238,31 @@ def update_all(verses, embeddings):
 # ── Main ──────────────────────────────────────────────────────────────────────
 
 def main():
-    check_env()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--changed-only", action="store_true",
+                        help="re-embed only verses whose embed text changed")
+    parser.add_argument("--transport", choices=sorted(TRANSPORTS), default="f32",
+                        help="vector wire format (f32 needs migration 011)")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="read verse text from the corpus snapshot (corpus_snapshot.py)")
+    args = parser.parse_args()
+    if args.snapshot and args.changed_only:
+        parser.error("--changed-only reads the changed verses live; drop --snapshot")
 
-    print("\n── Phase 1: Fetching all verses from Supabase ───────────────────────────")
-    verses = fetch_all_verses()
+    check_env()
+    snapshot = corpus_snapshot.Snapshot() if args.snapshot else None
+    if snapshot:
+        print(f"  Verse text from {snapshot.describe()}")
+
+    if args.changed_only:
+        print("\n── Phase 1: Fetching verses with stale embeddings ───────────────────────")
+        verses = fetch_changed_verses()
+        if not verses:
+            print("  ✓ Every embedding matches its current text. Nothing to do.")
+            return
+    else:
+        print("\n── Phase 1: Fetching all verses from Supabase ───────────────────────────")
+        verses = fetch_all_verses(snapshot)
     has_qs  = sum(1 for v in verses if v.get("tafsir_quraish_shihab"))
     has_km  = sum(1 for v in verses if v.get("tafsir_kemenag"))
     has_ik  = sum(1 for v in verses if v.get("tafsir_ibnu_kathir_id"))
@@ -202,12 +277,14 @@ def main():
     print(f"\n  ✓ Embedded {ok}/{len(verses)} verses\n")
 
     print("── Phase 4: Updating embeddings in Supabase ─────────────────────────────")
-    updated, skipped = update_all(verses, embeddings)
+    updated, skipped = update_all(verses, embeddings, args.transport)
     print(f"\n  ✓ Updated {updated} rows  ({skipped} skipped due to embed failure)\n")
 
     print("── Done ─────────────────────────────────────────────────────────────────")
     print(f"  Vectors now encode translation + Quraish Shihab + Kemenag RI + Ibnu Kathir")
     print(f"  for {updated} verses. Search relevancy is now at maximum richness.")
+    if not args.changed_only:
+        print("  Next: REINDEX INDEX quran_verses_embedding_idx; VACUUM ANALYZE quran_verses;")
 
 if __name__ == "__main__":
     main()
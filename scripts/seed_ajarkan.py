@@ -13,6 +13,24 @@ Usage:
   python scripts/seed_ajarkan.py --question-id sholat-02  # Re-run single question
   python scripts/seed_ajarkan.py --category aqidah        # Run only one category
   python scripts/seed_ajarkan.py --batch                  # Use OpenAI Batch API (cheaper)
+  python scripts/seed_ajarkan.py --batch --batch-select   # HyDE + selection via Batch API too
+  python scripts/seed_ajarkan.py --local-search           # Verse search in-process (needs numpy)
+
+Batch mode records its batches in the job ledger (openai_batch.py); a
+re-run with the same selection resumes them instead of submitting again.
+
+With --batch-select every model call runs at batch pricing, in stages:
+HyDE batch → bulk embeddings → hybrid search → selection batch → content
+batch. Each finished stage is saved to batch_output/ajarkan_checkpoint.json
+(keyed by question id + text, stamped with the prompt / model / search
+version), so a re-run skips straight to the first unfinished stage.
+
+Selected verses are kept in scripts/.verse_cache.sqlite3 across runs,
+keyed by question text + model names + search settings and backend (RPC
+or --local-search). Entries made with a different HyDE / selection prompt
+are dropped when the cache opens, so editing a prompt invalidates them;
+--refresh-verses re-selects everything.
+A rerun after a content-prompt tweak goes straight to generation.
 
 Environment variables required:
   OPENAI_API_KEY      — OpenAI API key
@@ -21,15 +39,20 @@ Environment variables required:
 """
 
 import argparse
+import hashlib
 import json
 import os
 import re
+import sqlite3
 import sys
+import threading
 import time
-import urllib.request
 import urllib.error
 from pathlib import Path
 
+import http_client, openai_batch, pipeline
+from embed_cache import EmbeddingCache
+
 # ── Config ──────────────────────────────────────────────────────────────────
 
 def load_env():
@@ -53,46 +76,58 @@ EMBEDDING_DIMS = 1536
 AGE_GROUPS = ['under7', '7plus']
 VECTOR_SEARCH_COUNT = 15
 POLL_INTERVAL = 60
+SELECT_WORKERS = 16  # questions whose selection chains run concurrently
+CHAT_RPS = 8         # chat completions per second (HyDE + selection)
+SEARCH_RPS = 10      # match_verses_hybrid calls per second
+EMBED_BATCH = 100    # HyDE texts per embeddings call
+INSERT_BATCH = 200   # rows per ajarkan_queries upsert
+SYNC_FLUSH = 10      # synchronous mode: upsert after this many new rows
+BATCH_JOB = 'ajarkan_content'  # ledger job names
+HYDE_JOB = 'ajarkan_hyde'
+SELECT_JOB = 'ajarkan_select'
 
 OUTPUT_DIR = Path(__file__).parent / 'output'
 BATCH_OUTPUT_DIR = Path(__file__).parent / 'batch_output'
+CHECKPOINT_PATH = BATCH_OUTPUT_DIR / 'ajarkan_checkpoint.json'
+VERSE_CACHE_PATH = Path(__file__).parent / '.verse_cache.sqlite3'
+
+# Persistent verse-selection cache (shared across age groups and runs),
+# opened on first use
+_verse_cache = None
+
+# On-disk embedding cache (scripts/embed_cache.py), opened on first use
+_embed_cache = None
+
+# In-process hybrid search (scripts/local_search.py), loaded by --local-search
+_local_search = None
 
-# Cache: question_id → list of selected verses (shared across age groups)
-_verse_cache = {}
+# Per-API request pacing, shared by every worker thread
+_chat_bucket = pipeline.TokenBucket(CHAT_RPS, burst=CHAT_RPS)
+_search_bucket = pipeline.TokenBucket(SEARCH_RPS, burst=SEARCH_RPS)
 
 # ── HTTP Helpers ────────────────────────────────────────────────────────────
 
 def http_request(url, method="GET", headers=None, body=None, timeout=120, retries=3):
-    """Generic HTTP request with retry + exponential backoff."""
+    """JSON request over the shared connection pool (http_client.py).
+
+    429 / 5xx and connection errors are retried with exponential backoff,
+    for POSTs too — every call here is a read, an upsert or a model call."""
     data = None
     if body is not None:
         data = json.dumps(body).encode()
-    last_err = None
-    for attempt in range(retries):
-        req = urllib.request.Request(url, data=data, method=method, headers=headers or {})
-        try:
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                raw = resp.read()
-                ct = resp.headers.get("Content-Type", "")
-                if "application/json" in ct:
-                    return json.loads(raw.decode())
-                return raw
-        except urllib.error.HTTPError as e:
-            code = e.code
-            body_text = e.read().decode()[:500]
-            if code == 429 or code >= 500:
-                last_err = RuntimeError(f"HTTP {code}: {body_text}")
-                wait = 2 ** attempt * 2
-                print(f"  (retry {attempt+1}/{retries} in {wait}s: HTTP {code})", flush=True)
-                time.sleep(wait)
-                continue
-            raise RuntimeError(f"HTTP {code}: {body_text}")
-        except Exception as e:
-            last_err = RuntimeError(f"Request failed ({method} {url[:60]}): {e}")
-            wait = 2 ** attempt * 2
-            print(f"  (retry {attempt+1}/{retries} in {wait}s: {e})", flush=True)
-            time.sleep(wait)
-    raise last_err
+    policy = http_client.RetryPolicy(tries=retries, backoff=2.0,
+                                     methods=("GET", "POST", "PATCH"))
+    try:
+        with http_client.request(method, url, headers, data, timeout, policy) as resp:
+            raw = resp.read()
+            ct = resp.headers.get("Content-Type", "")
+            if "application/json" in ct:
+                return json.loads(raw.decode())
+            return raw
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"HTTP {e.code}: {e.read().decode()[:500]}")
+    except urllib.error.URLError as e:
+        raise RuntimeError(f"Request failed ({method} {url[:60]}): {e.reason}")
 
 
 def supabase_headers():
@@ -109,6 +144,7 @@ def supabase_get(path):
 
 
 def supabase_post(path, body):
+    """POST one row or a list of rows; duplicates on the conflict target are merged."""
     url = f"{SUPABASE_URL}/rest/v1/{path}"
     return http_request(url, method="POST", headers={
         **supabase_headers(),
@@ -125,6 +161,7 @@ def supabase_rpc(fn_name, body):
 
 
 def openai_chat(model, messages, temperature=0.4, max_tokens=1500, json_mode=True):
+    _chat_bucket.acquire()
     url = "https://api.openai.com/v1/chat/completions"
     body = {
         "model": model,
@@ -141,62 +178,34 @@ def openai_chat(model, messages, temperature=0.4, max_tokens=1500, json_mode=Tru
     return resp["choices"][0]["message"]["content"]
 
 
-def openai_embed(text):
+def openai_embed_batch(texts):
     url = "https://api.openai.com/v1/embeddings"
     resp = http_request(url, method="POST", headers={
         "Content-Type": "application/json",
         "Authorization": f"Bearer {OPENAI_API_KEY}",
     }, body={
         "model": EMBEDDING_MODEL,
-        "input": text,
+        "input": texts,
         "dimensions": EMBEDDING_DIMS,
         "encoding_format": "float",
     }, timeout=30)
-    return resp["data"][0]["embedding"]
-
-
-def openai_batch_request(method, path, body=None, file_upload=None):
-    """Make a request to the OpenAI API. Supports multipart file uploads."""
-    url = f"https://api.openai.com{path}"
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-
-    if file_upload:
-        boundary = "----AjarkanBatchBoundary"
-        parts = []
-        for key, val in file_upload.items():
-            if key == "file":
-                filename, filedata = val
-                parts.append(
-                    f"--{boundary}\r\n"
-                    f"Content-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
-                    f"Content-Type: application/jsonl\r\n\r\n".encode() + filedata + b"\r\n"
-                )
-            else:
-                parts.append(
-                    f"--{boundary}\r\n"
-                    f"Content-Disposition: form-data; name=\"{key}\"\r\n\r\n"
-                    f"{val}\r\n".encode()
-                )
-        data = b"".join(p if isinstance(p, bytes) else p.encode() for p in parts) + f"--{boundary}--\r\n".encode()
-        headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
-        req = urllib.request.Request(url, data=data, method=method, headers=headers)
-    elif body is not None:
-        data = json.dumps(body).encode()
-        headers["Content-Type"] = "application/json"
-        req = urllib.request.Request(url, data=data, method=method, headers=headers)
-    else:
-        req = urllib.request.Request(url, method=method, headers=headers)
+    return [item["embedding"] for item in sorted(resp["data"], key=lambda x: x["index"])]
+
+
+def embed_cache():
+    global _embed_cache
+    if _embed_cache is None:
+        _embed_cache = EmbeddingCache(EMBEDDING_MODEL, EMBEDDING_DIMS)
+    return _embed_cache
+
+
+def openai_embed(text):
+    return embed_cache().embed([text], openai_embed_batch)[0]
 
-    timeout = 600 if file_upload else 120
-    try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            raw = resp.read()
-            ct = resp.headers.get("Content-Type", "")
-            if "application/json" in ct:
-                return json.loads(raw.decode())
-            return raw
-    except urllib.error.HTTPError as e:
-        raise RuntimeError(f"OpenAI HTTP {e.code}: {e.read().decode()[:500]}")
+
+def openai_embed_many(texts):
+    """Embed many texts with one embeddings call per EMBED_BATCH (cache misses only)."""
+    return embed_cache().embed(texts, openai_embed_batch, batch_size=EMBED_BATCH)
 
 
 # ── Question Parser ─────────────────────────────────────────────────────────
@@ -315,88 +324,188 @@ PENTING:
 - Output HANYA JSON, tanpa markdown atau teks tambahan"""
 
 
+# ── Verse Selection Cache ──────────────────────────────────────────────────
+
+class VerseCache:
+    """SQLite store of selected verses, one row per question text.
+
+    The key covers everything that decides the selection apart from the
+    prompts: question text, models, embedding size, candidate count and the
+    search backend ('rpc', or 'local' for --local-search, whose BM25 text
+    ranking differs). The prompts are hashed separately; rows from other
+    prompt versions are deleted on open. With refresh=True only selections
+    made during this run are served. AJARKAN_VERSE_CACHE overrides the path.
+    """
+
+    def __init__(self, path=None, refresh=False, search='rpc'):
+        self.path = path or os.environ.get('AJARKAN_VERSE_CACHE') or VERSE_CACHE_PATH
+        self.refresh = refresh
+        self.search = search
+        self.prompt_hash = hashlib.sha256(
+            (HYDE_SYSTEM + '\0' + VERSE_SELECT_SYSTEM).encode('utf-8')).hexdigest()[:16]
+        # prompts + models + search settings, stamped on --batch-select checkpoints
+        self.version = hashlib.sha256(json.dumps(
+            [self.prompt_hash, SELECTOR_MODEL, EMBEDDING_MODEL, EMBEDDING_DIMS,
+             VECTOR_SEARCH_COUNT, search]).encode('utf-8')).hexdigest()[:16]
+        self.written = set()   # keys stored during this run
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS selections (
+              key          TEXT PRIMARY KEY,
+              question     TEXT NOT NULL,
+              prompt_hash  TEXT NOT NULL,
+              verses       TEXT NOT NULL,     -- JSON array of candidate rows
+              created_at   REAL NOT NULL
+            )""")
+        stale = self.db.execute("DELETE FROM selections WHERE prompt_hash != ?",
+                                (self.prompt_hash,)).rowcount
+        self.db.commit()
+        if stale:
+            print(f"  ↻ Verse cache: dropped {stale} selections made with an older prompt")
+
+    def key(self, question):
+        parts = [question['text'], SELECTOR_MODEL, EMBEDDING_MODEL, EMBEDDING_DIMS, VECTOR_SEARCH_COUNT,
+                 self.search]
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, question):
+        """Cached verses for question, or None. With refresh=True only entries
+        written during this run count (e.g. the other age group's selection)."""
+        if self.refresh and self.key(question) not in self.written:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT verses FROM selections WHERE key = ? AND prompt_hash = ?",
+                                  (self.key(question), self.prompt_hash)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, question, verses):
+        """Store a selection. Empty ones aren't persisted — they are usually a
+        transient parse or search failure worth retrying next run."""
+        if not verses:
+            return
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO selections (key, question, prompt_hash, verses, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (self.key(question), question['text'], self.prompt_hash,
+                 json.dumps(verses, ensure_ascii=False), time.time()))
+            self.db.commit()
+            self.written.add(self.key(question))
+
+
+def verse_cache(refresh=False, search='rpc'):
+    global _verse_cache
+    if _verse_cache is None:
+        _verse_cache = VerseCache(refresh=refresh, search=search)
+    return _verse_cache
+
+
 # ── Verse Selection Pipeline ───────────────────────────────────────────────
 
+def hyde_messages(question):
+    return [
+        {"role": "system", "content": HYDE_SYSTEM},
+        {"role": "user", "content": question['text']},
+    ]
+
+
+def selection_messages(question, candidates):
+    candidate_list = '\n'.join([
+        f"- {c['id']} ({c['surah_name']} {c['verse_number']}): {c['translation'][:100]}"
+        for c in candidates[:10]
+    ])
+    return [
+        {"role": "system", "content": VERSE_SELECT_SYSTEM},
+        {"role": "user", "content": f"Pertanyaan anak: \"{question['text']}\"\n\nKandidat ayat:\n{candidate_list}"},
+    ]
+
+
+def write_hyde(question):
+    """Step 1: hypothetical description of the verses that answer the question."""
+    return openai_chat(SELECTOR_MODEL, hyde_messages(question),
+                       temperature=0.3, max_tokens=300, json_mode=False)
+
+
+def search_candidates(question, embedding):
+    """Step 3: hybrid (vector + full-text) search via Supabase RPC, or
+    in-process with --local-search."""
+    if _local_search is not None:
+        return _local_search.hybrid(embedding, question['text'], VECTOR_SEARCH_COUNT)
+    _search_bucket.acquire()
+    return supabase_rpc("match_verses_hybrid", {
+        "query_embedding": str(embedding),
+        "query_text": question['text'],
+        "match_count": VECTOR_SEARCH_COUNT,
+    }) or []
+
+
+def hydrate_selection(question, candidates, selection_resp):
+    """Selected ids from the GPT reply → candidate rows with verse_relevance.
+    Returns [] if the reply can't be parsed."""
+    try:
+        selected = json.loads(selection_resp)["selected"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        print(f"    ⚠ Failed to parse verse selection for {question['id']}")
+        return []
+
+    selected_ids = {s['id'] for s in selected}
+    relevance_map = {s['id']: s.get('verse_relevance', '') for s in selected}
+
+    verses = []
+    for c in candidates:
+        if c['id'] in selected_ids:
+            c['verse_relevance'] = relevance_map.get(c['id'], '')
+            verses.append(c)
+    return verses
+
+
+def choose_verses(question, candidates):
+    """Step 4: GPT selects the 2-3 most relevant candidates."""
+    selection_resp = openai_chat(SELECTOR_MODEL, selection_messages(question, candidates),
+                                 temperature=0.2, max_tokens=500)
+    return hydrate_selection(question, candidates, selection_resp)
+
+
 def select_verses_for_question(question):
     """HyDE → embed → vector search → GPT select 2-3 verses."""
     qid = question['id']
 
     # Check cache
-    if qid in _verse_cache:
-        return _verse_cache[qid]
+    cached = verse_cache().get(question)
+    if cached is not None:
+        print(f"    Verses: cached ({len(cached)})", flush=True)
+        return cached
 
     # Step 1: Generate HyDE document
     print(f"    Step 1: HyDE...", end=' ', flush=True)
-    hyde_text = openai_chat(
-        SELECTOR_MODEL,
-        [
-            {"role": "system", "content": HYDE_SYSTEM},
-            {"role": "user", "content": question['text']},
-        ],
-        temperature=0.3,
-        max_tokens=300,
-        json_mode=False,
-    )
-
+    hyde_text = write_hyde(question)
     print(f"done ({len(hyde_text)} chars)", flush=True)
 
     # Step 2: Embed the HyDE document
     print(f"    Step 2: Embed...", end=' ', flush=True)
     embedding = openai_embed(hyde_text)
-
     print(f"done ({len(embedding)} dims)", flush=True)
 
     # Step 3: Vector search via Supabase RPC
     print(f"    Step 3: Vector search...", end=' ', flush=True)
-    candidates = supabase_rpc("match_verses_hybrid", {
-        "query_embedding": str(embedding),
-        "query_text": question['text'],
-        "match_count": VECTOR_SEARCH_COUNT,
-    })
-
-    print(f"done ({len(candidates) if candidates else 0} results)", flush=True)
+    candidates = search_candidates(question, embedding)
+    print(f"done ({len(candidates)} results)", flush=True)
 
     if not candidates:
         print(f"    ⚠ No verse candidates found for {qid}")
-        _verse_cache[qid] = []
         return []
 
     # Step 4: GPT selects 2-3 most relevant verses
-    candidate_list = '\n'.join([
-        f"- {c['id']} ({c['surah_name']} {c['verse_number']}): {c['translation'][:100]}"
-        for c in candidates[:10]
-    ])
-
     print(f"    Step 4: GPT select verses ({len(candidates[:10])} candidates)...", end=' ', flush=True)
-    selection_resp = openai_chat(
-        SELECTOR_MODEL,
-        [
-            {"role": "system", "content": VERSE_SELECT_SYSTEM},
-            {"role": "user", "content": f"Pertanyaan anak: \"{question['text']}\"\n\nKandidat ayat:\n{candidate_list}"},
-        ],
-        temperature=0.2,
-        max_tokens=500,
-    )
+    verses = choose_verses(question, candidates)
     print("done", flush=True)
 
-    try:
-        selected = json.loads(selection_resp)["selected"]
-    except (json.JSONDecodeError, KeyError):
-        print(f"    ⚠ Failed to parse verse selection for {qid}")
-        _verse_cache[qid] = []
-        return []
-
-    # Hydrate selected verses with full data from candidates
-    selected_ids = {s['id'] for s in selected}
-    relevance_map = {s['id']: s.get('verse_relevance', '') for s in selected}
-
-    verses = []
-    for c in candidates:
-        if c['id'] in selected_ids:
-            c['verse_relevance'] = relevance_map.get(c['id'], '')
-            verses.append(c)
-
-    _verse_cache[qid] = verses
+    verse_cache().put(question, verses)
     return verses
 
 
@@ -438,28 +547,82 @@ def generate_content(question, age_group, verses):
 
 # ── Database Operations ─────────────────────────────────────────────────────
 
-def check_existing(question_id, age_group):
-    """Check if a question+age_group pair already exists in the DB."""
-    rows = supabase_get(
-        f"ajarkan_queries?select=id&question_id=eq.{question_id}&age_group=eq.{age_group}"
-    )
-    return len(rows) > 0
+def fetch_existing_keys():
+    """All (question_id, age_group) pairs already in ajarkan_queries.
+
+    Keyset-paged on id, so the whole table costs a handful of GETs instead
+    of one lookup per pair."""
+    keys = set()
+    last_id = 0
+    while True:
+        rows = supabase_get(f"ajarkan_queries?select=id,question_id,age_group"
+                            f"&id=gt.{last_id}&order=id&limit=1000")
+        keys.update((r['question_id'], r['age_group']) for r in rows)
+        if len(rows) < 1000:
+            return keys
+        last_id = rows[-1]['id']
+
+
+def build_row(question, age_group, verses, content):
+    return {
+        'question_id': question['id'],
+        'question_text': question['text'],
+        'category': question['category'],
+        'subcategory': question['subcategory'],
+        'age_group': age_group,
+        'selected_verses': json.dumps([{
+            'surah': v.get('surah_number'),
+            'ayah': v.get('verse_number'),
+            'verse_relevance': v.get('verse_relevance', ''),
+        } for v in verses]),
+        'penjelasan_anak': content.get('penjelasan_anak', ''),
+        'pembuka_percakapan': json.dumps(content.get('pembuka_percakapan', {})),
+        'aktivitas_bersama': content.get('aktivitas_bersama', ''),
+    }
 
 
-def insert_row(row):
-    """Insert a single row into ajarkan_queries (upsert on conflict)."""
-    supabase_post("ajarkan_queries", row)
+def insert_rows(rows):
+    """Upsert rows into ajarkan_queries, INSERT_BATCH per POST.
+
+    If a bulk POST fails, its rows are retried one by one so the bad row is
+    identified. Returns (inserted, failed_custom_ids)."""
+    inserted = 0
+    failed = []
+    for start in range(0, len(rows), INSERT_BATCH):
+        chunk = rows[start:start + INSERT_BATCH]
+        try:
+            supabase_post("ajarkan_queries?on_conflict=question_id,age_group", chunk)
+            inserted += len(chunk)
+            continue
+        except Exception as e:
+            if len(chunk) == 1:
+                print(f"  ✗ {chunk[0]['question_id']}:{chunk[0]['age_group']}: {e}")
+                failed.append(f"{chunk[0]['question_id']}:{chunk[0]['age_group']}")
+                continue
+            print(f"  ⚠ Bulk insert of {len(chunk)} rows failed ({e}) — retrying row by row")
+        for row in chunk:
+            custom_id = f"{row['question_id']}:{row['age_group']}"
+            try:
+                supabase_post("ajarkan_queries?on_conflict=question_id,age_group", row)
+                inserted += 1
+            except Exception as e:
+                print(f"  ✗ {custom_id}: {e}")
+                failed.append(custom_id)
+    return inserted, failed
 
 
 # ── Main Pipeline (Synchronous) ─────────────────────────────────────────────
 
-def process_question(question, age_group, dry_run=False):
-    """Full pipeline for one question + one age group."""
+def process_question(question, age_group, existing=frozenset(), dry_run=False):
+    """Full pipeline for one question + one age group.
+
+    Returns the row to insert (the caller upserts rows in bulk), or None if
+    the pair is skipped or fails."""
     qid = question['id']
     print(f'  {qid} ({age_group})...', end=' ', flush=True)
 
     # Skip if already exists
-    if not dry_run and check_existing(qid, age_group):
+    if (qid, age_group) in existing:
         print('skip (exists)')
         return None
 
@@ -476,35 +639,15 @@ def process_question(question, age_group, dry_run=False):
         return None
 
     # Step 3: Build row
-    row = {
-        'question_id': qid,
-        'question_text': question['text'],
-        'category': question['category'],
-        'subcategory': question['subcategory'],
-        'age_group': age_group,
-        'selected_verses': json.dumps([{
-            'surah': v.get('surah_number'),
-            'ayah': v.get('verse_number'),
-            'verse_relevance': v.get('verse_relevance', ''),
-        } for v in verses]),
-        'penjelasan_anak': content['penjelasan_anak'],
-        'pembuka_percakapan': json.dumps(content['pembuka_percakapan']),
-        'aktivitas_bersama': content['aktivitas_bersama'],
-    }
+    row = build_row(question, age_group, verses, content)
 
-    # Step 4: Insert or output
     if dry_run:
         # For dry-run, use dicts instead of JSON strings
-        row['selected_verses'] = [{
-            'surah': v.get('surah_number'),
-            'ayah': v.get('verse_number'),
-            'verse_relevance': v.get('verse_relevance', ''),
-        } for v in verses]
+        row['selected_verses'] = json.loads(row['selected_verses'])
         row['pembuka_percakapan'] = content['pembuka_percakapan']
         print('✓ (dry-run)')
     else:
-        insert_row(row)
-        print('✓')
+        print('✓ (queued)')
 
     return row
 
@@ -512,149 +655,312 @@ def process_question(question, age_group, dry_run=False):
 # ── Batch Mode ──────────────────────────────────────────────────────────────
 
 def batch_select_verses(questions):
-    """Phase 2 of batch mode: HyDE + embed + vector search for all questions.
-    Must be synchronous because each step depends on the previous.
-    Returns dict of question_id → list of selected verse candidates."""
+    """Phase 2 of batch mode: verse selection for all questions, concurrently.
+
+    Stage A writes every HyDE document (SELECT_WORKERS at a time), stage B
+    embeds them all with one embeddings call per EMBED_BATCH texts, and
+    stage C runs search → GPT selection per question in parallel. Chat and
+    search calls are paced by their own token buckets (CHAT_RPS,
+    SEARCH_RPS). Returns dict of question_id → list of selected verses."""
 
-    print(f"\n── Phase 2: Verse selection (synchronous) for {len(questions)} questions ──")
+    print(f"\n── Phase 2: Verse selection for {len(questions)} questions "
+          f"({SELECT_WORKERS} in parallel) ──")
+    cache = verse_cache()
     results = {}
-    for i, q in enumerate(questions, 1):
-        qid = q['id']
-        print(f"  [{i}/{len(questions)}] {qid}...", end=' ', flush=True)
-        try:
-            verses = select_verses_for_question(q)
-            results[qid] = verses
-            print(f"✓ ({len(verses)} verses)")
-        except Exception as e:
-            print(f"✗ ({e})")
-            results[qid] = []
-        time.sleep(0.3)
+    for q in questions:
+        cached = cache.get(q)
+        if cached is not None:
+            results[q['id']] = cached
+    todo = [q for q in questions if q['id'] not in results]
+    if results:
+        print(f"  ✓ {len(results)} selections from the verse cache")
+
+    def report(stage):
+        def on_result(i, q, result, error):
+            if error:
+                print(f"  ✗ {stage} {q['id']}: {error}", flush=True)
+                results[q['id']] = []
+        return on_result
+
+    # Stage A: HyDE
+    hyde = pipeline.run_ordered(todo, write_hyde, workers=SELECT_WORKERS,
+                                retries=1, on_result=report("HyDE"))
+    todo = [(q, text) for q, (text, error) in zip(todo, hyde) if not error]
+    print(f"  ✓ HyDE: {len(todo)} documents")
+
+    # Stage B: embeddings, batched across questions
+    try:
+        embeddings = openai_embed_many([text for _, text in todo]) if todo else []
+    except Exception as e:
+        print(f"  ✗ Embedding failed: {e}")
+        embeddings = []
+        for q, _ in todo:
+            results[q['id']] = []
+        todo = []
+    print(f"  ✓ Embedded {len(embeddings)} documents ({embed_cache().summary()})")
+
+    # Stage C: search → select, one chain per question
+    def search_and_choose(item):
+        q, embedding = item
+        candidates = search_candidates(q, embedding)
+        if not candidates:
+            print(f"    ⚠ No verse candidates found for {q['id']}")
+            return []
+        return choose_verses(q, candidates)
+
+    def on_selected(i, item, verses, error):
+        q = item[0]
+        if error:
+            print(f"  ✗ select {q['id']}: {error}", flush=True)
+            verses = []
+        else:
+            cache.put(q, verses)
+        results[q['id']] = verses
+        print(f"  [{len(results)}/{len(questions)}] {q['id']} ✓ ({len(verses)} verses)", flush=True)
+
+    pipeline.run_ordered([(q, e) for (q, _), e in zip(todo, embeddings)], search_and_choose,
+                         workers=SELECT_WORKERS, retries=1, on_result=on_selected)
 
     found = sum(1 for v in results.values() if v)
     print(f"  ✓ Found verses for {found}/{len(questions)} questions\n")
     return results
 
 
-def batch_generate_content(questions, verse_map):
-    """Phase 3 of batch mode: use OpenAI Batch API for content generation."""
-
-    # Build JSONL for all question × age group pairs
-    print("── Phase 3: Building JSONL for content generation ─────────────────────")
-    lines = []
-    pairs = []  # Track (qid, age_group) in order
-
-    for q in questions:
-        qid = q['id']
-        verses = verse_map.get(qid, [])
-        if not verses:
-            continue
-        for age in AGE_GROUPS:
-            custom_id = f"{qid}:{age}"
-            prompt = get_generation_prompt(q, age, verses)
-            request_obj = {
-                "custom_id": custom_id,
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": CONTENT_MODEL,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "response_format": {"type": "json_object"},
-                    "temperature": 0.5,
-                    "max_tokens": 1200,
-                },
-            }
-            lines.append(json.dumps(request_obj, ensure_ascii=False))
-            pairs.append((qid, age))
-
-    if not lines:
-        print("  No valid pairs to process.")
-        return {}
-
-    jsonl_content = "\n".join(lines)
-    jsonl_bytes = jsonl_content.encode("utf-8")
-
-    # Save JSONL
-    BATCH_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    timestamp = time.strftime("%Y%m%d_%H%M%S")
-    jsonl_path = BATCH_OUTPUT_DIR / f"ajarkan_request_{timestamp}.jsonl"
-    jsonl_path.write_text(jsonl_content, encoding="utf-8")
-    print(f"  ✓ Built {len(lines)} requests → {jsonl_path}")
-
-    # Upload file
-    print("  Uploading JSONL file …", end=" ", flush=True)
-    upload_resp = openai_batch_request("POST", "/v1/files", file_upload={
-        "purpose": "batch",
-        "file": ("ajarkan_request.jsonl", jsonl_bytes),
-    })
-    file_id = upload_resp["id"]
-    print(f"✓ file_id={file_id}")
-
-    # Create batch
-    print("  Creating batch …", end=" ", flush=True)
-    batch_resp = openai_batch_request("POST", "/v1/batches", body={
-        "input_file_id": file_id,
-        "endpoint": "/v1/chat/completions",
-        "completion_window": "24h",
-    })
-    batch_id = batch_resp["id"]
-    print(f"✓ batch_id={batch_id}")
-
-    # Poll
-    print(f"  Polling every {POLL_INTERVAL}s …")
-    while True:
-        status_resp = openai_batch_request("GET", f"/v1/batches/{batch_id}")
-        status = status_resp["status"]
-        completed = status_resp.get("request_counts", {}).get("completed", 0)
-        total = status_resp.get("request_counts", {}).get("total", 0)
-        failed = status_resp.get("request_counts", {}).get("failed", 0)
-        print(f"    status={status}  completed={completed}/{total}  failed={failed}", flush=True)
-
-        if status == "completed":
-            output_file_id = status_resp.get("output_file_id")
-            print(f"  ✓ Batch completed! output_file_id={output_file_id}")
-            break
-        elif status in ("failed", "expired", "cancelled", "cancelling"):
-            raise RuntimeError(f"Batch {batch_id} ended with status: {status}")
-        time.sleep(POLL_INTERVAL)
-
-    # Download results
-    print("  Downloading results …", end=" ", flush=True)
-    raw = openai_batch_request("GET", f"/v1/files/{output_file_id}/content")
-    result_path = BATCH_OUTPUT_DIR / f"ajarkan_result_{timestamp}.jsonl"
-    result_path.write_bytes(raw)
-    print(f"✓ → {result_path}")
-
-    # Parse results into dict keyed by custom_id
-    content_map = {}
-    for line in raw.decode("utf-8").strip().split("\n"):
-        if not line.strip():
-            continue
-        obj = json.loads(line)
+def parse_chat_results(objs, as_json=True):
+    """Batch output lines (parsed JSON objects) → dict of custom_id → reply
+    (parsed JSON, or the raw text if as_json is False)."""
+    results = {}
+    for obj in objs:
         custom_id = obj["custom_id"]
         response = obj.get("response", {})
         if response.get("status_code") == 200:
             try:
                 text = response["body"]["choices"][0]["message"]["content"]
-                content_map[custom_id] = json.loads(text)
+                results[custom_id] = json.loads(text) if as_json else text
             except (KeyError, IndexError, json.JSONDecodeError) as e:
                 print(f"  ⚠ Parse error for {custom_id}: {e}")
         else:
             print(f"  ⚠ HTTP error for {custom_id}: {response.get('status_code')}")
+    return results
+
 
-    ok = sum(1 for v in content_map.values() if v)
-    print(f"  ✓ Parsed {ok}/{len(lines)} results\n")
-    return content_map
+def collect_batch(ledger, batch_id, timestamp, prefix, as_json=True):
+    """Poll a batch to completion, save and parse its output."""
+    print(f"  Polling every {POLL_INTERVAL}s …")
+    status_resp = openai_batch.wait(batch_id, ledger, POLL_INTERVAL)
+    if status_resp["status"] != "completed":
+        raise RuntimeError(f"Batch {batch_id} ended with status: {status_resp['status']}")
+    output_file_id = status_resp.get("output_file_id")
+    print(f"  ✓ Batch completed! output_file_id={output_file_id}")
+
+    result_path = BATCH_OUTPUT_DIR / f"{prefix}_result_{timestamp}.jsonl"
+    print(f"  Streaming results → {result_path}")
+    return parse_chat_results(openai_batch.stream_results(output_file_id, result_path), as_json)
+
+
+def run_chat_batch(ledger, job, title, requests, as_json=True):
+    """Run one Batch API stage: requests is a list of (custom_id, body).
+
+    Outstanding ledger batches for `job` that hold any wanted request are
+    resumed first, keeping only the wanted results; only the rest are
+    submitted. Returns (results, batch_ids) — results maps custom_id → reply;
+    the caller marks batch_ids applied."""
+    wanted = {cid for cid, _ in requests}
+    results = {}
+    batch_ids = []
+    BATCH_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    for job_row in ledger.outstanding(job):
+        overlap = wanted.intersection(job_row["custom_ids"])
+        if not overlap:
+            continue
+        print(f"── {title}: resuming batch {job_row['batch_id']} "
+              f"({len(overlap)}/{len(job_row['custom_ids'])} requests still wanted) ──")
+        try:
+            replies = collect_batch(ledger, job_row["batch_id"],
+                                    time.strftime("%Y%m%d_%H%M%S"), job, as_json)
+            results.update((cid, reply) for cid, reply in replies.items() if cid in wanted)
+            batch_ids.append(job_row["batch_id"])
+        except Exception as e:
+            print(f"  ✗ {e}")
+
+    # Requests in an upload whose batch could not be created yet wait for it
+    unsubmitted = ledger.unsubmitted_ids(job)
+    todo = [(cid, body) for cid, body in requests
+            if cid not in results and cid not in unsubmitted]
+    print(f"── {title}: building JSONL ({len(todo)} requests) ──")
+    if not todo:
+        print("  No new requests to process.")
+        return results, batch_ids
+
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    jsonl_path = BATCH_OUTPUT_DIR / f"{job}_request_{timestamp}.jsonl"
+    n, size = openai_batch.write_jsonl(jsonl_path, (
+        {"custom_id": cid, "method": "POST", "url": "/v1/chat/completions", "body": body}
+        for cid, body in todo))
+    print(f"  ✓ Built {n} requests ({size / 1_048_576:.1f} MB) → {jsonl_path}")
+
+    batch_id = openai_batch.submit(ledger, job, jsonl_path, [cid for cid, _ in todo])
+    fresh = collect_batch(ledger, batch_id, timestamp, job, as_json)
+    results.update(fresh)
+    batch_ids.append(batch_id)
+    print(f"  ✓ Parsed {sum(1 for v in fresh.values() if v)}/{n} results\n")
+    return results, batch_ids
+
+
+# ── Batch-priced verse selection (--batch-select) ──────────────────────────
+
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_checkpoint(checkpoint):
+    BATCH_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = CHECKPOINT_PATH.with_suffix('.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp, CHECKPOINT_PATH)
+
+
+def checkpointed(checkpoint, stage, question):
+    """Saved value of `stage` for question, or None if missing or made for a
+    different question text / prompt / model (VerseCache.version)."""
+    entry = checkpoint.get(stage, {}).get(question['id'])
+    if (entry and entry.get('text') == question['text']
+            and entry.get('version') == verse_cache().version):
+        return entry['value']
+    return None
+
+
+def store_checkpoint(checkpoint, stage, question, value):
+    checkpoint.setdefault(stage, {})[question['id']] = {
+        'text': question['text'], 'version': verse_cache().version, 'value': value}
+
+
+def batch_api_select_verses(questions, ledger):
+    """Phase 2 of --batch-select: verse selection entirely at batch pricing.
+
+    HyDE batch → bulk embeddings → hybrid search → selection batch, with each
+    stage's output checkpointed before the next starts. Returns dict of
+    question_id → list of selected verses."""
+    cache = verse_cache()
+    checkpoint = {} if cache.refresh else load_checkpoint()
+    by_id = {q['id']: q for q in questions}
+
+    # Questions already solved in an earlier run skip every stage
+    results = {}
+    for q in questions:
+        cached = cache.get(q)
+        if cached is not None:
+            results[q['id']] = cached
+    if results:
+        print(f"  ✓ {len(results)} selections from the verse cache")
+    questions = [q for q in questions if q['id'] not in results]
+
+    # Stage 1: HyDE batch
+    need = [q for q in questions if checkpointed(checkpoint, 'hyde', q) is None]
+    if need:
+        hyde, batch_ids = run_chat_batch(ledger, HYDE_JOB, 'Phase 2a: HyDE batch', [
+            (q['id'], {"model": SELECTOR_MODEL, "messages": hyde_messages(q),
+                       "temperature": 0.3, "max_tokens": 300})
+            for q in need], as_json=False)
+        for qid, text in hyde.items():
+            if qid in by_id:
+                store_checkpoint(checkpoint, 'hyde', by_id[qid], text)
+        save_checkpoint(checkpoint)
+        for batch_id in batch_ids:
+            ledger.mark_applied(batch_id)
+    hyde = {q['id']: checkpointed(checkpoint, 'hyde', q) for q in questions}
+    hyde = {qid: text for qid, text in hyde.items() if text}
+    print(f"  ✓ HyDE documents: {len(hyde)}/{len(questions)}")
+
+    # Stages 2 + 3: embeddings (one call per EMBED_BATCH) → hybrid search
+    need = [q for q in questions if q['id'] in hyde
+            and checkpointed(checkpoint, 'candidates', q) is None]
+    if need:
+        print(f"── Phase 2b: Embedding + searching {len(need)} questions ──")
+        embeddings = openai_embed_many([hyde[q['id']] for q in need])
+        found = pipeline.run_ordered(list(zip(need, embeddings)),
+                                     lambda item: search_candidates(*item),
+                                     workers=SELECT_WORKERS, retries=1)
+        for q, (candidates, error) in zip(need, found):
+            if error:
+                print(f"  ✗ search {q['id']}: {error}")
+            else:
+                store_checkpoint(checkpoint, 'candidates', q, candidates)
+        save_checkpoint(checkpoint)
+    candidates = {q['id']: checkpointed(checkpoint, 'candidates', q) for q in questions}
+    candidates = {qid: c for qid, c in candidates.items() if c}
+    print(f"  ✓ Candidates for {len(candidates)}/{len(questions)} questions")
+
+    # Stage 4: selection batch
+    need = [q for q in questions if q['id'] in candidates
+            and checkpointed(checkpoint, 'selection', q) is None]
+    if need:
+        replies, batch_ids = run_chat_batch(ledger, SELECT_JOB, 'Phase 2c: Selection batch', [
+            (q['id'], {"model": SELECTOR_MODEL,
+                       "messages": selection_messages(q, candidates[q['id']]),
+                       "response_format": {"type": "json_object"},
+                       "temperature": 0.2, "max_tokens": 500})
+            for q in need], as_json=False)
+        for qid, reply in replies.items():
+            if qid in by_id:
+                q = by_id[qid]
+                store_checkpoint(checkpoint, 'selection', q,
+                                 hydrate_selection(q, candidates[qid], reply))
+        save_checkpoint(checkpoint)
+        for batch_id in batch_ids:
+            ledger.mark_applied(batch_id)
+
+    for q in questions:
+        verses = checkpointed(checkpoint, 'selection', q) or []
+        cache.put(q, verses)
+        results[q['id']] = verses
+    found = sum(1 for v in results.values() if v)
+    print(f"  ✓ Found verses for {found}/{len(results)} questions\n")
+    return results
+
+
+def batch_generate_content(questions, verse_map, ledger, existing=frozenset()):
+    """Phase 3 of batch mode: use OpenAI Batch API for content generation.
+    Pairs already in `existing` are not requested again.
+
+    Returns (content_map, batch_ids). The caller marks the batches applied in
+    the ledger once their rows are inserted."""
+    requests = [
+        (f"{q['id']}:{age}", {
+            "model": CONTENT_MODEL,
+            "messages": [{"role": "user", "content": get_generation_prompt(q, age, verse_map[q['id']])}],
+            "response_format": {"type": "json_object"},
+            "temperature": 0.5,
+            "max_tokens": 1200,
+        })
+        for q in questions if verse_map.get(q['id']) for age in AGE_GROUPS
+        if (q['id'], age) not in existing
+    ]
+    return run_chat_batch(ledger, BATCH_JOB, 'Phase 3: Content batch', requests)
 
 
 # ── Main ────────────────────────────────────────────────────────────────────
 
 def main():
+    global _local_search
     parser = argparse.ArgumentParser(description='Seed ajarkan_queries table')
     parser.add_argument('--test', action='store_true', help='Test mode: 3 questions only')
     parser.add_argument('--dry-run', action='store_true', help='Output to JSON instead of DB')
     parser.add_argument('--question-id', type=str, help='Re-run single question ID')
     parser.add_argument('--category', type=str, help='Run only one category slug')
     parser.add_argument('--batch', action='store_true', help='Use OpenAI Batch API (cheaper)')
+    parser.add_argument('--batch-select', action='store_true',
+                        help='With --batch: run HyDE and verse selection as batches too')
+    parser.add_argument('--refresh-verses', action='store_true',
+                        help='Ignore cached verse selections and select again')
+    parser.add_argument('--local-search', action='store_true',
+                        help='Search verses in-process (local_search.py) instead of the RPC')
     parser.add_argument('--questions-file', type=str,
                         default='ajarkan-325-questions-clean.md',
                         help='Path to questions markdown file')
@@ -685,6 +991,12 @@ def main():
         sys.exit(1)
 
     questions = parse_questions_file(questions_path)
+    if args.local_search:
+        import local_search
+        t0 = time.time()
+        _local_search, source = local_search.load()
+        print(f'  ✓ Local search: {len(_local_search)} verses from {source} in {time.time() - t0:.1f}s')
+    verse_cache(refresh=args.refresh_verses, search='local' if args.local_search else 'rpc')
     print(f'\n── Phase 1: Parsed {len(questions)} questions from {questions_path.name} ──')
 
     # Filter
@@ -706,15 +1018,23 @@ def main():
 
     if args.batch and not args.dry_run:
         # ── Batch API path ──────────────────────────────────────────────
-        # Phase 2: Verse selection (synchronous — needs embed + vector search)
-        verse_map = batch_select_verses(questions)
+        ledger = openai_batch.Ledger()
+        existing = fetch_existing_keys()
+        print(f"  {len(existing)} question × age rows already in ajarkan_queries")
+
+        # Phase 2: Verse selection — batch-priced stages, or concurrent
+        # HyDE / embed / search / select
+        if args.batch_select:
+            verse_map = batch_api_select_verses(questions, ledger)
+        else:
+            verse_map = batch_select_verses(questions)
 
         # Phase 3: Content generation (batch API)
-        content_map = batch_generate_content(questions, verse_map)
+        content_map, batch_ids = batch_generate_content(questions, verse_map, ledger, existing)
 
         # Phase 4: Insert into DB
         print("── Phase 4: Inserting into Supabase ──────────────────────────────────")
-        inserted = 0
+        rows = []
         skipped = 0
         failed = 0
 
@@ -726,41 +1046,20 @@ def main():
                 continue
 
             for age in AGE_GROUPS:
-                custom_id = f"{qid}:{age}"
-                content = content_map.get(custom_id)
-                if not content:
-                    failed += 1
-                    continue
-
-                # Check if exists
-                if check_existing(qid, age):
+                if (qid, age) in existing:
                     skipped += 1
                     continue
-
-                row = {
-                    'question_id': qid,
-                    'question_text': q['text'],
-                    'category': q['category'],
-                    'subcategory': q['subcategory'],
-                    'age_group': age,
-                    'selected_verses': json.dumps([{
-                        'surah': v.get('surah_number'),
-                        'ayah': v.get('verse_number'),
-                        'verse_relevance': v.get('verse_relevance', ''),
-                    } for v in verses]),
-                    'penjelasan_anak': content.get('penjelasan_anak', ''),
-                    'pembuka_percakapan': json.dumps(content.get('pembuka_percakapan', {})),
-                    'aktivitas_bersama': content.get('aktivitas_bersama', ''),
-                }
-
-                try:
-                    insert_row(row)
-                    inserted += 1
-                except Exception as e:
-                    print(f"  ✗ {custom_id}: {e}")
+                content = content_map.get(f"{qid}:{age}")
+                if not content:
                     failed += 1
+                    continue
+                rows.append(build_row(q, age, verses, content))
 
+        inserted, failed_ids = insert_rows(rows)
+        failed += len(failed_ids)
         print(f"  ✓ Inserted: {inserted}  Skipped: {skipped}  Failed: {failed}")
+        for batch_id in batch_ids:
+            ledger.mark_applied(batch_id)
 
     else:
         # ── Synchronous path ────────────────────────────────────────────
@@ -771,14 +1070,27 @@ def main():
         failed = 0
 
         failed_ids = []
+        pending = []
+        existing = set() if args.dry_run else fetch_existing_keys()
+
+        def flush():
+            nonlocal succeeded, failed
+            inserted, bad = insert_rows(pending)
+            succeeded += inserted
+            failed += len(bad)
+            failed_ids.extend(bad)
+            pending.clear()
+
         for i, q in enumerate(questions, 1):
             print(f'\n[{i}/{len(questions)}] {q["text"][:60]}...')
             for age in AGE_GROUPS:
                 try:
-                    result = process_question(q, age, dry_run=args.dry_run)
-                    if result:
+                    result = process_question(q, age, existing, dry_run=args.dry_run)
+                    if result and args.dry_run:
                         results.append(result)
                         succeeded += 1
+                    elif result:
+                        pending.append(result)
                     elif result is None:
                         skipped += 1
                     else:
@@ -789,6 +1101,10 @@ def main():
                     failed += 1
                     failed_ids.append(f"{q['id']}:{age}")
                 time.sleep(0.5)  # Rate limit courtesy
+            if len(pending) >= SYNC_FLUSH:
+                flush()
+        if pending:
+            flush()
 
         # Output
         if args.dry_run:
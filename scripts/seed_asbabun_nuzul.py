@@ -14,11 +14,12 @@ Usage:
   python3 scripts/seed_asbabun_nuzul.py
 """
 
-import os, sys, json, time
+import os, sys, time
 from pathlib import Path
-from urllib.request import urlopen, Request
 from urllib.error import HTTPError, URLError
 
+import http_cache, supabase_rest
+
 # ── Load env ──────────────────────────────────────────────────────────────────
 env_path = Path(__file__).parent.parent / ".env"
 if env_path.exists():
@@ -30,13 +31,6 @@ if env_path.exists():
 SUPABASE_URL = os.environ["SUPABASE_URL"].rstrip("/")
 SERVICE_KEY  = os.environ["SUPABASE_SERVICE_KEY"]
 
-SB_HEADERS = {
-    "apikey":        SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type":  "application/json",
-    "Prefer":        "return=minimal",
-}
-
 BASE_URL = "https://raw.githubusercontent.com/spa5k/tafsir_api/main/tafsir/en-asbab-al-nuzul-by-al-wahidi"
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
@@ -44,9 +38,7 @@ def fetch_json(url: str, retries: int = 3):
     """Fetch JSON from URL. Returns None on 404."""
     for attempt in range(retries):
         try:
-            req = Request(url, headers={"Accept": "application/json"})
-            with urlopen(req, timeout=15) as r:
-                return json.loads(r.read().decode())
+            return http_cache.fetch_json(url, {"Accept": "application/json"}, timeout=15)
         except HTTPError as e:
             if e.code == 404:
                 return None
@@ -60,25 +52,9 @@ def fetch_json(url: str, retries: int = 3):
             else:
                 raise
 
-def sb_get(path: str) -> list:
-    req = Request(f"{SUPABASE_URL}/rest/v1/{path}",
-                  headers={**SB_HEADERS, "Accept": "application/json"})
-    with urlopen(req, timeout=30) as r:
-        return json.loads(r.read().decode())
-
-def sb_patch(verse_id: str, text: str):
-    payload = json.dumps({"asbabun_nuzul": text}).encode()
-    req = Request(
-        f"{SUPABASE_URL}/rest/v1/quran_verses?id=eq.{verse_id}",
-        data=payload, method="PATCH", headers=SB_HEADERS,
-    )
-    with urlopen(req, timeout=15) as r:
-        r.read()
-
 # ── Phase 1: Check existing ──────────────────────────────────────────────────
 print("\n── Phase 1: Checking which verses already have asbabun nuzul ─────────────────")
-existing = sb_get("quran_verses?select=id&asbabun_nuzul=not.is.null")
-done_ids = {r["id"] for r in existing}
+done_ids = {r["id"] for r in supabase_rest.scan_verses("id", ["asbabun_nuzul=not.is.null"])}
 print(f"  Already populated: {len(done_ids)}")
 
 # ── Phase 2: Fetch from spa5k API ────────────────────────────────────────────
@@ -89,8 +65,9 @@ total_skipped = 0
 total_failed  = 0
 
 for surah_num in range(1, 115):
-    url  = f"{BASE_URL}/{surah_num}.json"
-    data = fetch_json(url)
+    url    = f"{BASE_URL}/{surah_num}.json"
+    polite = not http_cache.cached(url)
+    data   = fetch_json(url)
 
     if data is None:
         # Surah file doesn't exist (surahs 78-114 mostly)
@@ -101,7 +78,7 @@ for surah_num in range(1, 115):
         # Surah file exists but has no data
         continue
 
-    count = 0
+    rows = []
     for entry in ayahs:
         ayah_num = entry.get("ayah")
         text     = entry.get("text", "").strip()
@@ -115,19 +92,23 @@ for surah_num in range(1, 115):
             total_skipped += 1
             continue
 
+        rows.append((verse_id, text))
+
+    count = 0
+    if rows:
         try:
-            sb_patch(verse_id, text)
-            total_updated += 1
-            count += 1
+            count = supabase_rest.update_column("asbabun_nuzul", rows)
+            total_updated += count
         except Exception as e:
-            print(f"  ✗ PATCH {verse_id}: {e}")
-            total_failed += 1
+            print(f"  ✗ Surah {surah_num}: bulk update of {len(rows)} rows failed — {e}")
+            total_failed += len(rows)
 
     if count > 0:
         print(f"  Surah {surah_num:>3}: {count} verses updated")
 
     # Small delay between surah requests
-    time.sleep(0.2)
+    if polite:
+        time.sleep(0.2)
 
 print(f"\n── Summary ──────────────────────────────────────────────────────────────────")
 print(f"  Total entries found: {total_fetched}")
@@ -1,21 +1,41 @@
 #!/usr/bin/env python3
 """
 Seed tafsir_ibnu_kathir from quran.com API (Tafsir ID 169 - Ibn Kathir Abridged, English).
-Fetches one verse at a time, strips HTML, stores in Supabase.
-Resumable: skips verses that already have content.
+Fetches concurrently under an AIMD window (widens while quran.com answers,
+halves on 429/5xx), strips HTML and bulk-flushes results to Supabase as they
+arrive. Resumable: skips verses that already have content.
+
+Modes:
+  chapter (default) — /tafsirs/169/by_chapter/{surah}, paginated. A verse
+      whose text is empty or identical to the previous verse belongs to the
+      previous verse's passage; each passage is stored once in
+      tafsir_ibnu_kathir_passages and copied to its verses server-side
+      (migration 014). ~120 requests instead of 6,236.
+  ayah — /tafsirs/169/by_ayah/{s}:{v}, one request per verse; passages are
+      then grouped server-side with rebuild_ibnu_kathir_passages().
+
+Usage:
+  python3 scripts/seed_ibnu_kathir.py
+  python3 scripts/seed_ibnu_kathir.py --mode ayah
 """
 
-import os, sys, time, re, json
+import os, sys, re, argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from urllib.request import urlopen, Request
-from urllib.error import URLError
+from urllib.error import HTTPError
+
+import http_cache, pipeline, supabase_rest
 
 # ── Config ────────────────────────────────────────────────────────────────────
-SUPABASE_URL = os.environ.get("SUPABASE_URL", "").rstrip("/")
-SERVICE_KEY  = os.environ.get("SUPABASE_SERVICE_KEY", "")
-TAFSIR_ID    = 169          # Ibn Kathir Abridged, English — quran.com
-DELAY        = 0.35         # seconds between quran.com requests (polite rate limit)
-BATCH_SIZE   = 50           # rows per Supabase PATCH batch
+SUPABASE_URL  = os.environ.get("SUPABASE_URL", "").rstrip("/")
+SERVICE_KEY   = os.environ.get("SUPABASE_SERVICE_KEY", "")
+TAFSIR_ID     = 169          # Ibn Kathir Abridged, English — quran.com
+START_CONC    = 2            # initial concurrent quran.com requests
+MAX_CONC      = 12           # AIMD ceiling
+FETCH_TRIES   = 6            # attempts per request (throttled attempts included)
+BATCH_SIZE    = 200          # rows per bulk update RPC call
+CHAPTER_PAGE  = 50           # verses per by_chapter page
+PASSAGE_BATCH = 50           # passages per upsert_ibnu_kathir_passages call
 
 if not SUPABASE_URL or not SERVICE_KEY:
     env_path = Path(__file__).parent.parent / ".env"
@@ -30,13 +50,6 @@ if not SUPABASE_URL or not SERVICE_KEY:
 assert SUPABASE_URL, "SUPABASE_URL not set"
 assert SERVICE_KEY,  "SUPABASE_SERVICE_KEY not set"
 
-HEADERS_SB = {
-    "apikey":        SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type":  "application/json",
-    "Prefer":        "return=minimal",
-}
-
 # ── Helpers ───────────────────────────────────────────────────────────────────
 def strip_html(text: str) -> str:
     """Remove HTML tags and decode basic entities."""
@@ -53,34 +66,45 @@ QURAN_COM_HEADERS = {
     "Referer":    "https://quran.com/",
 }
 
-def fetch_json(url: str, retries: int = 3) -> dict:
-    for attempt in range(retries):
-        try:
-            req = Request(url, headers=QURAN_COM_HEADERS)
-            with urlopen(req, timeout=15) as r:
-                return json.loads(r.read().decode())
-        except Exception as e:
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-            else:
-                raise
-
-def sb_get(path: str) -> list:
-    req = Request(f"{SUPABASE_URL}/rest/v1/{path}",
-                  headers={**HEADERS_SB, "Accept": "application/json"})
-    with urlopen(req, timeout=30) as r:
-        return json.loads(r.read().decode())
-
-def sb_patch(verse_id: str, text: str):
-    payload = json.dumps({"tafsir_ibnu_kathir": text}).encode()
-    req = Request(
-        f"{SUPABASE_URL}/rest/v1/quran_verses?id=eq.{verse_id}",
-        data=payload,
-        method="PATCH",
-        headers=HEADERS_SB,
-    )
-    with urlopen(req, timeout=15) as r:
-        r.read()
+def fetch_json(url: str) -> dict:
+    """Single attempt; 429/5xx become pipeline.Throttled so the window shrinks."""
+    try:
+        return http_cache.fetch_json(url, QURAN_COM_HEADERS, timeout=15)
+    except HTTPError as e:
+        if e.code == 429 or e.code >= 500:
+            retry_after = e.headers.get("Retry-After", "")
+            raise pipeline.Throttled(f"HTTP {e.code}",
+                                     float(retry_after) if retry_after.isdigit() else None)
+        raise
+
+def fetch_verse(item):
+    surah, verse, vid = item
+    data = fetch_json(f"https://api.quran.com/api/v4/tafsirs/{TAFSIR_ID}/by_ayah/{surah}:{verse}")
+    raw  = data.get("tafsir", {}).get("text", "") or ""
+    return strip_html(raw).strip() or None
+
+def fetch_chapter(surah):
+    """All by_chapter pages of one surah → [(verse_number, text), ...]."""
+    rows, page = [], 1
+    while page:
+        data = fetch_json(f"https://api.quran.com/api/v4/tafsirs/{TAFSIR_ID}/by_chapter/{surah}"
+                          f"?page={page}&per_page={CHAPTER_PAGE}")
+        for t in data.get("tafsirs", []):
+            verse = int(t["verse_key"].split(":")[1])
+            rows.append((verse, strip_html(t.get("text") or "").strip()))
+        page = (data.get("pagination") or {}).get("next_page")
+    return rows
+
+def group_passages(surah, rows):
+    """Collapse runs of verses whose text is empty or repeats the previous one."""
+    passages = []
+    for verse, text in sorted(rows):
+        prev = passages[-1] if passages else None
+        if prev and verse == prev["last"] + 1 and (not text or text == prev["text"]):
+            prev["last"] = verse
+        elif text:
+            passages.append({"surah": surah, "first": verse, "last": verse, "text": text})
+    return passages
 
 # ── Surah verse counts (standard) ────────────────────────────────────────────
 SURAH_LENGTHS = [
@@ -92,10 +116,15 @@ SURAH_LENGTHS = [
     8,11,11,8,3,9,5,4,7,3,6,3,5,4,5,6,
 ]
 
+# ── Args ──────────────────────────────────────────────────────────────────────
+parser = argparse.ArgumentParser()
+parser.add_argument("--mode", choices=("chapter", "ayah"), default="chapter",
+                    help="fetch by_chapter pages (default) or one request per verse")
+args = parser.parse_args()
+
 # ── Phase 1: find verses still needing tafsir_ibnu_kathir ─────────────────────
 print("\n── Phase 1: Checking which verses need Ibnu Kathir tafsir ──────────────────")
-existing = sb_get("quran_verses?select=id&tafsir_ibnu_kathir=not.is.null")
-done_ids = {r["id"] for r in existing}
+done_ids = {r["id"] for r in supabase_rest.scan_verses("id", ["tafsir_ibnu_kathir=not.is.null"])}
 print(f"  Already populated: {len(done_ids)} / 6236")
 
 # Build list of all verse IDs
@@ -112,46 +141,88 @@ if not todo:
     print("  ✓ All verses already have Ibnu Kathir tafsir. Nothing to do.")
     sys.exit(0)
 
-# ── Phase 2: Fetch from quran.com and update Supabase ────────────────────────
-print("── Phase 2: Fetching from quran.com & updating Supabase ────────────────────")
-
-total   = len(todo)
-batch   = []
-updated = 0
+window  = pipeline.AIMDWindow(start=START_CONC, ceiling=MAX_CONC)
+writer  = ThreadPoolExecutor(max_workers=1)   # Supabase writes overlap with fetching
+flushes = []
 failed  = 0
 
-for i, (surah, verse, vid) in enumerate(todo, 1):
+def write_verses(rows):
+    """Runs on the writer thread; returns (updated, failed)."""
     try:
-        url  = f"https://api.quran.com/api/v4/tafsirs/{TAFSIR_ID}/by_ayah/{surah}:{verse}"
-        data = fetch_json(url)
-        raw  = data.get("tafsir", {}).get("text", "") or ""
-        text = strip_html(raw).strip()
-        if not text:
-            text = None
-        batch.append((vid, text))
+        return supabase_rest.update_column("tafsir_ibnu_kathir", rows), 0
     except Exception as e:
-        print(f"  ✗ {vid}: fetch failed — {e}")
-        failed += 1
-        batch.append((vid, None))
-
-    # Flush batch to Supabase
-    if len(batch) >= BATCH_SIZE or i == total:
-        flush_n = len(batch)
-        sys.stdout.write(f"\r  {i}/{total} fetched, flushing {flush_n} to Supabase …")
+        print(f"\n  ✗ Bulk update of {len(rows)} rows failed: {e}")
+        return 0, len(rows)
+
+def write_passages(passages):
+    """Runs on the writer thread; returns (verses updated, verses failed)."""
+    updated = 0
+    for start in range(0, len(passages), PASSAGE_BATCH):
+        chunk = passages[start : start + PASSAGE_BATCH]
+        try:
+            updated += supabase_rest.rpc("upsert_ibnu_kathir_passages", {"passages": chunk}) or 0
+        except Exception as e:
+            lost = sum(p["last"] - p["first"] + 1 for p in chunk)
+            print(f"\n  ✗ Upsert of {len(chunk)} passages ({lost} verses) failed: {e}")
+            return updated, lost
+    return updated, 0
+
+# ── Phase 2: Fetch from quran.com and update Supabase ────────────────────────
+print(f"── Phase 2: Fetching from quran.com ({args.mode} mode) & updating Supabase ───")
+
+if args.mode == "chapter":
+    surahs   = sorted({s for s, _, _ in todo})
+    total    = len(surahs)
+    fetched  = 0
+    passages = 0
+
+    def on_chapter(i, surah, rows, error):
+        global fetched, failed, passages
+        fetched += 1
+        if error:
+            print(f"\n  ✗ Surah {surah}: fetch failed — {error}")
+            failed += SURAH_LENGTHS[surah - 1]
+        else:
+            grouped   = group_passages(surah, rows)
+            passages += len(grouped)
+            flushes.append(writer.submit(write_passages, grouped))
+        sys.stdout.write(f"\r  {fetched}/{total} surahs, {passages} passages, "
+                         f"concurrency {window.limit:4.1f} …")
+        sys.stdout.flush()
+
+    pipeline.run_adaptive(surahs, fetch_chapter, window, retries=FETCH_TRIES, on_result=on_chapter)
+else:
+    total   = len(todo)
+    batch   = []
+    fetched = 0
+
+    def on_verse(i, item, text, error):
+        global batch, fetched, failed
+        fetched += 1
+        if error:
+            print(f"\n  ✗ {item[2]}: fetch failed — {error}")
+            failed += 1
+        elif text:
+            batch.append((item[2], text))
+        if len(batch) >= BATCH_SIZE:
+            flushes.append(writer.submit(write_verses, batch))
+            batch = []
+        sys.stdout.write(f"\r  {fetched}/{total} fetched, concurrency {window.limit:4.1f} …")
         sys.stdout.flush()
-        for bvid, btext in batch:
-            if btext:
-                try:
-                    sb_patch(bvid, btext)
-                    updated += 1
-                except Exception as e:
-                    print(f"\n  ✗ PATCH {bvid}: {e}")
-                    failed += 1
-        batch = []
-        print(f"\r  {i}/{total} — {updated} updated, {failed} failed          ")
-
-    time.sleep(DELAY)
-
-print(f"\n  ✓ Done: {updated} verses updated, {failed} failed\n")
+
+    pipeline.run_adaptive(todo, fetch_verse, window, retries=FETCH_TRIES, on_result=on_verse)
+    if batch:
+        flushes.append(writer.submit(write_verses, batch))
+writer.shutdown(wait=True)
+
+updated = sum(f.result()[0] for f in flushes)
+failed += sum(f.result()[1] for f in flushes)
+
+if args.mode == "ayah" and updated:
+    grouped = supabase_rest.rpc("rebuild_ibnu_kathir_passages", {}) or 0
+    print(f"\n  Grouped {grouped} verses into passages")
+
+print(f"\n  ✓ Done: {updated} verses updated, {failed} failed")
+print(f"  {http_cache.summary()}\n")
 print("── Complete ─────────────────────────────────────────────────────────────────")
 print("  Next: re-run reembed.py if you want Ibnu Kathir in embeddings too.\n")
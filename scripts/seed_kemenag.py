@@ -17,7 +17,9 @@ Run once from the project root:
 Reads credentials from .env. Safe to re-run (skips already-populated rows).
 """
 
-import json, os, sys, time, urllib.request, urllib.error
+import os, sys, time
+
+import http_cache, supabase_rest
 
 # ── Config ────────────────────────────────────────────────────────────────────
 
@@ -38,7 +40,7 @@ SUPABASE_URL         = os.environ.get("SUPABASE_URL", "").rstrip("/")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY", "")
 EQURAN_BASE          = "https://equran.id/api/v2/tafsir"
 
-UPDATE_BATCH = 50   # rows per Supabase PATCH call
+UPDATE_BATCH = 200  # rows per update_verse_text_column RPC call
 SURAH_DELAY  = 0.4  # seconds between equran.id calls
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
@@ -51,17 +53,8 @@ def check_env():
         sys.exit(1)
 
 def http_get(url):
-    req = urllib.request.Request(url, headers={"Accept": "application/json"})
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        return json.loads(resp.read())
-
-def supabase_headers():
-    return {
-        "Content-Type":  "application/json",
-        "apikey":        SUPABASE_SERVICE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-        "Prefer":        "return=minimal",
-    }
+    return http_cache.fetch_json(url, {"Accept": "application/json"}, timeout=30,
+                                 validate=http_cache.code_ok)
 
 # ── Phase 1: Fetch tafsir from equran.id ─────────────────────────────────────
 
@@ -81,21 +74,15 @@ def fetch_all(skip_populated=True):
     # Check which ids already have tafsir_kemenag populated to allow resuming
     populated = set()
     if skip_populated:
-        url = (f"{SUPABASE_URL}/rest/v1/quran_verses"
-               f"?select=id&tafsir_kemenag=not.is.null&limit=10000")
-        req = urllib.request.Request(url, headers={
-            "apikey":        SUPABASE_SERVICE_KEY,
-            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-        })
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            existing = json.loads(resp.read())
-        populated = {r["id"] for r in existing}
+        populated = {r["id"] for r in supabase_rest.scan_verses(
+            "id", ["tafsir_kemenag=not.is.null"])}
         if populated:
             print(f"  ↳ {len(populated)} verses already populated — will skip")
 
     all_rows = []
     for n in range(1, 115):
         print(f"  [{n:3}/114] Fetching surah {n} … ", end="", flush=True)
+        polite = not http_cache.cached(f"{EQURAN_BASE}/{n}")
         try:
             rows = fetch_surah_tafsir(n)
             new  = [r for r in rows if r["id"] not in populated]
@@ -103,31 +90,17 @@ def fetch_all(skip_populated=True):
             print(f"✓ ({len(rows)} ayat, {len(new)} new)")
         except Exception as e:
             print(f"✗  {e}")
-        time.sleep(SURAH_DELAY)
+        if polite:
+            time.sleep(SURAH_DELAY)
 
     return all_rows
 
 # ── Phase 2: Upsert into Supabase ────────────────────────────────────────────
 
 def update_batch(rows):
-    """PATCH tafsir_kemenag for a batch of verse ids."""
-    # Supabase REST: PATCH with id=in.(...) filter
-    # We send individual updates because PATCH with IN filter sets same value.
-    # Use bulk RPC or individual calls.
-    # For simplicity: POST to a helper endpoint or use individual PATCHes.
-    # We'll use a loop but group by surah to stay efficient.
-    for row in rows:
-        url = (f"{SUPABASE_URL}/rest/v1/quran_verses"
-               f"?id=eq.{urllib.parse.quote(row['id'])}")
-        body = json.dumps({"tafsir_kemenag": row["tafsir_kemenag"]}).encode()
-        req  = urllib.request.Request(
-            url, data=body, headers=supabase_headers(), method="PATCH"
-        )
-        try:
-            with urllib.request.urlopen(req, timeout=30):
-                pass
-        except Exception as e:
-            print(f"\n    ✗ Failed to update {row['id']}: {e}")
+    """Set tafsir_kemenag for a batch of verses in one set-based RPC call."""
+    return supabase_rest.update_column(
+        "tafsir_kemenag", [(r["id"], r["tafsir_kemenag"]) for r in rows], UPDATE_BATCH)
 
 def update_all(rows):
     total   = len(rows)
@@ -136,17 +109,15 @@ def update_all(rows):
         batch = rows[start : start + UPDATE_BATCH]
         end   = min(start + UPDATE_BATCH, total)
         print(f"  Updating {start+1}–{end}/{total} … ", end="", flush=True)
-        update_batch(batch)
-        updated += len(batch)
-        print("✓")
-        time.sleep(0.1)
+        try:
+            updated += update_batch(batch)
+            print("✓")
+        except Exception as e:
+            print(f"✗  {e}")
     return updated
 
 # ── Main ──────────────────────────────────────────────────────────────────────
 
-# Import urllib.parse (used in update_batch)
-import urllib.parse
-
 def main():
     check_env()
 
@@ -12,10 +12,17 @@ Run once locally (takes ~3-5 minutes):
   SUPABASE_SERVICE_KEY=eyJ...    \\
   python3 scripts/seed_quran.py
 
+Surahs are fetched concurrently under a shared token-bucket rate limit
+(--fetch-workers, --fetch-rps); a surah that still fails after retries
+aborts the run before anything is embedded.
+
 Re-running is safe: upsert on primary key conflict (ignores duplicates).
 """
 
-import json, os, sys, time, urllib.request, urllib.error
+import argparse, json, os, sys, urllib.request, urllib.error
+
+import http_cache, http_client, pipeline
+from embed_cache import EmbeddingCache
 
 # ── Config ────────────────────────────────────────────────────────────────────
 
@@ -24,10 +31,19 @@ SUPABASE_URL         = os.environ.get("SUPABASE_URL", "").rstrip("/")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY", "")
 
 EMBED_MODEL   = "text-embedding-3-small"
+EMBED_DIMS    = 1536   # model default; part of the embedding cache key
 EMBED_BATCH   = 100    # verses per OpenAI embedding request
 INSERT_BATCH  = 50     # rows per Supabase insert request
 MATCH_COUNT   = 15     # top-K for similarity search (used in api/get-ayat.js)
 
+PIPELINE_DEPTH = 4     # embedded batches buffered between OpenAI and Supabase
+INSERT_WORKERS = 2     # concurrent Supabase insert workers
+
+FETCH_WORKERS  = 8     # concurrent surah fetches
+FETCH_PER_HOST = 4     # max in-flight requests to alquran.cloud
+FETCH_RPS      = 4.0   # token-bucket rate for alquran.cloud (requests/second)
+FETCH_RETRIES  = 4     # attempts per surah before the run is aborted
+
 # Indonesian surah names (overrides the englishName from alquran.cloud)
 SURAH_NAMES = {
   1:"Al-Fatihah", 2:"Al-Baqarah", 3:"Ali Imran", 4:"An-Nisa",
@@ -73,12 +89,11 @@ def check_env():
 def http_post(url, headers, body):
     data = json.dumps(body).encode()
     req  = urllib.request.Request(url, data=data, headers=headers, method="POST")
-    with urllib.request.urlopen(req, timeout=30) as resp:
+    with http_client.urlopen(req, timeout=30) as resp:
         return json.loads(resp.read().decode())
 
 def http_get(url):
-    with urllib.request.urlopen(url, timeout=20) as resp:
-        return json.loads(resp.read().decode())
+    return http_cache.fetch_json(url, timeout=20, validate=http_cache.code_ok)
 
 # ── Phase 1: Fetch all verses ─────────────────────────────────────────────────
 
@@ -91,37 +106,58 @@ def load_tafsir_map():
         curated = json.load(f)
     return {v["id"]: v.get("tafsir_quraish_shihab") for v in curated}
 
+def surah_url(n):
+    return f"https://api.alquran.cloud/v1/surah/{n}/editions/quran-simple,id.indonesian"
+
 def fetch_surah(n):
-    url  = f"https://api.alquran.cloud/v1/surah/{n}/editions/quran-simple,id.indonesian"
-    data = http_get(url)
+    data = http_get(surah_url(n))
     if data.get("code") != 200:
         raise ValueError(f"alquran.cloud error for surah {n}: {data.get('status')}")
     arabic_ayahs = data["data"][0]["ayahs"]
     indo_ayahs   = data["data"][1]["ayahs"]
     return arabic_ayahs, indo_ayahs
 
-def fetch_all_verses(tafsir_map):
+def fetch_all_verses(tafsir_map, workers=FETCH_WORKERS, rps=FETCH_RPS):
+    """Fetch all 114 surahs concurrently under a shared rate limit.
+
+    Returns (verses, failed) — verses in mushaf order, failed as a list of
+    (surah_number, error) for surahs that still failed after FETCH_RETRIES.
+    """
+    def report(i, n, result, error):
+        if error:
+            print(f"  [{n:3}/114] {SURAH_NAMES[n]} ✗  {error}", flush=True)
+        else:
+            print(f"  [{n:3}/114] {SURAH_NAMES[n]} ✓ ({len(result[0])} ayat)", flush=True)
+
+    surahs  = list(range(1, 115))
+    if all(http_cache.cached(surah_url(n)) for n in surahs):
+        rps = None   # everything is on disk — no upstream to be polite to
+    results = pipeline.run_ordered(
+        surahs, fetch_surah,
+        workers=workers, rate=rps, burst=FETCH_PER_HOST,
+        per_host=FETCH_PER_HOST, url_of=surah_url,
+        retries=FETCH_RETRIES, on_result=report,
+    )
+
     verses = []
-    for n in range(1, 115):
-        print(f"  [{n:3}/114] Fetching {SURAH_NAMES[n]} … ", end="", flush=True)
-        try:
-            arabic_ayahs, indo_ayahs = fetch_surah(n)
-            for ar, id_ in zip(arabic_ayahs, indo_ayahs):
-                verse_id = f"{n}:{ar['numberInSurah']}"
-                verses.append({
-                    "id":             verse_id,
-                    "surah_number":   n,
-                    "surah_name":     SURAH_NAMES[n],
-                    "verse_number":   ar["numberInSurah"],
-                    "arabic":         ar["text"],
-                    "translation":    id_["text"],
-                    "tafsir_quraish_shihab": tafsir_map.get(verse_id),
-                })
-            print(f"✓ ({len(arabic_ayahs)} ayat)")
-        except Exception as e:
-            print(f"✗  {e}")
-        time.sleep(0.4)
-    return verses
+    failed = []
+    for n, (result, error) in zip(surahs, results):
+        if error:
+            failed.append((n, error))
+            continue
+        arabic_ayahs, indo_ayahs = result
+        for ar, id_ in zip(arabic_ayahs, indo_ayahs):
+            verse_id = f"{n}:{ar['numberInSurah']}"
+            verses.append({
+                "id":             verse_id,
+                "surah_number":   n,
+                "surah_name":     SURAH_NAMES[n],
+                "verse_number":   ar["numberInSurah"],
+                "arabic":         ar["text"],
+                "translation":    id_["text"],
+                "tafsir_quraish_shihab": tafsir_map.get(verse_id),
+            })
+    return verses, failed
 
 # ── Phase 2: Build embed texts ────────────────────────────────────────────────
 
@@ -144,24 +180,6 @@ def embed_batch(texts):
     # Sort by index to match input order
     return [item["embedding"] for item in sorted(resp["data"], key=lambda x: x["index"])]
 
-def embed_all(verses):
-    embeddings = []
-    total = len(verses)
-    for start in range(0, total, EMBED_BATCH):
-        batch  = verses[start : start + EMBED_BATCH]
-        texts  = [build_embed_text(v) for v in batch]
-        end    = min(start + EMBED_BATCH, total)
-        print(f"  Embedding {start+1}–{end}/{total} … ", end="", flush=True)
-        try:
-            vecs = embed_batch(texts)
-            embeddings.extend(vecs)
-            print("✓")
-        except Exception as e:
-            print(f"✗  {e}")
-            embeddings.extend([None] * len(batch))
-        time.sleep(0.3)
-    return embeddings
-
 # ── Phase 4: Insert to Supabase ───────────────────────────────────────────────
 
 def insert_batch(rows):
@@ -174,59 +192,100 @@ def insert_batch(rows):
     }
     http_post(url, headers, rows)
 
-def insert_all(verses, embeddings):
-    rows    = []
-    skipped = 0
-    for v, emb in zip(verses, embeddings):
-        if emb is None:
-            skipped += 1
-            continue
-        rows.append({
-            "id":             v["id"],
-            "surah_number":   v["surah_number"],
-            "surah_name":     v["surah_name"],
-            "verse_number":   v["verse_number"],
-            "arabic":         v["arabic"],
-            "translation":    v["translation"],
-            "tafsir_quraish_shihab": v["tafsir_quraish_shihab"],
-            "embedding":      emb,
-        })
-
-    total = len(rows)
-    inserted = 0
-    for start in range(0, total, INSERT_BATCH):
-        batch = rows[start : start + INSERT_BATCH]
-        end   = min(start + INSERT_BATCH, total)
-        print(f"  Inserting {start+1}–{end}/{total} … ", end="", flush=True)
-        try:
-            insert_batch(batch)
-            inserted += len(batch)
-            print("✓")
-        except Exception as e:
-            print(f"✗  {e}")
-        time.sleep(0.2)
-
-    return inserted, skipped
+def build_row(v, emb):
+    return {
+        "id":             v["id"],
+        "surah_number":   v["surah_number"],
+        "surah_name":     v["surah_name"],
+        "verse_number":   v["verse_number"],
+        "arabic":         v["arabic"],
+        "translation":    v["translation"],
+        "tafsir_quraish_shihab": v["tafsir_quraish_shihab"],
+        "embedding":      emb,
+    }
+
+# ── Phase 3 + 4: Stream embeddings straight into Supabase ────────────────────
+
+def embed_and_insert(verses):
+    """Embed in EMBED_BATCH groups and insert each group as soon as it is ready.
+
+    Embedded batches wait in a queue of PIPELINE_DEPTH, drained by
+    INSERT_WORKERS threads — only a few batches of vectors are ever held in
+    memory, and OpenAI and Supabase calls overlap instead of running back
+    to back. Texts already in the embedding cache skip the API. Returns (embedded, inserted, skipped).
+    """
+    total   = len(verses)
+    batches = [verses[s : s + EMBED_BATCH] for s in range(0, total, EMBED_BATCH)]
+    counts  = {"embedded": 0, "inserted": 0, "skipped": 0}
+
+    cache = EmbeddingCache(EMBED_MODEL, EMBED_DIMS)
+
+    def produce(batch):
+        vecs = cache.embed([build_embed_text(v) for v in batch], embed_batch, EMBED_BATCH)
+        return [build_row(v, emb) for v, emb in zip(batch, vecs)]
+
+    def consume(rows):
+        inserted = 0
+        for s in range(0, len(rows), INSERT_BATCH):
+            chunk = rows[s : s + INSERT_BATCH]
+            try:
+                insert_batch(chunk)
+            except Exception as e:
+                e.inserted = inserted   # chunks already written before the failure
+                raise
+            inserted += len(chunk)
+        return inserted
+
+    def report(stage, i, result, error):
+        start = i * EMBED_BATCH
+        end   = min(start + EMBED_BATCH, total)
+        label = "Embedding" if stage == "produce" else "Inserting"
+        if error:
+            print(f"  {label} {start+1}–{end}/{total} ✗  {error}", flush=True)
+            written = getattr(error, "inserted", 0)
+            counts["inserted"] += written
+            counts["skipped"]  += end - start - written
+        elif stage == "produce":
+            counts["embedded"] += len(result)
+            print(f"  {label} {start+1}–{end}/{total} ✓", flush=True)
+        else:
+            counts["inserted"] += result
+            print(f"  {label} {start+1}–{end}/{total} ✓", flush=True)
+
+    pipeline.stream_stages(batches, produce, consume,
+                           depth=PIPELINE_DEPTH, consumers=INSERT_WORKERS,
+                           on_result=report)
+    print(f"  {cache.summary()}")
+    return counts["embedded"], counts["inserted"], counts["skipped"]
 
 # ── Main ──────────────────────────────────────────────────────────────────────
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fetch-workers", type=int, default=FETCH_WORKERS,
+                        help="concurrent alquran.cloud requests")
+    parser.add_argument("--fetch-rps", type=float, default=FETCH_RPS,
+                        help="alquran.cloud requests per second")
+    args = parser.parse_args()
+
     check_env()
 
     print("\n── Phase 1: Fetching verses from alquran.cloud ─────────────────────────")
     tafsir_map = load_tafsir_map()
     print(f"  Loaded tafsir_quraish_shihab for {len(tafsir_map)} curated verses")
-    verses = fetch_all_verses(tafsir_map)
-    print(f"\n  ✓ Fetched {len(verses)} verses across 114 surahs\n")
-
-    print("── Phase 2 + 3: Embedding with text-embedding-3-small ──────────────────")
-    embeddings = embed_all(verses)
-    ok_count = sum(1 for e in embeddings if e is not None)
-    print(f"\n  ✓ Embedded {ok_count}/{len(verses)} verses\n")
+    verses, failed = fetch_all_verses(tafsir_map, args.fetch_workers, args.fetch_rps)
+    if failed:
+        print(f"\n  ✗ {len(failed)} surah(s) failed after {FETCH_RETRIES} attempts: "
+              f"{', '.join(str(n) for n, _ in failed)}")
+        print("  Aborting before embedding so no surah is silently missing. Re-run to retry.")
+        sys.exit(1)
+    print(f"\n  ✓ Fetched {len(verses)} verses across 114 surahs")
+    print(f"  {http_cache.summary()}\n")
 
-    print("── Phase 4: Inserting into Supabase ─────────────────────────────────────")
-    inserted, skipped = insert_all(verses, embeddings)
-    print(f"\n  ✓ Inserted {inserted} rows  ({skipped} skipped due to embed failure)\n")
+    print("── Phase 2–4: Embedding with text-embedding-3-small → Supabase ─────────")
+    embedded, inserted, skipped = embed_and_insert(verses)
+    print(f"\n  ✓ Embedded {embedded}/{len(verses)} verses")
+    print(f"  ✓ Inserted {inserted} rows  ({skipped} skipped due to embed/insert failure)\n")
 
     print("── Done ─────────────────────────────────────────────────────────────────")
     print(f"  {inserted} verses now in Supabase.")
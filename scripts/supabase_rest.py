@@ -0,0 +1,108 @@
+"""
+supabase_rest.py
+────────────────
+Shared PostgREST helpers for the scripts in scripts/.
+
+Reads SUPABASE_URL and SUPABASE_SERVICE_KEY from the environment at call
+time, so each script's own .env loading still applies.
+
+  scan_verses   — generator over quran_verses using keyset pagination on
+                  (surah_number, verse_number)
+  update_column — bulk-update one whitelisted text column via the
+                  update_verse_text_column RPC (migration 013)
+"""
+
+import json, os, urllib.error, urllib.parse, urllib.request
+
+import http_client
+
+PAGE_SIZE   = 1000   # Supabase's default max-rows; larger pages get truncated
+BULK_BATCH  = 200    # rows per update_verse_text_column call
+KEYSET      = ("surah_number", "verse_number")
+
+# ── Helpers ───────────────────────────────────────────────────────────────────
+
+def base_url():
+    return os.environ.get("SUPABASE_URL", "").rstrip("/")
+
+def headers(extra=None):
+    key = os.environ.get("SUPABASE_SERVICE_KEY", "")
+    h = {
+        "Content-Type":  "application/json",
+        "apikey":        key,
+        "Authorization": f"Bearer {key}",
+    }
+    if extra:
+        h.update(extra)
+    return h
+
+def get_json(path, timeout=30):
+    req = urllib.request.Request(f"{base_url()}/rest/v1/{path}",
+                                 headers=headers({"Accept": "application/json"}))
+    with http_client.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode())
+
+def rpc(fn_name, body, timeout=60):
+    data = json.dumps(body).encode()
+    req  = urllib.request.Request(f"{base_url()}/rest/v1/rpc/{fn_name}", data=data,
+                                  method="POST", headers=headers())
+    try:
+        with http_client.urlopen(req, timeout=timeout) as resp:
+            raw = resp.read()
+            return json.loads(raw) if raw else None
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"HTTP {e.code}: {e.read().decode()[:200]}")
+
+# ── Keyset scan ───────────────────────────────────────────────────────────────
+
+def scan_verses(columns, filters=(), page_size=PAGE_SIZE):
+    """Yield quran_verses rows in mushaf order, one page at a time.
+
+    columns  — comma-separated string or list of column names
+    filters  — PostgREST filters, e.g. ["tafsir_summary=is.null"]
+
+    Each page resumes strictly after the last (surah_number, verse_number)
+    seen, so per-page latency stays flat and rows updated mid-scan are
+    neither skipped nor repeated. Only the requested columns are yielded;
+    the keyset columns are fetched as needed and stripped again.
+    """
+    if isinstance(columns, str):
+        columns = [c.strip() for c in columns.split(",") if c.strip()]
+    select = list(columns) + [c for c in KEYSET if c not in columns]
+    strip  = [c for c in KEYSET if c not in columns]
+    base   = (f"quran_verses?select={','.join(select)}"
+              + "".join(f"&{f}" for f in filters)
+              + f"&order={KEYSET[0]},{KEYSET[1]}&limit={page_size}")
+
+    last = None
+    while True:
+        path = base
+        if last:
+            s, v = last
+            keyset = f"({KEYSET[0]}.gt.{s},and({KEYSET[0]}.eq.{s},{KEYSET[1]}.gt.{v}))"
+            path  += "&or=" + urllib.parse.quote(keyset, safe="(),.")
+        page = get_json(path)
+        if not page:
+            return
+        last = (page[-1][KEYSET[0]], page[-1][KEYSET[1]])
+        for row in page:
+            for c in strip:
+                del row[c]
+            yield row
+        if len(page) < page_size:
+            return
+
+# ── Bulk column update ────────────────────────────────────────────────────────
+
+def update_column(column, rows, batch_size=BULK_BATCH):
+    """Set `column` for many verses: rows is an iterable of (verse_id, text).
+
+    Sends one set-based RPC per batch_size rows and returns the number of
+    rows the database reports as updated. Raises on the first failed call.
+    """
+    rows    = [{"id": vid, "value": text} for vid, text in rows]
+    updated = 0
+    for start in range(0, len(rows), batch_size):
+        updated += rpc("update_verse_text_column",
+                       {"col": column, "updates": rows[start : start + batch_size]}) or 0
+    return updated
@@ -0,0 +1,73 @@
+"""
+token_count.py
+──────────────
+Token counting for budgeting OpenAI requests (batch quotas, prompt sizes).
+
+Uses tiktoken when it is installed (pip install tiktoken). Without it,
+falls back to a characters-per-token estimate that deliberately
+over-counts, so budgets err towards smaller batches rather than rejected
+ones.
+
+  count(text, model)          — tokens in a string
+  count_messages(msgs, model) — prompt tokens for a chat request
+  truncate(text, limit, model) — text cut to ≤ limit tokens, at a sentence
+                                 or paragraph end where one is near
+  backend()                   — "tiktoken" or "estimate"
+"""
+
+import math
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHARS_PER_TOKEN  = 3.0   # conservative for mixed Indonesian / Arabic text
+MESSAGE_OVERHEAD = 4     # role + separators per chat message
+REPLY_PRIMING    = 3     # tokens added once per chat request
+TRUNCATION_MARK  = " […]"
+
+_encodings = {}
+
+def _encoding(model):
+    enc = _encodings.get(model)
+    if enc is None:
+        try:
+            enc = tiktoken.encoding_for_model(model)
+        except KeyError:
+            enc = tiktoken.get_encoding("o200k_base")
+        _encodings[model] = enc
+    return enc
+
+def backend():
+    return "tiktoken" if tiktoken else "estimate"
+
+def count(text, model="gpt-4o-mini"):
+    if not text:
+        return 0
+    if tiktoken:
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def count_messages(messages, model="gpt-4o-mini"):
+    return REPLY_PRIMING + sum(MESSAGE_OVERHEAD + count(m["content"], model) for m in messages)
+
+def truncate(text, limit, model="gpt-4o-mini"):
+    """Cut text to at most `limit` tokens (including the trailing mark).
+
+    The cut is moved back to the last paragraph or sentence end if one lies
+    in the final third of the kept text, so the model isn't handed a broken
+    sentence. Text already within the limit is returned unchanged.
+    """
+    if not text or count(text, model) <= limit:
+        return text
+    keep = max(limit - count(TRUNCATION_MARK, model), 0)
+    if tiktoken:
+        enc  = _encoding(model)
+        head = enc.decode(enc.encode(text, disallowed_special=())[:keep])
+    else:
+        head = text[:int(keep * CHARS_PER_TOKEN)]
+    end = max(head.rfind("\n\n"), head.rfind(". "), head.rfind(".\n"))
+    if end >= len(head) * 2 // 3:
+        head = head[:end + 1]
+    return head.rstrip() + TRUNCATION_MARK
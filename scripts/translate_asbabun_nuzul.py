@@ -10,15 +10,20 @@ Flow:
   4. Poll until complete (prints progress every 30 s)
   5. Parse results → update Supabase asbabun_nuzul_id
 
+Every batch is recorded in the job ledger (openai_batch.py). A re-run first
+finishes any outstanding batch from an earlier run, so an interrupted run
+resumes automatically without re-submitting or re-applying anything.
+
 Usage:
   python3 scripts/translate_asbabun_nuzul.py
-  python3 scripts/translate_asbabun_nuzul.py --poll <batch_id>   # resume polling
+  python3 scripts/translate_asbabun_nuzul.py --poll <batch_id>   # poll a specific batch
+  python3 scripts/translate_asbabun_nuzul.py --snapshot          # text from corpus_snapshot.py
 """
 
-import os, sys, json, time, argparse
+import os, sys, argparse
 from pathlib import Path
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+
+import corpus_snapshot, openai_batch, supabase_rest
 
 # ── Load env ──────────────────────────────────────────────────────────────────
 env_path = Path(__file__).parent.parent / ".env"
@@ -32,16 +37,9 @@ SUPABASE_URL = os.environ["SUPABASE_URL"].rstrip("/")
 SERVICE_KEY  = os.environ["SUPABASE_SERVICE_KEY"]
 OPENAI_KEY   = os.environ["OPENAI_API_KEY"]
 
-SB_HEADERS = {
-    "apikey":        SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type":  "application/json",
-    "Prefer":        "return=minimal",
-}
-OAI_HEADERS = {
-    "Authorization": f"Bearer {OPENAI_KEY}",
-    "Content-Type":  "application/json",
-}
+JOB           = "translate_asbabun_nuzul"   # ledger job name
+UPDATE_BATCH  = 200   # rows per bulk update RPC call
+POLL_INTERVAL = 30    # seconds between batch status polls
 
 BATCH_FILE   = Path("/tmp/asbab_translate_batch.jsonl")
 RESULTS_FILE = Path("/tmp/asbab_translate_results.jsonl")
@@ -71,138 +69,59 @@ Aturan:
 def user_msg(text: str) -> str:
     return f"Terjemahkan dan format ulang teks Asbabun Nuzul berikut ke Bahasa Indonesia:\n\n{text}"
 
-# ── Supabase helpers ──────────────────────────────────────────────────────────
-def sb_get(path: str) -> list:
-    req = Request(f"{SUPABASE_URL}/rest/v1/{path}",
-                  headers={**SB_HEADERS, "Accept": "application/json"})
-    with urlopen(req, timeout=30) as r:
-        return json.loads(r.read())
-
-def sb_patch(verse_id: str, text: str):
-    payload = json.dumps({"asbabun_nuzul_id": text}).encode()
-    req = Request(
-        f"{SUPABASE_URL}/rest/v1/quran_verses?id=eq.{verse_id}",
-        data=payload, method="PATCH", headers=SB_HEADERS,
-    )
-    with urlopen(req, timeout=15) as r:
-        r.read()
-
-# ── OpenAI helpers ────────────────────────────────────────────────────────────
-def oai_request(method: str, path: str, body=None, content_type="application/json"):
-    url  = f"https://api.openai.com/v1/{path}"
-    data = json.dumps(body).encode() if body else None
-    req  = Request(url, data=data, method=method,
-                   headers={**OAI_HEADERS, "Content-Type": content_type})
-    with urlopen(req, timeout=60) as r:
-        return json.loads(r.read())
-
-def upload_file(path: Path) -> str:
-    """Upload JSONL batch file using multipart/form-data."""
-    boundary = "----BatchBoundary"
-    content  = path.read_bytes()
-    body = (
-        f"--{boundary}\r\n"
-        f'Content-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
-        f"--{boundary}\r\n"
-        f'Content-Disposition: form-data; name="file"; filename="{path.name}"\r\n'
-        f"Content-Type: application/jsonl\r\n\r\n"
-    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
-
-    req = Request(
-        "https://api.openai.com/v1/files",
-        data=body, method="POST",
-        headers={
-            "Authorization": f"Bearer {OPENAI_KEY}",
-            "Content-Type":  f"multipart/form-data; boundary={boundary}",
-        },
-    )
-    with urlopen(req, timeout=120) as r:
-        return json.loads(r.read())["id"]
-
-def download_file(file_id: str, dest: Path):
-    req = Request(f"https://api.openai.com/v1/files/{file_id}/content",
-                  headers={"Authorization": f"Bearer {OPENAI_KEY}"})
-    with urlopen(req, timeout=120) as r:
-        dest.write_bytes(r.read())
-
 # ── Phase 1: Fetch verses needing translation ─────────────────────────────────
-def fetch_todo() -> list:
+def fetch_todo(snapshot=None) -> list:
     print("\n── Phase 1: Fetching verses to translate ────────────────────────────────────")
-    rows = sb_get(
-        "quran_verses"
-        "?select=id,asbabun_nuzul"
-        "&asbabun_nuzul=not.is.null"
-        "&asbabun_nuzul_id=is.null"
-        "&order=id"
+    # With a snapshot only the ids come from Supabase; the English text from disk
+    rows = corpus_snapshot.scan_verses(
+        "id,asbabun_nuzul",
+        ["asbabun_nuzul=not.is.null", "asbabun_nuzul_id=is.null"],
+        snapshot,
     )
+    missing = [r["id"] for r in rows if not r["asbabun_nuzul"]] if snapshot else []
+    if missing:
+        # seeded after the snapshot was exported
+        print(f"  ⚠ {len(missing)} verses have no asbabun_nuzul in snapshot {snapshot.version} "
+              f"— skipped; re-export the snapshot to include them")
+        rows = [r for r in rows if r["asbabun_nuzul"]]
     print(f"  {len(rows)} verses need translation")
     return rows
 
 # ── Phase 2: Build JSONL batch file ──────────────────────────────────────────
+def build_request(custom_id: str, text: str) -> dict:
+    # Dynamic max_tokens based on input length
+    max_tokens = 8192 if len(text) > 4000 else 4096
+    return openai_batch.chat_request(
+        custom_id, "gpt-4o-mini", SYSTEM_PROMPT, user_msg(text),
+        cache_key=openai_batch.prompt_cache_key(JOB, SYSTEM_PROMPT),
+        max_tokens=max_tokens, temperature=0.3,
+    )
+
 def build_batch(rows: list):
     print(f"\n── Phase 2: Building batch file ({len(rows)} requests) ──────────────────────")
-    lines = []
-    for r in rows:
-        vid  = r["id"]
-        text = r["asbabun_nuzul"]
-        # Dynamic max_tokens based on input length
-        max_tokens = 8192 if len(text) > 4000 else 4096
-        req = {
-            "custom_id": vid,
-            "method":    "POST",
-            "url":       "/v1/chat/completions",
-            "body": {
-                "model": "gpt-4o-mini",
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user",   "content": user_msg(text)},
-                ],
-                "max_tokens":   max_tokens,
-                "temperature":  0.3,
-            },
-        }
-        lines.append(json.dumps(req, ensure_ascii=False))
-
-    BATCH_FILE.write_text("\n".join(lines), encoding="utf-8")
-    size_mb = BATCH_FILE.stat().st_size / 1_048_576
-    print(f"  Batch file: {BATCH_FILE} ({size_mb:.1f} MB, {len(lines)} lines)")
+    # Streamed straight to disk — the file is never held in memory
+    n, size = openai_batch.write_jsonl(
+        BATCH_FILE, (build_request(r["id"], r["asbabun_nuzul"]) for r in rows))
+    print(f"  Batch file: {BATCH_FILE} ({size / 1_048_576:.1f} MB, {n} lines)")
 
 # ── Phase 3: Upload + submit batch ───────────────────────────────────────────
-def submit_batch() -> str:
+def submit_batch(ledger, rows: list) -> str:
     print("\n── Phase 3: Uploading batch file to OpenAI ──────────────────────────────────")
-    file_id = upload_file(BATCH_FILE)
-    print(f"  File uploaded: {file_id}")
-
-    batch = oai_request("POST", "batches", {
-        "input_file_id":  file_id,
-        "endpoint":       "/v1/chat/completions",
-        "completion_window": "24h",
-    })
-    batch_id = batch["id"]
-    print(f"  Batch submitted: {batch_id}")
-    print(f"  Status: {batch['status']}")
-    print(f"\n  Save this batch ID to resume if needed:")
-    print(f"     python3 scripts/translate_asbabun_nuzul.py --poll {batch_id}\n")
+    batch_id = openai_batch.submit(ledger, JOB, BATCH_FILE, [r["id"] for r in rows])
+    print(f"  Recorded in {ledger.path} — a re-run resumes this batch automatically")
     return batch_id
 
 # ── Phase 4: Poll until complete ─────────────────────────────────────────────
-def poll_batch(batch_id: str) -> dict:
+def poll_batch(batch_id: str, ledger=None, exit_on_failure=True) -> dict:
     print(f"\n── Phase 4: Polling batch {batch_id} ────────────────────────────────────────")
-    while True:
-        batch = oai_request("GET", f"batches/{batch_id}")
-        status  = batch["status"]
-        counts  = batch.get("request_counts", {})
-        total   = counts.get("total", "?")
-        done    = counts.get("completed", 0)
-        failed  = counts.get("failed", 0)
-        print(f"  [{time.strftime('%H:%M:%S')}] {status} — {done}/{total} done, {failed} failed")
-
-        if status == "completed":
-            return batch
-        if status in ("failed", "expired", "cancelled"):
-            print(f"  Batch {status}. Exiting.")
-            sys.exit(1)
-        time.sleep(30)
+    batch = openai_batch.wait(batch_id, ledger, POLL_INTERVAL)
+    if batch["status"] != "completed":
+        if not exit_on_failure:
+            print(f"  Batch {batch['status']} — its verses are submitted again below.")
+            return None
+        print(f"  Batch {batch['status']}. Exiting.")
+        sys.exit(1)
+    return batch
 
 # ── Phase 5: Parse results + update Supabase ─────────────────────────────────
 def apply_results(batch: dict):
@@ -211,16 +130,30 @@ def apply_results(batch: dict):
         print("  No output file in batch response.")
         sys.exit(1)
 
-    print(f"\n── Phase 5: Downloading results ({output_file_id}) ──────────────────────────")
-    download_file(output_file_id, RESULTS_FILE)
-    lines = RESULTS_FILE.read_text(encoding="utf-8").splitlines()
-    print(f"  {len(lines)} result lines downloaded")
-
-    print("  Updating Supabase …")
+    print(f"\n── Phase 5: Streaming results ({output_file_id}) → Supabase ─────────────────")
     updated = 0
     failed  = 0
-    for line in lines:
-        obj = json.loads(line)
+    pending = []
+
+    def flush():
+        nonlocal updated, failed
+        if not pending:
+            return
+        try:
+            updated += supabase_rest.update_column("asbabun_nuzul_id", pending)
+            print(f"    … {updated} updated")
+        except Exception as e:
+            print(f"  ✗ Bulk update of {len(pending)} rows failed: {e}")
+            failed += len(pending)
+        pending.clear()
+
+    # Parsed line by line as the file downloads; each full group is written
+    # while the rest is still arriving
+    lines = 0
+    usage = openai_batch.UsageTally()
+    for obj in openai_batch.stream_results(output_file_id, RESULTS_FILE):
+        lines += 1
+        usage.add(obj)
         vid = obj.get("custom_id", "")
         if obj.get("error"):
             print(f"  ✗ {vid}: {obj['error']}")
@@ -232,36 +165,55 @@ def apply_results(batch: dict):
             continue
         text = choices[0].get("message", {}).get("content", "").strip()
         if text:
-            try:
-                sb_patch(vid, text)
-                updated += 1
-                if updated % 50 == 0:
-                    print(f"    … {updated} updated")
-            except Exception as e:
-                print(f"  ✗ PATCH {vid}: {e}")
-                failed += 1
+            pending.append((vid, text))
+            if len(pending) >= UPDATE_BATCH:
+                flush()
+    flush()
+    print(f"  {lines} result lines processed (saved to {RESULTS_FILE})")
+    print(f"  {usage.summary()}")
 
     print(f"\n  Done: {updated} updated, {failed} failed")
 
 # ── Main ──────────────────────────────────────────────────────────────────────
+def finish(ledger, batch_id, resuming=False):
+    """Poll a batch, apply its results and mark it applied. A resumed batch
+    that ended without results doesn't stop the run: wait() has recorded its
+    status, and its verses come back as todo."""
+    batch = poll_batch(batch_id, ledger, exit_on_failure=not resuming)
+    if batch is None:
+        return
+    if resuming and not batch.get("output_file_id"):
+        print("  No output file in batch response — its verses are submitted again below.")
+        ledger.mark_applied(batch_id)
+        return
+    apply_results(batch)
+    ledger.mark_applied(batch_id)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--poll", metavar="BATCH_ID",
                         help="Skip to polling an existing batch ID")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Read the English text from the corpus snapshot (corpus_snapshot.py)")
     args = parser.parse_args()
 
+    ledger = openai_batch.Ledger()
     if args.poll:
-        batch = poll_batch(args.poll)
-        apply_results(batch)
+        finish(ledger, args.poll)
     else:
-        rows = fetch_todo()
+        # Resume batches left over from an interrupted run first
+        for job in ledger.outstanding(JOB):
+            print(f"\n  Resuming batch {job['batch_id']} ({len(job['custom_ids'])} requests)")
+            finish(ledger, job["batch_id"], resuming=True)
+
+        rows = fetch_todo(corpus_snapshot.Snapshot() if args.snapshot else None)
+        unsubmitted = ledger.unsubmitted_ids(JOB)
+        rows = [r for r in rows if r["id"] not in unsubmitted]
         if not rows:
             print("  All verses already translated. Nothing to do.")
             return
         build_batch(rows)
-        batch_id = submit_batch()
-        batch    = poll_batch(batch_id)
-        apply_results(batch)
+        finish(ledger, submit_batch(ledger, rows))
 
     print("\n── Complete ─────────────────────────────────────────────────────────────────")
     print("  asbabun_nuzul_id populated in Supabase.")
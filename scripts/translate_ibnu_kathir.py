@@ -3,22 +3,29 @@
 Translate tafsir_ibnu_kathir (English) → tafsir_ibnu_kathir_id (Bahasa Indonesia)
 using the OpenAI Batch API (50% cheaper, async).
 
+Translates each Ibnu Kathir passage (migration 014) once, not every verse
+that shares it; the RPC copies the result to all verses in the passage.
+
 Flow:
-  1. Fetch all verses that have English tafsir but no Indonesian yet
+  1. Fetch all passages that have English tafsir but no Indonesian yet
   2. Build a JSONL batch file
   3. Upload + submit to OpenAI Batch API
   4. Poll until complete (prints progress every 30 s)
-  5. Parse results → update Supabase tafsir_ibnu_kathir_id
+  5. Parse results → update passages + copy to quran_verses.tafsir_ibnu_kathir_id
+
+Every batch is recorded in the job ledger (openai_batch.py). A re-run first
+finishes any outstanding batch from an earlier run, so an interrupted run
+resumes automatically without re-submitting or re-applying anything.
 
 Usage:
   python3 scripts/translate_ibnu_kathir.py
-  python3 scripts/translate_ibnu_kathir.py --poll <batch_id>   # resume polling
+  python3 scripts/translate_ibnu_kathir.py --poll <batch_id>   # poll a specific batch
 """
 
-import os, sys, json, time, argparse
+import os, sys, argparse
 from pathlib import Path
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+
+import openai_batch, supabase_rest
 
 # ── Load env ──────────────────────────────────────────────────────────────────
 env_path = Path(__file__).parent.parent / ".env"
@@ -32,16 +39,10 @@ SUPABASE_URL = os.environ["SUPABASE_URL"].rstrip("/")
 SERVICE_KEY  = os.environ["SUPABASE_SERVICE_KEY"]
 OPENAI_KEY   = os.environ["OPENAI_API_KEY"]
 
-SB_HEADERS = {
-    "apikey":        SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type":  "application/json",
-    "Prefer":        "return=minimal",
-}
-OAI_HEADERS = {
-    "Authorization": f"Bearer {OPENAI_KEY}",
-    "Content-Type":  "application/json",
-}
+JOB           = "translate_ibnu_kathir"   # ledger job name
+UPDATE_BATCH  = 200   # rows per bulk update RPC call
+PAGE_SIZE     = 1000  # passages per keyset page
+POLL_INTERVAL = 30    # seconds between batch status polls
 
 BATCH_FILE   = Path("/tmp/ik_translate_batch.jsonl")
 RESULTS_FILE = Path("/tmp/ik_translate_results.jsonl")
@@ -66,140 +67,67 @@ Aturan:
 def user_msg(text: str) -> str:
     return f"Terjemahkan dan format ulang teks Tafsir Ibnu Kathir berikut:\n\n{text}"
 
-# ── Supabase helpers ──────────────────────────────────────────────────────────
-def sb_get(path: str) -> list:
-    req = Request(f"{SUPABASE_URL}/rest/v1/{path}",
-                  headers={**SB_HEADERS, "Accept": "application/json"})
-    with urlopen(req, timeout=30) as r:
-        return json.loads(r.read())
-
-def sb_patch(verse_id: str, text: str):
-    payload = json.dumps({"tafsir_ibnu_kathir_id": text}).encode()
-    req = Request(
-        f"{SUPABASE_URL}/rest/v1/quran_verses?id=eq.{verse_id}",
-        data=payload, method="PATCH", headers=SB_HEADERS,
-    )
-    with urlopen(req, timeout=15) as r:
-        r.read()
-
-# ── OpenAI helpers ────────────────────────────────────────────────────────────
-def oai_request(method: str, path: str, body=None, content_type="application/json"):
-    url  = f"https://api.openai.com/v1/{path}"
-    data = json.dumps(body).encode() if body else None
-    req  = Request(url, data=data, method=method,
-                   headers={**OAI_HEADERS, "Content-Type": content_type})
-    with urlopen(req, timeout=60) as r:
-        return json.loads(r.read())
-
-def upload_file(path: Path) -> str:
-    """Upload JSONL batch file using multipart/form-data."""
-    import urllib.parse, email.generator, email.mime.multipart, email.mime.base, io
-    boundary = "----BatchBoundary"
-    content  = path.read_bytes()
-    body = (
-        f"--{boundary}\r\n"
-        f'Content-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
-        f"--{boundary}\r\n"
-        f'Content-Disposition: form-data; name="file"; filename="{path.name}"\r\n'
-        f"Content-Type: application/jsonl\r\n\r\n"
-    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
-
-    req = Request(
-        "https://api.openai.com/v1/files",
-        data=body, method="POST",
-        headers={
-            "Authorization": f"Bearer {OPENAI_KEY}",
-            "Content-Type":  f"multipart/form-data; boundary={boundary}",
-        },
-    )
-    with urlopen(req, timeout=120) as r:
-        return json.loads(r.read())["id"]
-
-def download_file(file_id: str, dest: Path):
-    req = Request(f"https://api.openai.com/v1/files/{file_id}/content",
-                  headers={"Authorization": f"Bearer {OPENAI_KEY}"})
-    with urlopen(req, timeout=120) as r:
-        dest.write_bytes(r.read())
-
-# ── Phase 1: Fetch verses needing translation ─────────────────────────────────
+# ── Phase 1: Fetch passages needing translation ───────────────────────────────
 def fetch_todo() -> list:
-    print("\n── Phase 1: Fetching verses to translate ────────────────────────────────────")
-    # Verses with English tafsir but no Indonesian yet
-    rows = sb_get(
-        "quran_verses"
-        "?select=id,tafsir_ibnu_kathir"
-        "&tafsir_ibnu_kathir=not.is.null"
-        "&tafsir_ibnu_kathir_id=is.null"
-        "&order=id"
-    )
-    print(f"  {len(rows)} verses need translation")
+    """Untranslated passages as [{"id": "p:<passage id>", "tafsir_ibnu_kathir": text}]."""
+    print("\n── Phase 1: Fetching passages to translate ──────────────────────────────────")
+    # Verses seeded per-ayah but not grouped yet have no passage to translate
+    ungrouped = supabase_rest.get_json(
+        "quran_verses?select=id&tafsir_ibnu_kathir=not.is.null"
+        "&ibnu_kathir_passage_id=is.null&limit=1")
+    if ungrouped:
+        print("  ⚠ Some verses are not grouped into passages yet — run "
+              "SELECT rebuild_ibnu_kathir_passages(); (migration 014) to include them")
+
+    rows, last = [], 0
+    while True:
+        page = supabase_rest.get_json(
+            "tafsir_ibnu_kathir_passages?select=id,first_verse,last_verse,text_en"
+            f"&text_id=is.null&id=gt.{last}&order=id&limit={PAGE_SIZE}")
+        rows += [{"id": f"p:{p['id']}", "tafsir_ibnu_kathir": p["text_en"],
+                  "verses": p["last_verse"] - p["first_verse"] + 1} for p in page]
+        if len(page) < PAGE_SIZE:
+            break
+        last = page[-1]["id"]
+    verses = sum(r["verses"] for r in rows)
+    print(f"  {len(rows)} passages need translation (covering {verses} verses)")
     return rows
 
 # ── Phase 2: Build JSONL batch file ──────────────────────────────────────────
+def build_request(custom_id: str, text: str) -> dict:
+    # Dynamic max_tokens based on input length
+    max_tokens = 8192 if len(text) > 4000 else 4096
+    return openai_batch.chat_request(
+        custom_id, "gpt-4o-mini", SYSTEM_PROMPT, user_msg(text),
+        cache_key=openai_batch.prompt_cache_key(JOB, SYSTEM_PROMPT),
+        max_tokens=max_tokens, temperature=0.3,
+    )
+
 def build_batch(rows: list):
     print(f"\n── Phase 2: Building batch file ({len(rows)} requests) ──────────────────────")
-    lines = []
-    for r in rows:
-        vid  = r["id"]
-        text = r["tafsir_ibnu_kathir"]
-        # Dynamic max_tokens based on input length
-        max_tokens = 8192 if len(text) > 4000 else 4096
-        req = {
-            "custom_id": vid,
-            "method":    "POST",
-            "url":       "/v1/chat/completions",
-            "body": {
-                "model": "gpt-4o-mini",
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user",   "content": user_msg(text)},
-                ],
-                "max_tokens":   max_tokens,
-                "temperature":  0.3,
-            },
-        }
-        lines.append(json.dumps(req, ensure_ascii=False))
-
-    BATCH_FILE.write_text("\n".join(lines), encoding="utf-8")
-    size_mb = BATCH_FILE.stat().st_size / 1_048_576
-    print(f"  Batch file: {BATCH_FILE} ({size_mb:.1f} MB, {len(lines)} lines)")
+    # Streamed straight to disk — the file is never held in memory
+    n, size = openai_batch.write_jsonl(
+        BATCH_FILE, (build_request(r["id"], r["tafsir_ibnu_kathir"]) for r in rows))
+    print(f"  Batch file: {BATCH_FILE} ({size / 1_048_576:.1f} MB, {n} lines)")
 
 # ── Phase 3: Upload + submit batch ───────────────────────────────────────────
-def submit_batch() -> str:
+def submit_batch(ledger, rows: list) -> str:
     print("\n── Phase 3: Uploading batch file to OpenAI ──────────────────────────────────")
-    file_id = upload_file(BATCH_FILE)
-    print(f"  File uploaded: {file_id}")
-
-    batch = oai_request("POST", "batches", {
-        "input_file_id":  file_id,
-        "endpoint":       "/v1/chat/completions",
-        "completion_window": "24h",
-    })
-    batch_id = batch["id"]
-    print(f"  Batch submitted: {batch_id}")
-    print(f"  Status: {batch['status']}")
-    print(f"\n  💾 Save this batch ID to resume if needed:")
-    print(f"     python3 scripts/translate_ibnu_kathir.py --poll {batch_id}\n")
+    batch_id = openai_batch.submit(ledger, JOB, BATCH_FILE, [r["id"] for r in rows])
+    print(f"  Recorded in {ledger.path} — a re-run resumes this batch automatically")
     return batch_id
 
 # ── Phase 4: Poll until complete ─────────────────────────────────────────────
-def poll_batch(batch_id: str) -> dict:
+def poll_batch(batch_id: str, ledger=None, exit_on_failure=True) -> dict:
     print(f"\n── Phase 4: Polling batch {batch_id} ────────────────────────────────────────")
-    while True:
-        batch = oai_request("GET", f"batches/{batch_id}")
-        status  = batch["status"]
-        counts  = batch.get("request_counts", {})
-        total   = counts.get("total", "?")
-        done    = counts.get("completed", 0)
-        failed  = counts.get("failed", 0)
-        print(f"  [{time.strftime('%H:%M:%S')}] {status} — {done}/{total} done, {failed} failed")
-
-        if status == "completed":
-            return batch
-        if status in ("failed", "expired", "cancelled"):
-            print(f"  ✗ Batch {status}. Exiting.")
-            sys.exit(1)
-        time.sleep(30)
+    batch = openai_batch.wait(batch_id, ledger, POLL_INTERVAL)
+    if batch["status"] != "completed":
+        if not exit_on_failure:
+            print(f"  ✗ Batch {batch['status']} — its verses are submitted again below.")
+            return None
+        print(f"  ✗ Batch {batch['status']}. Exiting.")
+        sys.exit(1)
+    return batch
 
 # ── Phase 5: Parse results + update Supabase ─────────────────────────────────
 def apply_results(batch: dict):
@@ -208,16 +136,42 @@ def apply_results(batch: dict):
         print("  ✗ No output file in batch response.")
         sys.exit(1)
 
-    print(f"\n── Phase 5: Downloading results ({output_file_id}) ──────────────────────────")
-    download_file(output_file_id, RESULTS_FILE)
-    lines = RESULTS_FILE.read_text(encoding="utf-8").splitlines()
-    print(f"  {len(lines)} result lines downloaded")
-
-    print("  Updating Supabase …")
+    print(f"\n── Phase 5: Streaming results ({output_file_id}) → Supabase ─────────────────")
     updated = 0
     failed  = 0
-    for line in lines:
-        obj = json.loads(line)
+    pending = []
+
+    def write(rows):
+        # custom_id "p:<id>" is a passage; a bare verse id comes from batches
+        # submitted before passages existed
+        passages = [{"id": int(cid[2:]), "value": text} for cid, text in rows if cid.startswith("p:")]
+        verses   = [(cid, text) for cid, text in rows if not cid.startswith("p:")]
+        n = 0
+        if passages:
+            n += supabase_rest.rpc("apply_ibnu_kathir_passage_translations", {"updates": passages}) or 0
+        if verses:
+            n += supabase_rest.update_column("tafsir_ibnu_kathir_id", verses)
+        return n
+
+    def flush():
+        nonlocal updated, failed
+        if not pending:
+            return
+        try:
+            updated += write(pending)
+            print(f"    … {updated} verses updated")
+        except Exception as e:
+            print(f"  ✗ Bulk update of {len(pending)} rows failed: {e}")
+            failed += len(pending)
+        pending.clear()
+
+    # Parsed line by line as the file downloads; each full group is written
+    # while the rest is still arriving
+    lines = 0
+    usage = openai_batch.UsageTally()
+    for obj in openai_batch.stream_results(output_file_id, RESULTS_FILE):
+        lines += 1
+        usage.add(obj)
         vid = obj.get("custom_id", "")
         if obj.get("error"):
             print(f"  ✗ {vid}: {obj['error']}")
@@ -229,38 +183,55 @@ def apply_results(batch: dict):
             continue
         text = choices[0].get("message", {}).get("content", "").strip()
         if text:
-            try:
-                sb_patch(vid, text)
-                updated += 1
-                if updated % 100 == 0:
-                    print(f"    … {updated} updated")
-            except Exception as e:
-                print(f"  ✗ PATCH {vid}: {e}")
-                failed += 1
+            pending.append((vid, text))
+            if len(pending) >= UPDATE_BATCH:
+                flush()
+    flush()
+    print(f"  {lines} result lines processed (saved to {RESULTS_FILE})")
+    print(f"  {usage.summary()}")
 
-    print(f"\n  ✓ Done: {updated} updated, {failed} failed")
+    print(f"\n  ✓ Done: {updated} verses updated, {failed} failed")
 
 # ── Main ──────────────────────────────────────────────────────────────────────
+def finish(ledger, batch_id, resuming=False):
+    """Poll a batch, apply its results and mark it applied. A resumed batch
+    that ended without results doesn't stop the run: wait() has recorded its
+    status, and its verses come back as todo."""
+    batch = poll_batch(batch_id, ledger, exit_on_failure=not resuming)
+    if batch is None:
+        return
+    if resuming and not batch.get("output_file_id"):
+        print("  ✗ No output file in batch response — its verses are submitted again below.")
+        ledger.mark_applied(batch_id)
+        return
+    apply_results(batch)
+    ledger.mark_applied(batch_id)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--poll", metavar="BATCH_ID",
                         help="Skip to polling an existing batch ID")
     args = parser.parse_args()
 
+    ledger = openai_batch.Ledger()
     if args.poll:
-        # Resume: just poll + apply
-        batch = poll_batch(args.poll)
-        apply_results(batch)
+        # Explicit batch: just poll + apply
+        finish(ledger, args.poll)
     else:
+        # Resume batches left over from an interrupted run first
+        for job in ledger.outstanding(JOB):
+            print(f"\n  Resuming batch {job['batch_id']} ({len(job['custom_ids'])} requests)")
+            finish(ledger, job["batch_id"], resuming=True)
+
         # Full run
         rows = fetch_todo()
+        unsubmitted = ledger.unsubmitted_ids(JOB)
+        rows = [r for r in rows if r["id"] not in unsubmitted]
         if not rows:
-            print("  ✓ All verses already translated. Nothing to do.")
+            print("  ✓ All passages already translated. Nothing to do.")
             return
         build_batch(rows)
-        batch_id = submit_batch()
-        batch    = poll_batch(batch_id)
-        apply_results(batch)
+        finish(ledger, submit_batch(ledger, rows))
 
     print("\n── Complete ─────────────────────────────────────────────────────────────────")
     print("  tafsir_ibnu_kathir_id populated in Supabase.")
@@ -18,6 +18,8 @@ Re-running is safe: upsert on primary key just overwrites tafsir_quraish_shihab.
 
 import json, os, sys, time, urllib.request, urllib.error
 
+import http_cache, http_client
+
 # ── Config ────────────────────────────────────────────────────────────────────
 
 def load_env():
@@ -48,8 +50,7 @@ def check_env():
         sys.exit(1)
 
 def http_get(url):
-    with urllib.request.urlopen(url, timeout=20) as resp:
-        return json.loads(resp.read().decode())
+    return http_cache.fetch_json(url, timeout=20, validate=http_cache.code_ok)
 
 def upsert_batch(rows):
     """Call update_tafsir_batch RPC — pure UPDATE, leaves all other columns untouched."""
@@ -61,16 +62,18 @@ def upsert_batch(rows):
         "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
     })
     try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
+        with http_client.urlopen(req, timeout=60) as resp:
             resp.read()   # 200/204 — body may be empty
     except urllib.error.HTTPError as e:
         raise RuntimeError(f"HTTP {e.code}: {e.read().decode()[:200]}")
 
 # ── Phase 1: Fetch tafsir per surah ───────────────────────────────────────────
 
+def tafsir_url(surah_number):
+    return f"https://api.alquran.cloud/v1/surah/{surah_number}/{TAFSIR_EDITION}"
+
 def fetch_tafsir(surah_number):
-    url = f"https://api.alquran.cloud/v1/surah/{surah_number}/{TAFSIR_EDITION}"
-    data = http_get(url)
+    data = http_get(tafsir_url(surah_number))
     if data.get("code") != 200:
         raise ValueError(f"alquran.cloud error for surah {surah_number}: {data.get('status')}")
     return data["data"]["ayahs"]   # list of {numberInSurah, text, ...}
@@ -86,6 +89,7 @@ def update_all():
     print(f"\n── Fetching tafsir ({TAFSIR_EDITION}) from alquran.cloud ─────────────────")
     for n in range(1, total_surahs + 1):
         print(f"  [{n:3}/114] Surah {n} … ", end="", flush=True)
+        polite = not http_cache.cached(tafsir_url(n))
         try:
             ayahs = fetch_tafsir(n)
             for ayah in ayahs:
@@ -96,7 +100,8 @@ def update_all():
             print(f"✓ ({len(ayahs)} ayat)")
         except Exception as e:
             print(f"✗  {e}")
-        time.sleep(0.3)
+        if polite:
+            time.sleep(0.3)
 
     print(f"\n  ✓ Fetched tafsir for {len(all_rows)} verses\n")
 
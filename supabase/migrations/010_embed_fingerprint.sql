@@ -0,0 +1,53 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Migration 010: Embedding fingerprints for incremental re-embedding
+--
+-- Stores md5(embed text) next to each vector so scripts/reembed.py
+-- --changed-only can find verses whose translation / tafsir layers changed
+-- since they were last embedded, and re-embed only those rows.
+--
+-- Run this in the Supabase SQL Editor.
+-- ─────────────────────────────────────────────────────────────────────────────
+
+-- ── 1. Fingerprint column ───────────────────────────────────────────────────
+ALTER TABLE quran_verses ADD COLUMN IF NOT EXISTS embed_fingerprint TEXT;
+
+-- ── 2. SQL mirror of reembed.build_embed_text() ─────────────────────────────
+-- !! Keep in sync with build_embed_text in scripts/reembed.py !!
+-- A mismatch is harmless (the verse is simply re-embedded every run) but
+-- defeats the point of --changed-only.
+CREATE OR REPLACE FUNCTION embed_text(qv quran_verses)
+RETURNS text
+LANGUAGE sql IMMUTABLE
+AS $$
+  SELECT btrim(concat_ws(' ',
+    nullif(qv.translation,                     ''),
+    nullif(qv.tafsir_quraish_shihab,           ''),
+    nullif(left(qv.tafsir_kemenag,        600), ''),
+    nullif(left(qv.tafsir_ibnu_kathir_id, 600), '')
+  ), E' \t\n\r');
+$$;
+
+-- ── 3. Ids whose stored fingerprint no longer matches their text ───────────
+-- Returns a single array so PostgREST's max-rows cap doesn't truncate it.
+CREATE OR REPLACE FUNCTION verses_needing_reembed()
+RETURNS text[]
+LANGUAGE sql STABLE
+AS $$
+  SELECT coalesce(array_agg(qv.id ORDER BY qv.surah_number, qv.verse_number), '{}')
+  FROM quran_verses qv
+  WHERE qv.embed_fingerprint IS DISTINCT FROM md5(embed_text(qv));
+$$;
+
+-- ── 4. update_embedding_batch RPC — now also records the fingerprint ───────
+CREATE OR REPLACE FUNCTION update_embedding_batch(updates jsonb)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  UPDATE quran_verses AS qv
+  SET embedding         = (u->>'embedding')::vector,
+      embed_fingerprint = coalesce(u->>'fingerprint', qv.embed_fingerprint)
+  FROM jsonb_array_elements(updates) AS u
+  WHERE qv.id = u->>'id';
+END;
+$$;
@@ -0,0 +1,59 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Migration 011: Packed float32 embedding transport
+--
+-- scripts/reembed.py used to send each vector as str(emb) — ~30 KB of
+-- decimal text per 1536-dim row that Postgres parses back into floats.
+-- These functions accept base64 of little-endian float32 instead (8 KB of
+-- base64 per row) and decode it server-side, bit-exact.
+--
+-- Benchmark: python3 scripts/bench_vector_transport.py
+--
+-- Run this in the Supabase SQL Editor (after migration 010).
+-- ─────────────────────────────────────────────────────────────────────────────
+
+-- ── 1. base64(float32 LE) → vector ──────────────────────────────────────────
+-- Rebuilds each IEEE-754 single from its bits. Postgres has no bit-cast from
+-- int4 to float4, so sign / exponent / mantissa are combined arithmetically;
+-- the result is exact in float8 and the final ::real[] cast is lossless.
+-- NaN / Infinity are not handled (embeddings never contain them).
+CREATE OR REPLACE FUNCTION decode_f32_vector(b64 text)
+RETURNS vector
+LANGUAGE sql IMMUTABLE STRICT
+AS $$
+  WITH raw AS (
+    SELECT decode(b64, 'base64') AS b
+  ),
+  words AS (
+    SELECT i,
+           (get_byte(b, i * 4)::bigint)
+         | (get_byte(b, i * 4 + 1)::bigint << 8)
+         | (get_byte(b, i * 4 + 2)::bigint << 16)
+         | (get_byte(b, i * 4 + 3)::bigint << 24) AS w
+    FROM raw, generate_series(0, length(b) / 4 - 1) AS i
+  )
+  SELECT array_agg(
+           (CASE WHEN (w >> 31) = 1 THEN -1.0::float8 ELSE 1.0::float8 END) *
+           (CASE WHEN ((w >> 23) & 255) = 0
+                 THEN (w & 8388607)::float8 * power(2.0::float8, -149)
+                 ELSE (1.0::float8 + (w & 8388607)::float8 / 8388608.0::float8)
+                      * power(2.0::float8, ((w >> 23) & 255) - 127)
+            END)
+           ORDER BY i
+         )::real[]::vector
+  FROM words;
+$$;
+
+-- ── 2. Bulk update RPC using the packed format ─────────────────────────────
+-- updates: [{"id": "2:255", "embedding_f32": "<base64>", "fingerprint": "<md5>"}]
+CREATE OR REPLACE FUNCTION update_embedding_batch_f32(updates jsonb)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  UPDATE quran_verses AS qv
+  SET embedding         = decode_f32_vector(u->>'embedding_f32'),
+      embed_fingerprint = coalesce(u->>'fingerprint', qv.embed_fingerprint)
+  FROM jsonb_array_elements(updates) AS u
+  WHERE qv.id = u->>'id';
+END;
+$$;
@@ -0,0 +1,14 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Migration 012: Keyset index for streaming table scans
+--
+-- scripts/supabase_rest.scan_verses pages through quran_verses with
+--   ORDER BY surah_number, verse_number
+--   WHERE (surah_number, verse_number) > (last page's last row)
+-- instead of offset/limit. This index makes every page an index range scan,
+-- so per-page latency stays flat across the whole table.
+--
+-- Run this in the Supabase SQL Editor.
+-- ─────────────────────────────────────────────────────────────────────────────
+
+CREATE UNIQUE INDEX IF NOT EXISTS quran_verses_surah_verse_idx
+ON quran_verses (surah_number, verse_number);
@@ -0,0 +1,45 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Migration 013: Generic bulk text-column update RPC
+--
+-- Same set-based pattern as update_tafsir_batch (migration 004), but for any
+-- whitelisted text column, so the seed / translate scripts can write
+-- hundreds of rows per request instead of one PATCH per verse.
+--
+--   POST /rest/v1/rpc/update_verse_text_column
+--   {"col": "tafsir_kemenag", "updates": [{"id": "1:1", "value": "..."}, ...]}
+--
+-- Returns the number of rows updated. Runs with the caller's rights, so RLS
+-- still limits it to the service role.
+--
+-- Run this in the Supabase SQL Editor.
+-- ─────────────────────────────────────────────────────────────────────────────
+
+CREATE OR REPLACE FUNCTION update_verse_text_column(col text, updates jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  n integer;
+BEGIN
+  IF col NOT IN (
+    'tafsir_quraish_shihab',
+    'tafsir_kemenag',
+    'tafsir_ibnu_kathir',
+    'tafsir_ibnu_kathir_id',
+    'asbabun_nuzul',
+    'asbabun_nuzul_id'
+  ) THEN
+    RAISE EXCEPTION 'column % is not bulk-updatable', col;
+  END IF;
+
+  EXECUTE format(
+    'UPDATE quran_verses AS qv
+        SET %I = u->>''value''
+       FROM jsonb_array_elements($1) AS u
+      WHERE qv.id = u->>''id''', col)
+  USING updates;
+
+  GET DIAGNOSTICS n = ROW_COUNT;
+  RETURN n;
+END;
+$$;
@@ -0,0 +1,186 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Migration 014: Ibnu Kathir passages (one row per shared verse range)
+--
+-- quran.com's Ibn Kathir commentary usually covers a range of verses, and the
+-- per-verse API repeats the same passage for every verse in it. Passages are
+-- stored once here; quran_verses.ibnu_kathir_passage_id maps each verse to
+-- its passage, and tafsir_ibnu_kathir / tafsir_ibnu_kathir_id stay populated
+-- as server-side copies so existing readers keep working.
+--
+--   upsert_ibnu_kathir_passages(passages)
+--     [{"surah": 2, "first": 1, "last": 5, "text": "..."}, ...]
+--     Upserts passages and copies their text to every verse in range.
+--     Stored passages overlapping an incoming range are replaced; a verse
+--     keeps its Indonesian text until its new passage is translated.
+--
+--   rebuild_ibnu_kathir_passages()
+--     Groups verses that have tafsir_ibnu_kathir but no passage yet (runs of
+--     consecutive verses with identical text) into passages. Run once below
+--     for existing data; seed_ibnu_kathir.py --mode ayah calls it after seeding.
+--
+--   apply_ibnu_kathir_passage_translations(updates)
+--     [{"id": 42, "value": "..."}, ...]
+--     Sets text_id on passages and copies it to their verses.
+--
+-- Run this in the Supabase SQL Editor.
+-- ─────────────────────────────────────────────────────────────────────────────
+
+CREATE TABLE IF NOT EXISTS tafsir_ibnu_kathir_passages (
+  id            SERIAL PRIMARY KEY,
+  surah_number  INTEGER NOT NULL,
+  first_verse   INTEGER NOT NULL,
+  last_verse    INTEGER NOT NULL,
+  text_en       TEXT    NOT NULL,
+  text_id       TEXT,
+  UNIQUE (surah_number, first_verse)
+);
+
+ALTER TABLE tafsir_ibnu_kathir_passages ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Allow anonymous read tafsir_ibnu_kathir_passages"
+  ON tafsir_ibnu_kathir_passages FOR SELECT USING (true);
+
+ALTER TABLE quran_verses
+  ADD COLUMN IF NOT EXISTS ibnu_kathir_passage_id INTEGER
+    REFERENCES tafsir_ibnu_kathir_passages(id) ON DELETE SET NULL;
+
+CREATE INDEX IF NOT EXISTS quran_verses_ibnu_kathir_passage_idx
+  ON quran_verses (ibnu_kathir_passage_id);
+
+-- ── Upsert from the by_chapter fetch ─────────────────────────────────────────
+
+CREATE OR REPLACE FUNCTION upsert_ibnu_kathir_passages(passages jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  n integer;
+BEGIN
+  CREATE TEMP TABLE incoming ON COMMIT DROP AS
+  SELECT (p->>'surah')::int AS surah_number,
+         (p->>'first')::int AS first_verse,
+         (p->>'last')::int  AS last_verse,
+         p->>'text'         AS text_en
+    FROM jsonb_array_elements(passages) AS p;
+
+  -- Passage boundaries moved: drop stored passages that overlap an incoming
+  -- range but start elsewhere (same start is updated in place below), so no
+  -- orphan is left for translate_ibnu_kathir.py to pay for. Their verses
+  -- fall back to NULL (ON DELETE SET NULL) and are re-linked below.
+  DELETE FROM tafsir_ibnu_kathir_passages AS t
+   USING incoming AS i
+   WHERE t.surah_number = i.surah_number
+     AND t.first_verse <> i.first_verse
+     AND t.first_verse <= i.last_verse
+     AND t.last_verse  >= i.first_verse
+     AND NOT EXISTS (SELECT 1 FROM incoming AS k
+                      WHERE k.surah_number = t.surah_number
+                        AND k.first_verse  = t.first_verse);
+
+  WITH saved AS (
+    INSERT INTO tafsir_ibnu_kathir_passages AS t
+           (surah_number, first_verse, last_verse, text_en)
+    SELECT surah_number, first_verse, last_verse, text_en FROM incoming
+    ON CONFLICT (surah_number, first_verse) DO UPDATE
+       SET last_verse = EXCLUDED.last_verse,
+           text_en    = EXCLUDED.text_en,
+           -- a changed source text invalidates the translation
+           text_id    = CASE WHEN t.text_en = EXCLUDED.text_en THEN t.text_id END
+    RETURNING t.*
+  )
+  UPDATE quran_verses AS qv
+     SET ibnu_kathir_passage_id = s.id,
+         tafsir_ibnu_kathir     = s.text_en,
+         -- keep the verse's current translation until the passage has one
+         -- (apply_ibnu_kathir_passage_translations overwrites it then)
+         tafsir_ibnu_kathir_id  = coalesce(s.text_id, qv.tafsir_ibnu_kathir_id)
+    FROM saved AS s
+   WHERE qv.surah_number = s.surah_number
+     AND qv.verse_number BETWEEN s.first_verse AND s.last_verse;
+
+  GET DIAGNOSTICS n = ROW_COUNT;
+  DROP TABLE incoming;
+  RETURN n;
+END;
+$$;
+
+-- ── Group per-verse rows that have no passage yet ────────────────────────────
+
+CREATE OR REPLACE FUNCTION rebuild_ibnu_kathir_passages()
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  n integer;
+BEGIN
+  WITH ordered AS (
+    SELECT id, surah_number, verse_number, tafsir_ibnu_kathir, tafsir_ibnu_kathir_id,
+           CASE WHEN tafsir_ibnu_kathir IS DISTINCT FROM
+                     lag(tafsir_ibnu_kathir) OVER w
+                  OR verse_number <> lag(verse_number) OVER w + 1
+                THEN 1 ELSE 0 END AS starts_passage
+      FROM quran_verses
+     WHERE tafsir_ibnu_kathir IS NOT NULL
+       AND ibnu_kathir_passage_id IS NULL
+    WINDOW w AS (PARTITION BY surah_number ORDER BY verse_number)
+  ), grouped AS (
+    SELECT *, sum(starts_passage) OVER (PARTITION BY surah_number ORDER BY verse_number) AS grp
+      FROM ordered
+  ), ranges AS (
+    SELECT surah_number, grp,
+           min(verse_number)          AS first_verse,
+           max(verse_number)          AS last_verse,
+           min(tafsir_ibnu_kathir)    AS text_en,
+           min(tafsir_ibnu_kathir_id) AS text_id
+      FROM grouped
+     GROUP BY surah_number, grp
+  ), saved AS (
+    INSERT INTO tafsir_ibnu_kathir_passages AS t
+           (surah_number, first_verse, last_verse, text_en, text_id)
+    SELECT surah_number, first_verse, last_verse, text_en, text_id FROM ranges
+    ON CONFLICT (surah_number, first_verse) DO UPDATE
+       SET last_verse = EXCLUDED.last_verse,
+           text_en    = EXCLUDED.text_en,
+           text_id    = CASE WHEN t.text_en = EXCLUDED.text_en
+                             THEN coalesce(t.text_id, EXCLUDED.text_id) END
+    RETURNING t.*
+  )
+  UPDATE quran_verses AS qv
+     SET ibnu_kathir_passage_id = s.id,
+         tafsir_ibnu_kathir_id  = coalesce(qv.tafsir_ibnu_kathir_id, s.text_id)
+    FROM saved AS s
+   WHERE qv.surah_number = s.surah_number
+     AND qv.verse_number BETWEEN s.first_verse AND s.last_verse
+     AND qv.ibnu_kathir_passage_id IS NULL;
+
+  GET DIAGNOSTICS n = ROW_COUNT;
+  RETURN n;
+END;
+$$;
+
+SELECT rebuild_ibnu_kathir_passages();
+
+-- ── Translations, written once per passage ───────────────────────────────────
+
+CREATE OR REPLACE FUNCTION apply_ibnu_kathir_passage_translations(updates jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  n integer;
+BEGIN
+  WITH saved AS (
+    UPDATE tafsir_ibnu_kathir_passages AS t
+       SET text_id = u->>'value'
+      FROM jsonb_array_elements(updates) AS u
+     WHERE t.id = (u->>'id')::int
+    RETURNING t.id, t.text_id
+  )
+  UPDATE quran_verses AS qv
+     SET tafsir_ibnu_kathir_id = s.text_id
+    FROM saved AS s
+   WHERE qv.ibnu_kathir_passage_id = s.id;
+
+  GET DIAGNOSTICS n = ROW_COUNT;
+  RETURN n;
+END;
+$$;
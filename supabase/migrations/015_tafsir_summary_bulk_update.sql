@@ -0,0 +1,60 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Migration 015: Bulk tafsir_summary update with per-row errors
+--
+-- generate_tafsir_summaries.py used to PATCH quran_verses once per verse.
+-- This writes a whole group of summaries in one call:
+--
+--   POST /rest/v1/rpc/update_tafsir_summary_batch
+--   {"updates": [{"id": "1:1", "summary": {...}}, ...]}
+--
+-- Returns one row per update that did NOT land — [{"id": "...", "error":
+-- "..."}] — so an empty array means every row was written. The group is
+-- first applied as a single set-based UPDATE; only if that statement fails
+-- is it retried row by row, so one bad row never sinks the rest.
+--
+-- Run this in the Supabase SQL Editor.
+-- ─────────────────────────────────────────────────────────────────────────────
+
+CREATE OR REPLACE FUNCTION update_tafsir_summary_batch(updates jsonb)
+RETURNS TABLE (id text, error text)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  r jsonb;
+BEGIN
+  -- Rows that can be rejected without touching the table
+  RETURN QUERY
+    SELECT u->>'id', CASE
+             WHEN jsonb_typeof(u->'summary') IS DISTINCT FROM 'object'
+               THEN 'summary is not a JSON object'
+             ELSE 'no such verse'
+           END
+      FROM jsonb_array_elements(updates) AS u
+     WHERE jsonb_typeof(u->'summary') IS DISTINCT FROM 'object'
+        OR NOT EXISTS (SELECT 1 FROM quran_verses qv WHERE qv.id = u->>'id');
+
+  BEGIN
+    UPDATE quran_verses AS qv
+       SET tafsir_summary = u->'summary'
+      FROM jsonb_array_elements(updates) AS u
+     WHERE qv.id = u->>'id'
+       AND jsonb_typeof(u->'summary') = 'object';
+  EXCEPTION WHEN OTHERS THEN
+    -- Set-based statement failed as a whole: fall back to one row at a time
+    FOR r IN
+      SELECT e FROM jsonb_array_elements(updates) AS e
+       WHERE jsonb_typeof(e->'summary') = 'object'
+    LOOP
+      BEGIN
+        UPDATE quran_verses AS qv
+           SET tafsir_summary = r->'summary'
+         WHERE qv.id = r->>'id';
+      EXCEPTION WHEN OTHERS THEN
+        id    := r->>'id';
+        error := SQLERRM;
+        RETURN NEXT;
+      END;
+    END LOOP;
+  END;
+END;
+$$;